@@ -0,0 +1,378 @@
+"""
+Benchmarks for the scheduler and the prep_data loaders.
+
+    python benchmarks/run.py                        # quick grid
+    python benchmarks/run.py --grid full --steps 50000
+    python benchmarks/run.py --compare benchmarks/results/<commit>.json
+
+Annealing cases are generated with prep_data.from_random over a grid of
+problem sizes; loader cases read synthetic SQLite databases (and, for
+from_geojson_gyb, a GeoJSON of the stands) built in a temporary directory.
+Each case runs in its own process so its peak RSS can be measured. For
+every case we report
+
+    schedule    steps/sec, peak RSS, and the steps taken to come within
+                10% and 1% of the best known metric (the best of this run,
+                or of the compared results if they found a better one)
+    loaders     rows/sec, peak RSS
+
+Results are saved as JSON, by default to benchmarks/results/<commit>.json
+(ignored by git), for comparison across commits with --compare.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import platform
+import argparse
+import resource
+import tempfile
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.observers import Observer
+from harvestscheduler.trace import TraceRecorder, load_trace, NEW_BEST
+
+# stands, mgmts, periods, variables
+GRIDS = {
+    'quick': {
+        'stands': [100, 1000, 10000],
+        'mgmts': [10, 50],
+        'periods': [20],
+        'variables': [3],
+    },
+    'full': {
+        'stands': [100, 1000, 10000, 100000],
+        'mgmts': [10, 25, 100],
+        'periods': [10, 20, 40],
+        'variables': [3, 6, 12],
+    },
+}
+
+# loader cases, number of stands in the synthetic databases
+LOADER_STANDS = {'quick': [1000], 'full': [1000, 10000]}
+
+STRATEGIES = ['cumulative_maximize', 'cumulative_minimize', 'evenflow']
+
+# fractions of the best known metric for time-to-quality
+QUALITY = [0.10, 0.01]
+
+
+def variables(num_variables):
+    return [{'name': 'v%d' % i, 'strategy': STRATEGIES[i % len(STRATEGIES)], 'weight': 1.0}
+            for i in range(num_variables)]
+
+
+def peak_rss_mb():
+    # kilobytes on linux, bytes on OS X
+    scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class _Finish(Observer):
+    def on_finish(self, stats):
+        self.stats = stats
+
+
+def bench_schedule(case, steps, workdir):
+    stand_data, axis_map, valid_mgmts = prep_data.from_random(
+        case['stands'], case['mgmts'], case['periods'], case['variables'])
+    axis_map['variables'] = variables(case['variables'])
+    finish = _Finish()
+    path = os.path.join(workdir, 'trace.npy')
+    best = schedule(stand_data, axis_map, valid_mgmts, steps=steps,
+                    report_interval=max(1, steps // 10), seed=0, observers=[finish],
+                    trace=TraceRecorder(path, min_outcome=NEW_BEST))[0]
+    trace = load_trace(path)
+    return {
+        'steps': steps,
+        'steps_per_sec': finish.stats['steps_per_sec'],
+        'timings': finish.stats['timings'],
+        'best_metric': best,
+        # for time-to-quality against other results
+        'new_bests': [trace['step'].tolist(), trace['best'].tolist()],
+    }
+
+
+def make_fvs_stands(path, num_stands, num_periods=20, rng=None):
+    """ fvs_stands with 5 rxs x 2 offsets, a fifth of them missing, for prep_db2 """
+    rng = rng or random.Random(0)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE fvs_stands (standid text, rx integer, "offset" integer, '
+                 'climate text, year integer, timber real, carbon real, owl real, cost real)')
+    for s in range(num_stands):
+        rows = []
+        for rx, offset in itertools.product(range(1, 6), (0, 5)):
+            if rng.random() < 0.2:
+                continue
+            for climate in ('Ensemble-rcp60', 'Other'):
+                for y in range(num_periods):
+                    rows.append(('s%06d' % s, rx, offset, climate, 2010 + 5 * y,
+                                 rng.random(), rng.random(), rng.random(), rng.random()))
+        conn.executemany('INSERT INTO fvs_stands VALUES (?,?,?,?,?,?,?,?,?)', rows)
+    conn.execute(prep_data.FVS_STANDS_INDEX)
+    conn.commit()
+    conn.close()
+    return (path,)
+
+
+def make_fvsaggregate(path, num_stands, num_periods=20, rng=None):
+    """ stands and fvsaggregate with 4 rxs x 2 offsets at two site classes, for prep_db """
+    rng = rng or random.Random(0)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE stands (standid integer, acres real, slope real, '
+                 'sitecls integer, rx text)')
+    conn.execute('CREATE TABLE fvsaggregate (var text, climate text, cond integer, '
+                 'site integer, rx integer, "offset" integer, year integer, '
+                 'total_stand_carbon real, removed_merch_ft3 real, NSONEST real, '
+                 'FIREHZD real, CUT_TYPE text)')
+    for s in range(num_stands):
+        conn.execute('INSERT INTO stands VALUES (?,?,?,?,?)',
+                     (s, rng.uniform(5, 50), rng.uniform(0, 40), rng.choice([2, 3]), ''))
+        rows = []
+        for rx, offset in itertools.product(range(1, 5), (0, 5)):
+            if rng.random() < 0.2:
+                continue
+            for site in (2, 3):
+                for y in range(num_periods):
+                    rows.append(('PN', 'Ensemble-rcp60', s, site, rx, offset, 2010 + 5 * y,
+                                 rng.random() * 100, rng.random() * 1000, rng.random(),
+                                 rng.choice([1, 2, 3, 4, 5]), rng.choice(['', '1', '2', '3'])))
+        conn.executemany('INSERT INTO fvsaggregate VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+    conn.execute(prep_data.FVSAGGREGATE_INDEX)
+    conn.commit()
+    conn.close()
+    return (path,)
+
+
+def make_geojson_gyb(path, num_stands, num_periods=20, rng=None):
+    """
+    A GeoJSON of square stands, two to a condition, next to a Growth-Yield
+    Batch trees_fvsaggregate with 4 rxs x 2 offsets, for from_geojson_gyb
+    """
+    rng = rng or random.Random(0)
+    side = int(np.ceil(np.sqrt(num_stands)))
+    geojson = path + '.geojson'
+    with open(geojson, 'w') as fh:
+        fh.write('{"type": "FeatureCollection", "features": [\n')
+        for s in range(num_stands):
+            x, y, size = (s % side) * 200.0, (s // side) * 200.0, rng.uniform(50, 200)
+            ring = [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+            feature = {'type': 'Feature', 'properties': {'ID': 's%06d' % s, 'condid': s // 2},
+                       'geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+            fh.write((',\n' if s else '') + json.dumps(feature))
+        fh.write('\n]}\n')
+
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE trees_fvsaggregate (cond integer, rx integer, "offset" text, '
+                 'year integer, removed_merch_bdft real, total_stand_carbon real, '
+                 'FIREHZD real)')
+    for cond in range((num_stands + 1) // 2):
+        rows = []
+        for rx, offset in itertools.product(range(1, 5), ('0', '5')):
+            if rng.random() < 0.2:
+                continue
+            for y in range(num_periods):
+                rows.append((cond, rx, offset, 2010 + 5 * y, rng.random() * 5000,
+                             rng.random() * 100, rng.choice([1, 2, 3, 4, 5])))
+        conn.executemany('INSERT INTO trees_fvsaggregate VALUES (?,?,?,?,?,?,?)', rows)
+    conn.commit()
+    conn.close()
+    return (geojson, path)
+
+
+LOADERS = {
+    'prep_db2': (make_fvs_stands, 'fvs_stands', prep_data.prep_db2),
+    'prep_db': (make_fvsaggregate, 'fvsaggregate', prep_data.prep_db),
+    'from_geojson_gyb': (make_geojson_gyb, 'trees_fvsaggregate', prep_data.from_geojson_gyb),
+}
+
+
+def bench_loader(case, workdir):
+    make, table, prep = LOADERS[case['loader']]
+    path = os.path.join(workdir, 'fixture.db')
+    args = make(path, case['stands'])
+    conn = sqlite3.connect(path)
+    rows = conn.execute('SELECT count(*) FROM %s' % table).fetchone()[0]
+    conn.close()
+
+    start = time.time()
+    stand_data, axis_map, valid_mgmts = prep(*args)
+    seconds = time.time() - start
+    return {'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / max(seconds, 1e-9),
+            'shape': list(stand_data.shape)}
+
+
+def _run_case(case, steps, results):
+    workdir = tempfile.mkdtemp(prefix='harvestscheduler-bench-')
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        baseline = peak_rss_mb()
+        if case['kind'] == 'schedule':
+            result = bench_schedule(case, steps, workdir)
+        else:
+            result = bench_loader(case, workdir)
+        result['peak_rss_mb'] = peak_rss_mb()
+        result['baseline_rss_mb'] = baseline
+        results.put(result)
+    except Exception as e:
+        results.put({'error': repr(e)})
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_case(case, steps):
+    """ Run a case in a child process, for a peak RSS of its own """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case, args=(case, steps, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # killed, e.g. out of memory
+                result = {'error': 'exit code %s' % process.exitcode}
+                break
+    process.join()
+    return result
+
+
+def cases(grid, max_bytes):
+    for stands, mgmts, periods, num_variables in itertools.product(
+            *[GRIDS[grid][x] for x in ('stands', 'mgmts', 'periods', 'variables')]):
+        # from_random makes int64 data
+        if stands * mgmts * periods * num_variables * 8 > max_bytes:
+            continue
+        yield {'kind': 'schedule', 'stands': stands, 'mgmts': mgmts, 'periods': periods,
+               'variables': num_variables}
+    for loader in sorted(LOADERS):
+        for stands in LOADER_STANDS[grid]:
+            yield {'kind': 'loader', 'loader': loader, 'stands': stands}
+
+
+def case_name(case):
+    if case['kind'] == 'loader':
+        return '%s/stands=%d' % (case['loader'], case['stands'])
+    return 'schedule/%d-%d-%d-%d' % (case['stands'], case['mgmts'], case['periods'],
+                                     case['variables'])
+
+
+def steps_to_quality(new_bests, best_known):
+    """ The step of the first best within each QUALITY fraction of best_known """
+    result = {}
+    for fraction in QUALITY:
+        key = 'steps_to_%g%%' % (fraction * 100)
+        result[key] = None
+        for step, best in zip(*new_bests):
+            if best <= best_known + fraction * abs(best_known):
+                result[key] = step + 1
+                break
+    return result
+
+
+def add_quality(results, previous=None):
+    """ Time-to-quality against the best metric known for each case """
+    for name, result in results.items():
+        if 'new_bests' not in result:
+            continue
+        best_known = result['best_metric']
+        if previous and 'best_metric' in previous.get(name, {}):
+            best_known = min(best_known, previous[name]['best_metric'])
+        result['best_known'] = best_known
+        result.update(steps_to_quality(result['new_bests'], best_known))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def summary(result):
+    if 'error' in result:
+        return 'ERROR %s' % result['error']
+    if 'rows_per_sec' in result:
+        return '%10.0f rows/sec  %8.1f MB' % (result['rows_per_sec'], result['peak_rss_mb'])
+    return '%10.0f steps/sec %8.1f MB  to 10%%: %-7s to 1%%: %s' % (
+        result['steps_per_sec'], result['peak_rss_mb'],
+        result['steps_to_10%'], result['steps_to_1%'])
+
+
+def compare(results, previous):
+    """ Print the ratio of each case's throughput to the previous results """
+    print
+    print 'compared to %s' % previous['commit']
+    for name in sorted(results['results']):
+        new, old = results['results'][name], previous['results'].get(name)
+        if old is None or 'error' in new or 'error' in old:
+            continue
+        key = 'rows_per_sec' if 'rows_per_sec' in new else 'steps_per_sec'
+        print '%-32s %5.2fx %s   %5.2fx peak RSS' % (
+            name, new[key] / old[key], key, new['peak_rss_mb'] / old['peak_rss_mb'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--grid', choices=sorted(GRIDS), default='quick')
+    parser.add_argument('--steps', type=int, default=20000, help='annealing steps per case')
+    parser.add_argument('--max-bytes', type=float, default=2e9,
+                        help='skip problems whose stand data is larger')
+    parser.add_argument('--output', help='JSON results, default results/<commit>.json')
+    parser.add_argument('--compare', help='JSON results of another commit')
+    args = parser.parse_args(argv)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'grid': args.grid,
+        'steps': args.steps,
+        'results': {},
+    }
+    for case in cases(args.grid, args.max_bytes):
+        name = case_name(case)
+        result = run_case(case, args.steps)
+        results['results'][name] = result
+        add_quality({name: result}, previous and previous['results'])
+        print '%-32s %s' % (name, summary(result))
+
+    output = args.output or os.path.join(HERE, 'results', '%s.json' % commit)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    print
+    print 'results written to %s' % output
+
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 from __future__ import absolute_import
 
 from ._scheduler import schedule
+from ._tempering import parallel_tempering
 
 __all__ = [
     'schedule',
+    'parallel_tempering',
 ]
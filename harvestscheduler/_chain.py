@@ -0,0 +1,303 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import numpy as np
+import math
+from timeit import default_timer
+from ._sampler import ProposalSampler
+
+MOVE_MODES = ('single', 'heatbath', 'metropolis')
+
+# outcome of a step, each implies the ones before it
+REJECT = 0
+ACCEPT = 1
+IMPROVE = 2
+NEW_BEST = 3
+
+
+class AnnealingChain(object):
+    """
+    A single Markov chain over the mgmt of each stand.
+
+    Holds the current mgmts and the objective aggregates for them, and
+    tracks the best configuration it has visited. Moves are applied to
+    mgmts in place; accepted moves go into an undo log and a new best
+    only records its position in the log. ``best_mgmts`` is brought up
+    to date by replaying the log in ``flush_best``.
+
+    move_mode controls how each step proposes a move:
+        'single'     -- one random (stand, mgmt) pair, Metropolis acceptance
+        'heatbath'   -- score every valid mgmt for a random stand in one shot and
+                        sample the stand's next mgmt by its Boltzmann weight
+        'metropolis' -- as 'heatbath' but propose a different mgmt by weight and
+                        accept it with the Metropolized Gibbs criterion
+
+    adjacency is an optional ClumpPenalty whose penalty is part of the metric.
+    seed seeds the ProposalSampler that draws every random number of the chain.
+    """
+
+    def __init__(self, data, valid_mgmts, objective, mgmts, move_mode='single',
+                 adjacency=None, seed=None):
+        if move_mode not in MOVE_MODES:
+            raise ValueError("Unknown move_mode `%s`" % move_mode)
+        self.data = data
+        self.valid_mgmts = valid_mgmts
+        self.objective = objective
+        self.mgmts = mgmts
+        self.move_mode = move_mode
+        self.num_stands, self.num_mgmts = data.shape[:2]
+        self.sampler = ProposalSampler(valid_mgmts, self.num_mgmts, seed)
+
+        # optional ClumpPenalty, its penalty is added to the objective metric
+        self.adjacency = adjacency
+        if adjacency is not None:
+            adjacency.reset(mgmts)
+        self.sync()
+
+    def sync(self):
+        """
+        Take up the current mgmts, objective and adjacency as they are, e.g.
+        after polish_mgmts has moved stands through them, as the best
+        configuration so far
+        """
+        self.metric = self.objective.metric
+        if self.adjacency is not None:
+            self.metric += self.adjacency.penalty
+        # metric of the most recently proposed move, and its objective terms
+        self.proposed_metric = self.metric
+        self.proposed_terms = self.objective.state.terms
+        self.reset_best()
+
+    def reset_best(self):
+        """ Treat the current configuration as the best one """
+        self.best_metric = self.metric
+        self.best_metrics = self.objective.components.tolist()
+        self.best_vars_over_time = self.objective.totals
+        self.best_mgmts = list(self.mgmts)
+        self._journal = []
+        self._best_mark = 0
+
+    def flush_best(self):
+        """
+        Replay the moves leading up to the best configuration onto
+        best_mgmts, keeping only the moves made since in the undo log
+        """
+        best_mgmts = self.best_mgmts
+        for stand, mgmt in self._journal[:self._best_mark]:
+            best_mgmts[stand] = mgmt
+        journal = self._journal[self._best_mark:]
+        if len(journal) > len(best_mgmts):
+            # only the last move for each stand matters once replayed
+            journal = list(dict(journal).items())
+        self._journal = journal
+        self._best_mark = 0
+        return best_mgmts
+
+    def step(self, temp, timings=None):
+        """
+        Propose a move at temperature temp and accept or reject it.
+        Returns REJECT, ACCEPT, IMPROVE or NEW_BEST
+
+        timings, if given, is a list of three floats to which the seconds
+        spent proposing, evaluating and bookkeeping the move are added.
+        """
+        if timings is not None:
+            start = default_timer()
+        objective = self.objective
+        mgmts = self.mgmts
+        data = self.data
+        adjacency = self.adjacency
+
+        accept = False
+        improve = False
+
+        new_stand, rand_mgmt, rand, rand2 = self.sampler.draw()
+        old_mgmt = mgmts[new_stand]
+
+        if self.move_mode == 'single':
+            new_mgmt = self.sampler.other_mgmt(new_stand, old_mgmt, rand_mgmt)
+            mgmts[new_stand] = new_mgmt
+            if timings is not None:
+                proposed = default_timer()
+
+            # Calculate the diff to vars_over_time due to the change in mgmt
+            diff = data[new_stand, new_mgmt] - data[new_stand, old_mgmt]
+
+            # score the property-level totals with the diff applied
+            # note that all metrics return some value that is effectively scaled 0-100
+            objective_metric = objective.evaluate(diff)
+            proposed_terms = objective.candidate_terms
+
+            # determine if adjacent stands constitute clumps of harvesting that
+            # exceed regulatory limits
+            if adjacency is not None:
+                objective_metric += adjacency.evaluate(new_stand, old_mgmt, new_mgmt)
+
+            delta = objective_metric - self.metric
+
+            k = 1
+            if delta < 0.0:  # an improvement
+                accept = True
+                improve = True
+            elif math.exp(-(k*delta)/temp) > rand:  # within temperature, accept it
+                accept = True
+                improve = False
+
+        else:
+            candidates = self.sampler.candidates(new_stand)
+            current = candidates.index(old_mgmt)
+            if timings is not None:
+                proposed = default_timer()
+
+            # the diffs for every candidate mgmt of this stand, (k x time periods x variables)
+            diffs = data[new_stand, candidates] - data[new_stand, old_mgmt]
+            deltas = objective.evaluate_batch(diffs) - objective.metric
+            if adjacency is not None:
+                deltas += [adjacency.evaluate(new_stand, old_mgmt, mgmt) - adjacency.penalty
+                           for mgmt in candidates]
+
+            chosen = _neighborhood_choice(deltas, current, temp, self.move_mode, rand, rand2)
+            new_mgmt = candidates[chosen]
+            if chosen == current:
+                objective_metric = self.metric
+                proposed_terms = objective.state.terms
+            else:
+                mgmts[new_stand] = new_mgmt
+                # score the chosen move exactly, ready to commit
+                objective_metric = objective.evaluate(diffs[chosen])
+                proposed_terms = objective.candidate_terms
+                if adjacency is not None:
+                    objective_metric += adjacency.evaluate(new_stand, old_mgmt, new_mgmt)
+                accept = True
+                improve = deltas[chosen] < 0.0
+
+        self.proposed_metric = objective_metric
+        self.proposed_terms = proposed_terms
+        if timings is not None:
+            evaluated = default_timer()
+
+        if not accept:
+            mgmts[new_stand] = old_mgmt  # restore previous mgmt
+            outcome = REJECT
+        else:
+            objective.commit()
+            if adjacency is not None:
+                adjacency.commit()
+            self._journal.append((new_stand, new_mgmt))
+            self.metric = objective_metric
+
+            if objective_metric < self.best_metric:
+                self._best_mark = len(self._journal)
+                self.best_metric = objective_metric
+                self.best_metrics = objective.components.tolist()
+                self.best_vars_over_time = objective.totals
+                outcome = NEW_BEST
+            else:
+                outcome = IMPROVE if improve else ACCEPT
+
+        if timings is not None:
+            timings[0] += proposed - start
+            timings[1] += evaluated - proposed
+            timings[2] += default_timer() - evaluated
+        return outcome
+
+    def sample_deltas(self, n):
+        """
+        The change in metric of n random single moves from the current
+        configuration, evaluated without making any of them
+        """
+        deltas = np.empty(n)
+        mgmts = self.mgmts
+        for i in range(n):
+            stand, rand_mgmt, rand, rand2 = self.sampler.draw()
+            old_mgmt = mgmts[stand]
+            new_mgmt = self.sampler.other_mgmt(stand, old_mgmt, rand_mgmt)
+            mgmts[stand] = new_mgmt
+            metric = self.objective.evaluate(self.data[stand, new_mgmt] - self.data[stand, old_mgmt])
+            if self.adjacency is not None:
+                metric += self.adjacency.evaluate(stand, old_mgmt, new_mgmt)
+            mgmts[stand] = old_mgmt
+            deltas[i] = metric - self.metric
+        return deltas
+
+    def get_state(self):
+        """
+        Everything needed to continue the chain exactly, as a flat dict of
+        arrays: the current and best configurations, the undo log, the
+        objective aggregates, the sampler and any adjacency clumps
+        """
+        state = {
+            'mgmts': np.array(self.mgmts, dtype=np.int64),
+            'best_mgmts': np.array(self.best_mgmts, dtype=np.int64),
+            'journal': np.array(self._journal, dtype=np.int64).reshape(-1, 2),
+            'best_mark': np.int64(self._best_mark),
+            'metrics': np.array([self.metric, self.proposed_metric, self.best_metric]),
+            'best_metrics': np.array(self.best_metrics, dtype=np.float64),
+            'best_vars_over_time': np.array(self.best_vars_over_time),
+        }
+        parts = [('objective', self.objective), ('sampler', self.sampler)]
+        if self.adjacency is not None:
+            parts.append(('adjacency', self.adjacency))
+        for prefix, part in parts:
+            state.update(_prefixed(prefix, part.get_state()))
+        return state
+
+    def set_state(self, state):
+        """ Continue from a state returned by get_state, on the same problem """
+        self.mgmts[:] = state['mgmts'].tolist()
+        self.best_mgmts = state['best_mgmts'].tolist()
+        self._journal = [tuple(x) for x in state['journal'].tolist()]
+        self._best_mark = int(state['best_mark'])
+        # numpy floats, as the metrics of the interrupted chain were
+        self.metric, self.proposed_metric, self.best_metric = state['metrics']
+        self.best_metrics = state['best_metrics'].tolist()
+        self.best_vars_over_time = np.array(state['best_vars_over_time'])
+        self.objective.set_state(_substate(state, 'objective'))
+        self.sampler.set_state(_substate(state, 'sampler'))
+        if self.adjacency is not None:
+            self.adjacency.set_state(_substate(state, 'adjacency'))
+
+    def set_configuration(self, mgmts, vars_over_time):
+        """ Replace the current configuration, e.g. after a replica exchange """
+        self.mgmts = mgmts
+        self.metric = self.objective.reset(vars_over_time)
+        if self.adjacency is not None:
+            self.metric += self.adjacency.reset(mgmts)
+        self.reset_best()
+
+
+def _prefixed(prefix, state):
+    """ A state dict with its entries named prefix.name, see _substate """
+    return dict(('%s.%s' % (prefix, name), value) for name, value in state.items())
+
+
+def _substate(state, prefix):
+    """ The entries of a flat state dict under prefix, without it """
+    prefix += '.'
+    return dict((name[len(prefix):], value) for name, value in state.items()
+                if name.startswith(prefix))
+
+
+def _neighborhood_choice(deltas, current, temp, move_mode, rand, rand2):
+    """
+    Choose the index of a stand's next mgmt from the change in metric of
+    each of its candidates (deltas, zero at the current index)
+    """
+    # Boltzmann weights, relative to the best candidate to avoid overflow
+    weights = np.exp(-(deltas - deltas.min()) / temp)
+    cumulative = weights.cumsum()
+
+    if move_mode == 'heatbath':
+        # sample directly from the stand's conditional distribution
+        chosen = cumulative.searchsorted(rand * cumulative[-1], side='right')
+        return min(int(chosen), len(deltas) - 1)
+
+    # Metropolized Gibbs: propose any other candidate by weight and accept
+    # with probability min(1, (1 - p_current) / (1 - p_chosen))
+    probs = weights / cumulative[-1]
+    others = cumulative - np.where(np.arange(len(deltas)) >= current, weights[current], 0)
+    if others[-1] <= 0:
+        return current
+    chosen = min(int(others.searchsorted(rand * others[-1], side='right')), len(deltas) - 1)
+    if chosen != current and rand2 * (1 - probs[chosen]) < 1 - probs[current]:
+        return chosen
+    return current
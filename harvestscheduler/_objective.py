@@ -0,0 +1,383 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import numpy as np
+from .utils import valid_mgmt_mask
+
+STRATEGIES = (
+    'cumulative_maximize',
+    'cumulative_minimize',
+    'evenflow',
+    'within_bounds',
+    'evenflow_target',
+)
+
+
+def stand_bounds(stand_sums, valid=None):
+    """
+    The smallest and largest of stand_sums (stands x mgmts [x variables])
+    over the mgmts of each stand, added up across stands. valid, a boolean
+    (stands x mgmts) array, limits each stand to its valid mgmts.
+    """
+    if valid is None:
+        return stand_sums.min(axis=1).sum(axis=0), stand_sums.max(axis=1).sum(axis=0)
+    valid = valid.reshape(valid.shape + (1,) * (stand_sums.ndim - 2))
+    mins = np.where(valid, stand_sums, np.inf).min(axis=1).sum(axis=0)
+    maxes = np.where(valid, stand_sums, -np.inf).max(axis=1).sum(axis=0)
+    return mins, maxes
+
+
+def theoretical_bounds(data, valid_mgmts=None):
+    """
+    For each variable, sum across time periods, take the min/max mgmt
+    for each stand and add them up across all stands. Only the valid mgmts
+    of each stand count when valid_mgmts are given, as they do for the
+    stand data that knows its own bounds (compact.RaggedStandData,
+    store.StandDataFile), which returns those.
+    Returns two 1D arrays (mins, maxes) with length == num_variables
+    """
+    if hasattr(data, 'bounds'):
+        return data.bounds
+    num_variables = data.shape[3]
+    valid = None if valid_mgmts is None else valid_mgmt_mask(valid_mgmts, data.shape[1])
+    mins = np.zeros(num_variables)
+    maxes = np.zeros(num_variables)
+    for s in range(num_variables):
+        stand_sums = data[:, :, :, s].sum(axis=2)
+        mins[s], maxes[s] = stand_bounds(stand_sums, valid)
+    return mins, maxes
+
+
+def _per_period(value, num_periods):
+    """ Expand a scalar or a list of length num_periods to a 1D float array """
+    arr = np.zeros(num_periods) + np.asarray(value, dtype=np.float64)
+    if arr.shape != (num_periods,):
+        raise ValueError("Expected a scalar or %d values, got %r" % (num_periods, value))
+    return arr
+
+
+class CompiledProblem(object):
+    """
+    The objective function configuration from axis_map['variables'],
+    compiled once before annealing.
+
+    Variables are grouped by strategy family and reordered so that each
+    family is a contiguous block of columns (``order`` maps the compiled
+    column back to the original variable). Each family is then scored by
+    a single vectorized expression over all of its variables:
+
+        linear   -- cumulative_maximize and cumulative_minimize,
+                    scale * sum over time + offset
+        evenflow -- scale * variance over time
+        penalty  -- within_bounds and evenflow_target, scale * sum over time
+                    of a piecewise linear violation (10x penalty below target)
+
+    Variables with no variation (theoretical min == max) are placed
+    after the families and never contribute.
+    """
+
+    def __init__(self, variables, num_periods, theoretical_mins, theoretical_maxes):
+        self.num_periods = P = num_periods
+        self.num_variables = len(variables)
+        self.variable_names = [x['name'] for x in variables]
+        self.strategies = [x['strategy'] for x in variables]
+        self.weights = np.array([x['weight'] for x in variables], dtype=np.float64)
+        self.theoretical_mins = np.asarray(theoretical_mins, dtype=np.float64)
+        self.theoretical_maxes = np.asarray(theoretical_maxes, dtype=np.float64)
+
+        families = {'linear': [], 'evenflow': [], 'bounds': [], 'target': []}
+        constant = []
+        for s, strategy in enumerate(self.strategies):
+            if strategy not in STRATEGIES:
+                raise Exception("Unknown optimization strategy `%s`" % strategy)
+            if self.theoretical_mins[s] == self.theoretical_maxes[s]:
+                # if there's no variation, don't even bother
+                constant.append(s)
+            elif strategy.startswith('cumulative_'):
+                families['linear'].append(s)
+            elif strategy == 'evenflow':
+                families['evenflow'].append(s)
+            elif strategy == 'within_bounds':
+                families['bounds'].append(s)
+            elif strategy == 'evenflow_target':
+                families['target'].append(s)
+
+        # column layout: linear | evenflow | bounds | target | constant
+        self.slices = {}
+        start = 0
+        for name in ('linear', 'evenflow', 'bounds', 'target'):
+            self.slices[name] = slice(start, start + len(families[name]))
+            start += len(families[name])
+        self.num_terms = start
+        self.order = np.array(families['linear'] + families['evenflow'] +
+                              families['bounds'] + families['target'] + constant,
+                              dtype=np.intp)
+        self.inverse_order = np.argsort(self.order)
+
+        # note that all metrics are effectively scaled 0-100
+        idx = self.order[:self.num_terms]
+        w = self.weights[idx]
+        minval = self.theoretical_mins[idx]
+        maxval = self.theoretical_maxes[idx]
+        spread = maxval - minval
+        self.scales = np.zeros(self.num_terms)
+        self.offsets = np.zeros(self.num_terms)
+
+        lin = self.slices['linear']
+        maximize = np.array([self.strategies[s] == 'cumulative_maximize'
+                             for s in families['linear']], dtype=bool)
+        # compare the value to the theoretical maximum / minimum
+        self.scales[lin] = np.where(maximize, -100.0, 100.0) * w[lin] / spread[lin]
+        self.offsets[lin] = np.where(maximize, maxval[lin], -minval[lin]) * 100 * w[lin] / spread[lin]
+
+        # sum of squared deviations from the mean, i.e. the variance over time
+        # relative to the range by period
+        sl = self.slices['evenflow']
+        self.scales[sl] = 100 * w[sl] / spread[sl]
+
+        # sum of violations relative to the range by period
+        sl = self.slices['bounds']
+        self.scales[sl] = 100 * w[sl] * P / spread[sl]
+
+        # mean of deviations relative to half the range by period
+        sl = self.slices['target']
+        self.scales[sl] = 200 * w[sl] / spread[sl]
+
+        # bounds and targets are both piecewise linear penalties on the totals
+        # over time; each period's violation is max(a0*x + b0, a1*x + b1, 0)
+        self.slices['penalty'] = slice(self.slices['bounds'].start, self.slices['target'].stop)
+        num_bounds = len(families['bounds'])
+        num_penalties = num_bounds + len(families['target'])
+        self.penalty_slopes = np.zeros((3, P, num_penalties))
+        self.penalty_intercepts = np.zeros((3, P, num_penalties))
+
+        targets = [x.get('targets', None) for x in variables]
+        for i, s in enumerate(families['bounds']):
+            lower, upper = targets[s]
+            # positive values are below the min
+            self.penalty_slopes[0, :, i] = -1
+            self.penalty_intercepts[0, :, i] = _per_period(lower, P)
+            # positive values are above the max
+            self.penalty_slopes[1, :, i] = 1
+            self.penalty_intercepts[1, :, i] = -_per_period(upper, P)
+        for i, s in enumerate(families['target'], num_bounds):
+            target = _per_period(targets[s], P)
+            # absolute val but 10x penalty for going *below* target
+            self.penalty_slopes[0, :, i] = 1
+            self.penalty_intercepts[0, :, i] = -target
+            self.penalty_slopes[1, :, i] = -10
+            self.penalty_intercepts[1, :, i] = 10 * target
+
+    def to_compiled(self, arr):
+        """ Reorder the variables axis (the last one) into compiled order """
+        return np.take(arr, self.order, axis=-1)
+
+    def from_compiled(self, arr):
+        """ Reorder the variables axis (the last one) back to the original order """
+        return np.take(arr, self.inverse_order, axis=-1)
+
+
+def compile_problem(data, axis_map, bounds=None, valid_mgmts=None):
+    """
+    Compile the objective function for stand data and an axis_map
+    with 'variables' configured. Computes the theoretical bounds of each
+    variable from the data, over valid_mgmts if given, unless (mins, maxes)
+    are passed in.
+    """
+    num_periods, num_variables = data.shape[2:]
+    variables = axis_map['variables']
+    assert len(variables) == num_variables
+    if bounds is None:
+        bounds = theoretical_bounds(data, valid_mgmts)
+    theoretical_mins, theoretical_maxes = bounds
+    return CompiledProblem(variables, num_periods, theoretical_mins, theoretical_maxes)
+
+
+class _State(object):
+    """
+    Aggregates for one configuration, in compiled variable order,
+    with views onto each strategy family's columns
+    """
+
+    def __init__(self, problem):
+        P = problem.num_periods
+        sl = problem.slices
+        pen = sl['penalty']
+        self.totals = np.zeros((P, problem.num_variables))
+        self.sums = np.zeros(problem.num_variables)
+        # per-period violation of the bounds / targets
+        self.violations = np.zeros((P, pen.stop - pen.start))
+        self.terms = np.zeros(problem.num_terms)
+        self.metric = 0.0
+
+        self.sums_linear = self.sums[sl['linear']]
+        self.terms_linear = self.terms[sl['linear']]
+        self.totals_evenflow = self.totals[:, sl['evenflow']]
+        self.sums_evenflow = self.sums[sl['evenflow']]
+        self.terms_evenflow = self.terms[sl['evenflow']]
+        self.totals_penalty = self.totals[:, pen]
+        self.terms_penalty = self.terms[pen]
+
+
+class IncrementalObjective(object):
+    """
+    Keeps running aggregates of the objective function so that a single
+    stand's change in mgmt can be scored in O(periods).
+
+    For each variable we hold the property-level totals over time, the
+    running sum and the per-period violations of any bounds or targets.
+    ``evaluate`` scores the current state plus a diff into a scratch
+    state and ``commit`` adopts it. Each strategy family is scored with
+    one vectorized expression over all of its variables.
+    """
+
+    def __init__(self, problem, vars_over_time):
+        self.problem = problem
+        P = problem.num_periods
+        sl = problem.slices
+        num_evenflow = sl['evenflow'].stop - sl['evenflow'].start
+        num_penalties = sl['penalty'].stop - sl['penalty'].start
+
+        self._has_evenflow = num_evenflow > 0
+        self._has_penalty = num_penalties > 0
+        self._scales_linear = problem.scales[sl['linear']]
+        self._offsets_linear = problem.offsets[sl['linear']]
+        self._scales_evenflow = problem.scales[sl['evenflow']]
+        self._scales_penalty = problem.scales[sl['penalty']]
+
+        # scratch buffers so evaluate() does not allocate
+        self._diff = np.zeros((P, problem.num_variables))
+        self._dsums = np.zeros(problem.num_variables)
+        self._mean = np.zeros(num_evenflow)
+        self._deviation = np.zeros((P, num_evenflow))
+        self._pieces = np.zeros((3, P, num_penalties))
+
+        self.state = _State(problem)
+        self._candidate = _State(problem)
+        self.reset(vars_over_time)
+
+    def reset(self, vars_over_time):
+        """ Recompute every running aggregate from the totals """
+        state = self.state
+        state.totals[:] = self.problem.to_compiled(np.asarray(vars_over_time, dtype=np.float64))
+        state.totals.sum(axis=0, out=state.sums)
+        return self._score(state)
+
+    def get_state(self):
+        """ The running aggregates, which set_state restores exactly """
+        return {'totals': self.state.totals.copy(), 'sums': self.state.sums.copy()}
+
+    def set_state(self, state):
+        """ Adopt aggregates from get_state, rather than recomputing the sums as reset does """
+        self.state.totals[:] = state['totals']
+        self.state.sums[:] = state['sums']
+        return self._score(self.state)
+
+    @property
+    def metric(self):
+        return self.state.metric
+
+    @property
+    def totals(self):
+        """ Property-level totals (time periods x variables) """
+        return self.problem.from_compiled(self.state.totals)
+
+    @property
+    def components(self):
+        """ Weighted contribution of each variable to the metric """
+        components = np.zeros(self.problem.num_variables)
+        components[self.problem.order[:self.problem.num_terms]] = self.state.terms
+        return components
+
+    @property
+    def candidate_terms(self):
+        """
+        Terms, in compiled order, of the state scored by the last evaluate.
+        The array is the one commit adopts, so it keeps these values after
+        a commit until the next evaluate.
+        """
+        return self._candidate.terms
+
+    def _score(self, state):
+        # cumulative: scale * sum + offset
+        np.multiply(state.sums_linear, self._scales_linear, out=state.terms_linear)
+        state.terms_linear += self._offsets_linear
+
+        if self._has_evenflow:
+            # property-level variance of each variable over time
+            mean = self._mean
+            deviation = self._deviation
+            np.multiply(state.sums_evenflow, 1.0 / self.problem.num_periods, out=mean)
+            np.subtract(state.totals_evenflow, mean, out=deviation)
+            np.multiply(deviation, deviation, out=deviation)
+            deviation.sum(axis=0, out=state.terms_evenflow)
+            state.terms_evenflow *= self._scales_evenflow
+
+        if self._has_penalty:
+            pieces = self._pieces
+            np.multiply(state.totals_penalty, self.problem.penalty_slopes, out=pieces)
+            pieces += self.problem.penalty_intercepts
+            pieces.max(axis=0, out=state.violations)
+            state.violations.sum(axis=0, out=state.terms_penalty)
+            state.terms_penalty *= self._scales_penalty
+
+        state.metric = state.terms.sum()
+        return state.metric
+
+    def evaluate(self, diff):
+        """
+        Score the current state with a single stand's diff
+        (time periods x variables) applied, without committing it
+        """
+        d = self._diff
+        if d.dtype != diff.dtype:
+            # np.take needs an output buffer of the same dtype
+            self._diff = d = np.zeros(d.shape, dtype=diff.dtype)
+        np.take(diff, self.problem.order, axis=1, out=d, mode='clip')
+
+        candidate = self._candidate
+        np.add(self.state.totals, d, out=candidate.totals)
+        d.sum(axis=0, out=self._dsums)
+        np.add(self.state.sums, self._dsums, out=candidate.sums)
+        return self._score(candidate)
+
+    def evaluate_batch(self, diffs):
+        """
+        Score the current state with each of k alternative diffs
+        (k x time periods x variables) applied, in one broadcast.
+        Returns a 1D array of k metrics; nothing is committed.
+        """
+        problem = self.problem
+        sl = problem.slices
+        k = diffs.shape[0]
+
+        d = np.take(diffs, problem.order, axis=2)
+        totals = d + self.state.totals
+        sums = d.sum(axis=1, dtype=np.float64)
+        sums += self.state.sums
+        terms = np.empty((k, problem.num_terms))
+
+        lin = sl['linear']
+        np.multiply(sums[:, lin], self._scales_linear, out=terms[:, lin])
+        terms[:, lin] += self._offsets_linear
+
+        if self._has_evenflow:
+            ef = sl['evenflow']
+            mean = sums[:, np.newaxis, ef] / problem.num_periods
+            deviation = totals[:, :, ef] - mean
+            deviation *= deviation
+            deviation.sum(axis=1, out=terms[:, ef])
+            terms[:, ef] *= self._scales_evenflow
+
+        if self._has_penalty:
+            pen = sl['penalty']
+            pieces = totals[np.newaxis, :, :, pen] * problem.penalty_slopes[:, np.newaxis]
+            pieces += problem.penalty_intercepts[:, np.newaxis]
+            violations = pieces.max(axis=0)
+            violations.sum(axis=1, out=terms[:, pen])
+            terms[:, pen] *= self._scales_penalty
+
+        return terms.sum(axis=1)
+
+    def commit(self):
+        """ Adopt the most recently evaluated state """
+        self.state, self._candidate = self._candidate, self.state
@@ -0,0 +1,105 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import numpy as np
+from .utils import pack_valid_mgmts, stand_mgmts, PackedValidMgmts
+
+# draws taken from the generator at a time
+BLOCK_SIZE = 4096
+
+
+class ProposalSampler(object):
+    """
+    Proposes moves for an AnnealingChain from pre-drawn blocks of random numbers.
+
+    Stands with fewer than two valid mgmts can never change and are excluded
+    up front, so every proposal is an actual change. Stands, mgmt offsets and
+    acceptance uniforms are drawn BLOCK_SIZE at a time from a RandomState,
+    seeded for reproducible runs; give each parallel chain its own seed for
+    independent streams.
+    """
+
+    def __init__(self, valid_mgmts, num_mgmts, seed=None, block_size=BLOCK_SIZE):
+        if isinstance(valid_mgmts, PackedValidMgmts):
+            indptr, indices = valid_mgmts.indptr, valid_mgmts.indices
+        else:
+            indptr, indices = pack_valid_mgmts(valid_mgmts)
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.valid_mgmts = PackedValidMgmts(self.indptr, self.indices)
+        self.num_mgmts = num_mgmts
+
+        # an empty row means any mgmt is valid
+        counts = np.diff(self.indptr)
+        self.counts = np.where(counts == 0, num_mgmts, counts)
+        self.movable = np.nonzero(self.counts >= 2)[0]
+        if len(self.movable) == 0:
+            raise ValueError("No stand has more than one valid mgmt")
+
+        self.rng = np.random.RandomState(seed)
+        self.block_size = block_size
+        self._pos = block_size
+        self._block_state = None
+
+    def _refill(self):
+        rng = self.rng
+        # for get_state, a block is cheaper to draw again than to save
+        self._block_state = rng.get_state()
+        size = self.block_size
+        self._stands = self.movable[rng.randint(0, len(self.movable), size)].tolist()
+        self._uniforms = rng.random_sample((3, size)).tolist()
+        self._pos = 0
+
+    def draw(self):
+        """ A movable stand and three uniform [0, 1) numbers for the next step """
+        if self._pos == self.block_size:
+            self._refill()
+        i = self._pos
+        self._pos += 1
+        u = self._uniforms
+        return self._stands[i], u[0][i], u[1][i], u[2][i]
+
+    def candidates(self, stand):
+        """ The valid mgmts of a stand, as a list """
+        return stand_mgmts(self.valid_mgmts, stand, self.num_mgmts)
+
+    def other_mgmt(self, stand, current, u):
+        """
+        Map the uniform u to one of the stand's valid mgmts, other than current,
+        with equal probability
+        """
+        start, stop = self.indptr[stand], self.indptr[stand + 1]
+        if start == stop:
+            mgmt = int(u * (self.num_mgmts - 1))
+            return mgmt + 1 if mgmt >= current else mgmt
+        mgmt = int(self.indices[start + int(u * (stop - start - 1))])
+        if mgmt == current:
+            # the last candidate takes the place of the current mgmt
+            mgmt = int(self.indices[stop - 1])
+        return mgmt
+
+    def get_state(self):
+        """
+        The generator's state when the current block was drawn and the
+        position in it, from which set_state draws the same block again
+        """
+        if self._pos < self.block_size:
+            rng_state = self._block_state
+        else:
+            # the block is used up, the next one is drawn from the current state
+            rng_state = self.rng.get_state()
+        name, keys, pos, has_gauss, cached_gaussian = rng_state
+        return {
+            'keys': keys,
+            'position': np.array([pos, has_gauss, self._pos, self.block_size]),
+            'gaussian': np.float64(cached_gaussian),
+        }
+
+    def set_state(self, state):
+        """ Continue exactly where the sampler that gave state left off """
+        pos, has_gauss, block_pos, block_size = state['position'].tolist()
+        if block_size != self.block_size:
+            raise ValueError("Sampler state has block size %d, not %d" % (block_size, self.block_size))
+        self.rng.set_state(('MT19937', state['keys'], pos, has_gauss, float(state['gaussian'])))
+        if block_pos < block_size:
+            self._refill()
+        self._pos = block_pos
@@ -1,9 +1,49 @@
 # encoding: utf-8
 from __future__ import absolute_import
-import random
 import numpy as np
 import math
-import json
+import itertools
+from timeit import default_timer
+from ._objective import IncrementalObjective, compile_problem
+from ._chain import AnnealingChain, ACCEPT, IMPROVE, NEW_BEST, _prefixed, _substate
+from .shared import resolve_stand_data, stand_data_bounds
+from .adjacency import clump_penalty
+from .trace import TraceRecorder
+from .progress import ProgressPublisher, RedisSink, PlotSink
+from .observers import PrintObserver, PHASES, notify
+from .cooling import (cooling_config, calibrate_temperature, AdaptiveCooling,
+                      CALIBRATION_MOVES)
+from .stopping import stopping_config, StoppingCriteria
+from .checkpoint import Checkpointer, load_checkpoint, run_fingerprint
+from .warmstart import WARM_STARTS, greedy_mgmts, polish_mgmts
+from .utils import stand_mgmts
+
+# one step in this many is timed phase by phase for the observers
+TIMING_INTERVAL = 16
+
+
+def initial_mgmts(num_mgmts, valid_mgmts, starting_mgmts=None, rng=np.random):
+    """
+    Starting mgmt for each stand, random unless starting_mgmts are given.
+    rng is a numpy RandomState, or the numpy.random module
+    """
+    if starting_mgmts:
+        mgmts = list(starting_mgmts)
+    else:
+        mgmts = rng.randint(0, num_mgmts, len(valid_mgmts)).tolist()
+
+    # a stand limited to some mgmts starts with one of them: a random one,
+    # or the first if the given starting mgmt is not valid
+    for s, mgmt in enumerate(mgmts):
+        valid = stand_mgmts(valid_mgmts, s, num_mgmts)
+        if mgmt not in valid:
+            mgmts[s] = valid[0] if starting_mgmts else valid[rng.randint(len(valid))]
+    return mgmts
+
+
+def _estimate_timings(timings):
+    """ Seconds spent in each phase, from the timed sample of steps """
+    return dict((phase, seconds * TIMING_INTERVAL) for phase, seconds in zip(PHASES, timings))
 
 
 def schedule(
@@ -17,11 +57,75 @@ def schedule(
         logfile=None,
         adjacency=False,
         starting_mgmts=None,
-        live_plot=False):
-
-    if live_plot:
-        import redis
-        rc = redis.Redis()
+        live_plot=False,
+        move_mode='single',
+        seed=None,
+        trace=None,
+        progress=None,
+        observers=None,
+        cooling=None,
+        stopping=None,
+        checkpoint=None,
+        resume=None,
+        warm_start=None,
+        polish=0):
+    """
+    Simulated annealing over the mgmt of each stand.
+
+    data may also be a SharedStandData handle (see harvestscheduler.shared)
+    or a StandDataFile (see harvestscheduler.store), in which case
+    valid_mgmts may be None to use the shared or stored ones. Pass a
+    QuantizedStandData (see harvestscheduler.compact) to anneal over a
+    compact int16/int32/float32 copy of the data, or a RaggedStandData
+    (valid_mgmts may be None) to store only the valid mgmts of each stand.
+
+    move_mode controls how each step proposes a move, see AnnealingChain.
+
+    adjacency, if given, is a dict configuring the maximum harvest clump
+    size constraint, see harvestscheduler.adjacency.
+
+    seed makes the run reproducible; it seeds the random starting mgmts
+    and every random number drawn while annealing.
+
+    trace, a path or a TraceRecorder (see harvestscheduler.trace), records
+    every step to a binary .npy file. It costs far less than logfile, which
+    writes a line of text per step.
+
+    progress is a list of sinks (see harvestscheduler.progress) that the
+    steps are published to, a report interval at a time, from a background
+    thread. live_plot adds a RedisSink and a PlotSink.
+
+    temp_max and temp_min default to multiples of the summed weights. Set
+    either to 'auto' to calibrate it from a sample of random moves, and pass
+    cooling to adapt the temperature to the acceptance of uphill moves
+    instead of lowering it exponentially, see harvestscheduler.cooling.
+
+    stopping ends the run before steps when the best stops improving, the
+    acceptance rate stays low, or a wall-clock or CPU time budget runs out;
+    steps may then be None. See harvestscheduler.stopping.
+
+    checkpoint, a path or a Checkpointer, periodically saves the state of
+    the run so that schedule(..., resume=path) with the same arguments
+    continues it exactly, see harvestscheduler.checkpoint.
+
+    The run starts from starting_mgmts if given, random mgmts by default,
+    or with warm_start='greedy' from mgmts assigned greedily, stand by
+    stand, on the objective. polish is a number of local descent passes
+    over the stands made from that start. See harvestscheduler.warmstart.
+
+    observers are notified of the run's progress with structured stats,
+    see harvestscheduler.observers. The default prints a report every
+    report_interval steps; pass [] to run quietly.
+    """
+    bounds = stand_data_bounds(data)
+    data, valid_mgmts = resolve_stand_data(data, valid_mgmts)
+
+    if warm_start not in WARM_STARTS:
+        raise ValueError("Unknown warm_start `%s`" % warm_start)
+    if warm_start == 'greedy' and starting_mgmts:
+        raise ValueError("warm_start='greedy' replaces starting_mgmts, pass one or the other")
+    cooling_options = cooling_config(cooling)
+    stopper = StoppingCriteria(steps, stopping_config(stopping))
 
     if temp_min is None:
         temp_min=sum([x['weight'] for x in axis_map['variables']])/1000.0
@@ -36,246 +140,190 @@ def schedule(
     strategies = [x['strategy'] for x in axis_map['variables']]
     weights = [x['weight'] for x in axis_map['variables']]
     variable_names = [x['name'] for x in axis_map['variables']]
-    strategy_variables = [x.get("targets", None) for x in axis_map['variables']]
 
     assert len(strategies) == num_variables
     assert len(weights) == num_variables
     assert len(variable_names) == num_variables
     assert len(valid_mgmts) == num_stands
 
-    # initial mgmt
-    if starting_mgmts:
-        mgmts = starting_mgmts[:]
+    # the graph itself is left out, it has no stable representation
+    adjacency_options = dict((k, v) for k, v in (adjacency or {}).items() if k != 'graph')
+    fingerprint = run_fingerprint(data.shape, axis_map['variables'], steps, report_interval,
+                                  move_mode, adjacency_options, seed, cooling)
+    saved = None
+    if resume is not None:
+        saved = load_checkpoint(resume)
+        if saved['run.fingerprint'] != fingerprint:
+            raise ValueError("%s is a checkpoint of a run with different arguments" % resume)
+
+    # group the variables by strategy once, before annealing
+    problem = compile_problem(data, axis_map, bounds, valid_mgmts)
+
+    rng = np.random.RandomState(seed)
+    if saved is not None:
+        mgmts = saved['mgmts'].tolist()
+    elif warm_start == 'greedy':
+        mgmts = greedy_mgmts(data, valid_mgmts, problem)
     else:
-        mgmts = [random.randrange(num_mgmts) for x in range(num_stands)]
-
-    # make sure each stand's mgmt starts with a valid mgmt
-    for s, mgmt in enumerate(mgmts):
-        if valid_mgmts[s]:
-            mgmts[s] = valid_mgmts[s][0]
+        mgmts = initial_mgmts(num_mgmts, valid_mgmts, starting_mgmts, rng)
 
     # use numpy indexing to select only the desired mgmt of each stand and collapse accross stands
     vars_over_time = data[stand_range, mgmts].sum(axis=0)
-    prev_vars_over_time = vars_over_time.copy()
-
-    best_metric = float('inf')
-    best_mgmts = mgmts[:]
-    best_metrics = []
-
-    prev_metric = float('inf')
-    prev_mgmts = mgmts[:]
 
     accepts = 0
     improves = 0
     last_reported_step = 0
-    temp_factor = -math.log(temp_max / temp_min)
-
-    theoretical_maxes = [0 for x in range(num_variables)]
-    theoretical_mins = [0 for x in range(num_variables)]
-    for s, strategy in enumerate(strategies):
-        # select the variable, sum to across time periods, take the max for each stand and add them
-        theoretical_maxes[s] = data[:, :, :, s].sum(axis=2).max(axis=1).sum()
-        theoretical_mins[s] = data[:, :, :, s].sum(axis=2).min(axis=1).sum()
-        print variable_names[s], theoretical_mins[s], "to", theoretical_maxes[s]
-    print
-
-    enum_strategies = list(enumerate(strategies))
-
-    # property-level targets over time for evenflow_target variables
-    targets = []
-    uppers = [] 
-    lowers = []
-    for s, strategy in enum_strategies:
-        if strategy == 'evenflow_target':
-            target_per_period = strategy_variables[s]
-            try:
-                assert len(target_per_period) == num_periods
-                # it's a list
-                targets.append(np.array(target_per_period))
-            except TypeError:
-                # it's a scalar
-                targets.append(np.array([target_per_period] * num_periods))
-
-        if strategy == 'within_bounds':
-            lower, upper = strategy_variables[s]
-            try:
-                assert len(upper) == len(lower) == num_periods
-                # it's a list
-                uppers.append(np.array(upper))
-                lowers.append(np.array(lower))
-            except (TypeError, AssertionError):
-                # it's a scalar?
-                uppers.append(np.array([upper] * num_periods))
-                lowers.append(np.array([lower] * num_periods))
 
-        else:
-            uppers.append(None)
-            lowers.append(None)
-            targets.append(None)
+    if observers is None:
+        observers = [PrintObserver()]
+
+    objective = IncrementalObjective(problem, vars_over_time)
+    penalty = clump_penalty(data, axis_map, adjacency)
+    chain = AnnealingChain(data, valid_mgmts, objective, mgmts, move_mode, penalty,
+                           seed=rng.randint(2 ** 31))
+    if polish and saved is None:
+        polish_mgmts(data, valid_mgmts, objective, chain.mgmts, penalty, polish)
+        chain.sync()
+
+    calibrated = 'auto' in (temp_min, temp_max)
+    start_step = 0
+    if saved is not None:
+        chain.set_state(saved)
+        temp_min, temp_max = saved['run.temps'].tolist()
+        start_step = int(saved['run.step'])
+    elif calibrated:
+        # from the uphill moves around the starting configuration
+        deltas = chain.sample_deltas(CALIBRATION_MOVES)
+        default_temp = sum([x['weight'] for x in axis_map['variables']])
+        if temp_max == 'auto':
+            temp_max = (calibrate_temperature(deltas, cooling_options['start_acceptance']) or
+                        default_temp * 10)
+        if temp_min == 'auto':
+            temp_min = (calibrate_temperature(deltas, cooling_options['end_acceptance']) or
+                        default_temp / 1000.0)
+    temp_factor = -math.log(temp_max / temp_min)
+    adaptive = None
+    if cooling is not None:
+        adaptive = AdaptiveCooling(temp_min, temp_max, cooling_options)
+    if saved is not None:
+        stopper.set_state(_substate(saved, 'stopping'))
+        if adaptive is not None:
+            adaptive.set_state(_substate(saved, 'cooling'))
+
+    notify(observers, 'on_start', {
+        'variables': variable_names,
+        'theoretical_mins': problem.theoretical_mins.tolist(),
+        'theoretical_maxes': problem.theoretical_maxes.tolist(),
+        'temp_min': temp_min,
+        'temp_max': temp_max,
+        'calibrated': calibrated,
+        'resumed_at': start_step if saved is not None else None,
+        'start_metric': chain.metric,
+    })
 
     fh = None
     if logfile:
-        fh = open(logfile, 'w')
-
+        if saved is None:
+            fh = open(logfile, 'w')
+        else:
+            # drop whatever was logged after the checkpoint
+            fh = open(logfile, 'r+')
+            fh.truncate(int(saved['run.log_offset']))
+            fh.seek(0, 2)
+
+    recorder = None
+    if trace is not None:
+        recorder = trace if isinstance(trace, TraceRecorder) else TraceRecorder(trace)
+        recorder.open(problem, int(saved['run.trace_length']) if saved is not None else 0)
+
+    checkpointer = None
+    if checkpoint is not None:
+        checkpointer = checkpoint if isinstance(checkpoint, Checkpointer) else Checkpointer(checkpoint)
+        if checkpointer.every is not None and checkpointer.every % report_interval:
+            raise ValueError("Checkpoints can only be every multiple of report_interval steps")
+
+    sinks = list(progress or [])
     if live_plot:
-        from harvestscheduler.plot import AnalogPlot
-        analog_plot = AnalogPlot(steps)
-        plot_cache = []
-
-    select_sum_time = 0
-    fsteps = float(steps)
-
-    for step in range(steps):
-
-        # determine temperature
-        temp = temp_max * math.exp(temp_factor * step / fsteps)
-
-        actual_change = False
-        while not actual_change:
-            new_stand = random.randrange(num_stands)
-            old_mgmt = mgmts[new_stand]
-
-            if valid_mgmts[new_stand]:
-                # new stand has restricted mgmts, pick from the select list
-                new_mgmt = random.choice(valid_mgmts[new_stand])
-            else:
-                # pick anything
-                new_mgmt = random.randrange(num_mgmts)
-
-            if old_mgmt != new_mgmt:
-                actual_change = True
-
-        mgmts[new_stand] = new_mgmt
-
-        # determine if adjacent stands constitue clumps of harvesting that
-        # might exceed regulatory limits
-        adjacency_penalty = 0
-        # TODO 
-        # adj_stands = adjacency[new_stand]
-        # harvest = selected[:, :, 1]
-        # harvest_clump = harvest[([new_stand] + adj_stands)].sum(axis=0)
-        # # TODO - don't hardcode
-        # MAX_HARVEST_CLUMP = 75
-        # if harvest_clump.max() > MAX_HARVEST_CLUMP:
-        #     adjacency_penalty = 1000
-
-        # Calculate the diff to vars_over_time due to the change in mgmt
-        olddata = data[new_stand, old_mgmt]
-        newdata = data[new_stand, new_mgmt]
-        diff = newdata - olddata
-
-        # 2D array
-        # time periods x sum of each variable over all stands
-        # apply diff 
-        vars_over_time += diff
-
-        # 1D array
-        # useful for cumulative maximize/target
-        # property-level cumulative sum of each variable
-        property_cumulative = vars_over_time.sum(axis=0)
-
-        objective_metrics = []
-
-        for s, strategy in enum_strategies:
-            # note that all cumulative metrics return some value that is effectively scaled 0-100
-
-            if theoretical_mins[s] == theoretical_maxes[s]:
-                #if there's no variation, don't even bother
-                objective_metrics.append(0)
-
-            elif strategy == 'cumulative_maximize':
-                # compare the value to the theoretical maximum
-                maxval = theoretical_maxes[s]
-                minval = theoretical_mins[s]
-                cumval = property_cumulative[s]
-                objective_metrics.append(100*((maxval - cumval) / float(maxval - minval)) * weights[s])
-
-            elif strategy == 'evenflow':
-                values = vars_over_time[:, s]
-                # property-level variance of THIS variable over time
-                property_variance = values.var(axis=0)
-
-                maxval = theoretical_maxes[s]
-                minval = theoretical_mins[s]
-                range_by_period = (maxval - minval) / float(num_periods)
-
-                # TODO make evenflow return a number scaled 0-100
-                objective_metrics.append(property_variance / range_by_period * weights[s] * 100)
-
-            elif strategy == 'within_bounds':
-                values = vars_over_time[:, s]
-                periods = values.shape[0]
-                maxval = theoretical_maxes[s]
-                minval = theoretical_mins[s]
-                refval = ((maxval-minval)/periods)
-
-                below = lowers[s] - values
-                below = below[below > 0] # positive values are below the min
-
-                above = values - uppers[s]
-                above = above[above > 0] # positive values are above the max
-
-                outofbounds = below.sum() + above.sum()
-                objective_metrics.append((outofbounds / refval) * 100 * weights[s])
-                
-            elif strategy == 'evenflow_target':
-                values = vars_over_time[:, s]
-
-                maxval = theoretical_maxes[s]
-                minval = theoretical_mins[s]
-                range_by_period = (maxval - minval) / float(num_periods)
-
-                diffs = values - targets[s]
-                # absolute val but 10x penalty for going *below* target
-                diffs[diffs < 0] *= -10
-                # diffs = np.absolute(values - targets[s])
-
-                scaled_sum_diffs = 100 * ((diffs / (range_by_period/2.0))).mean()
-                objective_metrics.append(scaled_sum_diffs * weights[s])
-
-            elif strategy == 'cumulative_minimize':
-                # compare the value to the theoretical minimum
-                maxval = theoretical_maxes[s]
-                minval = theoretical_mins[s]
-                cumval = property_cumulative[s]
-                objective_metrics.append(100*((cumval - minval) / float(maxval - minval)) * weights[s])
-
-            else:
-                raise Exception("Unknown optimization strategy `%s`" % strategy)
-
-        objective_metric = sum(objective_metrics) + adjacency_penalty
-
-        accept = False
-        improve = False
-        new_best = False
-
-        delta = objective_metric - prev_metric
-
-        rand = np.random.uniform()
-        k = 1
-        if delta < 0.0:  # an improvement
-            accept = True
-            improve = True
-        elif math.exp(-(k*delta)/temp) > rand:  # within temperature, accept it
-            accept = True
-            improve = False
+        sinks += [RedisSink(), PlotSink(steps or report_interval * 100)]
+    publisher = None
+    if sinks:
+        publisher = ProgressPublisher(sinks, batch_size=report_interval)
+
+    fsteps = float(steps or 1)
+    timings = [0.0] * len(PHASES)
+    total_timings = [0.0] * len(PHASES)
+    started = last_reported_time = default_timer()
+    last_reported_count = start_step
+    stopped = None
+    checkpoint_due = False
+    if saved is not None:
+        accepts, improves, last_reported_step = saved['run.counts'].tolist()
+
+    for step in itertools.count(start_step):
+
+        # determine temperature, over the steps or the time budget
+        if stopper.budgeted:
+            fraction_done = min(stopper.progress, 1.0)
+        else:
+            fraction_done = step / fsteps
+        if adaptive is None:
+            temp = temp_max * math.exp(temp_factor * fraction_done)
+        else:
+            temp = adaptive.temp
+
+        if step % TIMING_INTERVAL:
+            outcome = chain.step(temp)
+        else:
+            outcome = chain.step(temp, timings)
+        accept = outcome >= ACCEPT
+        improve = outcome >= IMPROVE
+        new_best = outcome == NEW_BEST
+        objective_metric = chain.proposed_metric
+        best_metric = chain.best_metric
+        if adaptive is not None:
+            adaptive.observe(outcome, new_best, fraction_done)
+
+        if recorder is not None:
+            recorder.record(step, objective_metric, best_metric, chain.proposed_terms,
+                            outcome, temp)
+        if publisher is not None:
+            publisher.record(step, objective_metric, outcome, best_metric)
+        if new_best:
+            notify(observers, 'on_new_best', {'step': step, 'best_metric': best_metric,
+                                              'temp': temp})
 
         if (step+1) % report_interval == 0 and step > 0:
             reported_steps = float(step - last_reported_step)
-            print "step: %-7d  accepted %0.2f %%   improved %0.2f %%   best_metric:   %-6.2f    temp: %-1.4f" % (
-                step+1, 100*accepts/reported_steps, 100*improves/reported_steps, best_metric, temp)
-            print "  weighted best: ", ",  ".join(["%s: %.2f" % x
-                                                   for x in zip(variable_names, best_metrics)])
-            print "unweighted best: ", ",  ".join(["%s: %.2f" % x
-                                                   for x in zip(variable_names,
-                                                                [a / b for a, b in zip(best_metrics, weights)])])
-            print 
-            if live_plot:
-                rc.publish("test_channel", 
-                    json.dumps({'plot_cache': plot_cache})
-                )
-                analog_plot.append(plot_cache)
-                plot_cache = []
+            now = default_timer()
+            interval = max(now - last_reported_time, 1e-9)
+            # end of a temperature plateau, bring best_mgmts up to date
+            chain.flush_best()
+            notify(observers, 'on_temperature_step', {'step': step + 1, 'temp': temp})
+            notify(observers, 'on_report', {
+                'step': step + 1,
+                'steps': steps,
+                'temp': temp,
+                'elapsed': now - started,
+                'steps_per_sec': (step + 1 - last_reported_count) / interval,
+                'acceptance_rate': accepts / reported_steps,
+                'improvement_rate': improves / reported_steps,
+                'best_metric': best_metric,
+                'variables': variable_names,
+                'weighted': list(chain.best_metrics),
+                'unweighted': [a / b for a, b in zip(chain.best_metrics, weights)],
+                'adjacency_penalty': (best_metric - sum(chain.best_metrics)) if adjacency else None,
+                'timings': _estimate_timings(timings),
+            })
+            total_timings = [a + b for a, b in zip(total_timings, timings)]
+            timings = [0.0] * len(PHASES)
+            last_reported_time = now
+            last_reported_count = step + 1
+
+            if publisher is not None:
+                publisher.flush()
+                publisher.drain()
+            stopped = stopper.report(accepts / reported_steps)
+            checkpoint_due = checkpointer is not None and checkpointer.due(step + 1)
             improves = 0
             accepts = 0
             last_reported_step = step
@@ -284,33 +332,7 @@ def schedule(
             improves += 1
 
         if accept:
-            prev_mgmts = mgmts[:]  # record new mgmts
-            prev_vars_over_time = vars_over_time.copy()
-            prev_metric = objective_metric
             accepts += 1
-        else:
-            mgmts = prev_mgmts[:]  # restore previous mgmts
-            vars_over_time = prev_vars_over_time.copy()
-
-        if objective_metric < best_metric:
-            best_mgmts = mgmts[:]
-            best_metric = objective_metric
-            best_metrics = objective_metrics
-            best_vars_over_time = vars_over_time[:]
-            new_best = True
-
-        if live_plot:
-            if not accept:
-                stype = "reject"
-            elif accept and not improve:
-                stype = "accept"
-            elif accept and improve and not new_best:
-                stype = "acceptimprove"
-            elif new_best:
-                stype = "newbest"  
-            
-            plot_cache.append((objective_metric, step, stype, best_metric))
-            
 
         if logfile and fh:
             if not accept:
@@ -325,9 +347,47 @@ def schedule(
             fh.write(','.join(str(x) for x in [step, objective_metric, stype, temp]))
             fh.write("\n")
 
-    print "Select sum time: ", select_sum_time
+        stopped = stopper.step(step, best_metric) or stopped
+        if stopped:
+            break
+
+        if checkpoint_due:
+            # at the end of a report interval, when best_mgmts is up to date
+            state = chain.get_state()
+            state.update(_prefixed('stopping', stopper.get_state()))
+            if adaptive is not None:
+                state.update(_prefixed('cooling', adaptive.get_state()))
+            if recorder is not None:
+                recorder.flush()
+            if fh:
+                fh.flush()
+            state.update({
+                'run.fingerprint': fingerprint,
+                'run.step': np.int64(step + 1),
+                'run.temps': np.array([temp_min, temp_max]),
+                'run.counts': np.array([accepts, improves, last_reported_step], dtype=np.int64),
+                'run.trace_length': np.int64(recorder.length if recorder is not None else 0),
+                'run.log_offset': np.int64(fh.tell() if fh else 0),
+            })
+            checkpointer.save(state)
+            checkpoint_due = False
+
+    best_mgmts = chain.flush_best()
+    elapsed = default_timer() - started
+    total_timings = [a + b for a, b in zip(total_timings, timings)]
+    notify(observers, 'on_finish', {
+        'steps': step + 1,
+        'stopped': stopped,
+        'elapsed': elapsed,
+        'steps_per_sec': (step + 1 - start_step) / max(elapsed, 1e-9),
+        'best_metric': chain.best_metric,
+        'timings': _estimate_timings(total_timings),
+    })
 
     if fh:
         fh.close()
-    return best_metric, best_mgmts, best_vars_over_time
-
+    if recorder is not None:
+        recorder.close()
+    if publisher is not None:
+        publisher.close()
+    return chain.best_metric, best_mgmts, chain.best_vars_over_time
@@ -0,0 +1,293 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import random
+import traceback
+import multiprocessing
+import numpy as np
+import math
+from ._objective import IncrementalObjective, compile_problem
+from ._chain import AnnealingChain
+from ._scheduler import initial_mgmts
+from .shared import is_stand_data_handle, resolve_stand_data, stand_data_bounds
+from .adjacency import clump_penalty
+from .observers import PrintObserver, notify
+from .utils import pack_valid_mgmts, PackedValidMgmts
+
+# set in each worker process by _init_worker so the stand data
+# is never pickled along with the tasks
+_worker = {}
+
+
+def _init_worker(data, valid_mgmts, problem, move_mode, axis_map=None, adjacency=None):
+    data, valid_mgmts = resolve_stand_data(data, valid_mgmts)
+    _worker['data'] = data
+    _worker['valid_mgmts'] = valid_mgmts
+    _worker['problem'] = problem
+    _worker['move_mode'] = move_mode
+    _worker['axis_map'] = axis_map
+    _worker['adjacency'] = adjacency
+    # the chains of the replicas run by this worker, kept across rounds
+    _worker['chains'] = {}
+
+
+def _run_replica(args):
+    """
+    Advance one replica by a number of steps at a fixed temperature.
+
+    The replica's chain lives in the worker from one round to the next.
+    Only a replica whose configuration was swapped is sent its new mgmts and
+    totals, which it adopts with set_configuration; the chain is only built
+    the first time. The best configuration is sent back only if it beats
+    best_to_beat.
+    """
+    replica, configuration, temp, steps, seed, best_to_beat = args
+    chain = _worker['chains'].get(replica)
+    if chain is None:
+        mgmts, vars_over_time = configuration
+        data = _worker['data']
+        objective = IncrementalObjective(_worker['problem'], vars_over_time)
+        chain = AnnealingChain(data, _worker['valid_mgmts'], objective, mgmts.tolist(),
+                               _worker['move_mode'],
+                               clump_penalty(data, _worker['axis_map'], _worker['adjacency']),
+                               seed)
+        _worker['chains'][replica] = chain
+    elif configuration is not None:
+        mgmts, vars_over_time = configuration
+        chain.set_configuration(mgmts.tolist(), vars_over_time)
+    else:
+        # the round's best starts from the current configuration, which
+        # also keeps the undo log from growing across rounds
+        chain.reset_best()
+
+    accepts = 0
+    for step in range(steps):
+        if chain.step(temp):
+            accepts += 1
+
+    result = {
+        'mgmts': np.array(chain.mgmts, dtype=np.int32),
+        'vars_over_time': chain.objective.totals,
+        'metric': chain.metric,
+        'accepts': accepts,
+        'best': None,
+    }
+    if chain.best_metric < best_to_beat:
+        result['best'] = (chain.best_metric, np.array(chain.flush_best(), dtype=np.int32),
+                          chain.best_vars_over_time, chain.best_metrics)
+    return result
+
+
+def _worker_loop(conn, initargs):
+    """ Run the tasks sent down conn in this process until it sends None """
+    _init_worker(*initargs)
+    while True:
+        tasks = conn.recv()
+        if tasks is None:
+            break
+        try:
+            conn.send(('ok', [_run_replica(task) for task in tasks]))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class _ReplicaWorkers(object):
+    """
+    Worker processes that each run a fixed subset of the replicas, so a
+    replica's chain stays in one process for the whole run. A Pool would
+    hand each round's tasks to whichever worker is free.
+    """
+
+    def __init__(self, processes, initargs):
+        self.connections = []
+        self.processes = []
+        for i in range(processes):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker_loop, args=(child, initargs))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def map(self, tasks):
+        """ Run the tasks, replica r on worker r % processes, in order """
+        n = len(self.connections)
+        for i, conn in enumerate(self.connections):
+            conn.send(tasks[i::n])
+        results = [None] * len(tasks)
+        for i, conn in enumerate(self.connections):
+            status, value = conn.recv()
+            if status != 'ok':
+                raise RuntimeError("Replica worker failed:\n" + value)
+            results[i::n] = value
+        return results
+
+    def close(self):
+        for conn in self.connections:
+            conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+
+
+def temperature_ladder(temp_min, temp_max, replicas):
+    """ Geometrically spaced temperatures from temp_min to temp_max """
+    if replicas == 1:
+        return [float(temp_min)]
+    ratio = float(temp_max) / temp_min
+    return [temp_min * ratio ** (i / float(replicas - 1)) for i in range(replicas)]
+
+
+def parallel_tempering(
+        data,
+        axis_map,
+        valid_mgmts,
+        temp_min=None,
+        temp_max=None,
+        steps=20000,
+        replicas=None,
+        swap_interval=500,
+        processes=None,
+        report_interval=5000,
+        starting_mgmts=None,
+        move_mode='single',
+        seed=None,
+        adjacency=False,
+        observers=None):
+    """
+    Replica exchange (parallel tempering) over the mgmt of each stand.
+
+    Runs one chain per temperature on a geometric ladder from temp_min to
+    temp_max, each for `steps` steps, in a pool of worker processes. Every
+    `swap_interval` steps the configurations at neighboring temperatures
+    are exchanged with probability min(1, exp((1/T_i - 1/T_j)(E_i - E_j))).
+    The stand data is handed to each worker once, when the workers start,
+    and each replica's chain stays in its worker for the whole run; swaps
+    only move mgmt vectors and aggregate totals. Pass a SharedStandData
+    handle or a StandDataFile as data (valid_mgmts may then be None) to have
+    the workers attach to one shared copy instead of inheriting the array,
+    or a QuantizedStandData to hand them a compact one. adjacency is the
+    same maximum harvest clump configuration that schedule() accepts.
+    seed makes the run reproducible; every replica is given its own random
+    stream derived from it.
+
+    observers are sent on_replica_report every report_interval steps, see
+    harvestscheduler.observers. The default prints the report; pass [] to
+    run quietly.
+
+    Returns the same (best_metric, best_mgmts, best_vars_over_time) as schedule()
+    """
+    shared = data if is_stand_data_handle(data) else None
+    bounds = stand_data_bounds(data)
+    data, valid_mgmts = resolve_stand_data(data, valid_mgmts)
+
+    if observers is None:
+        observers = [PrintObserver()]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if replicas is None:
+        replicas = processes
+
+    if temp_min is None:
+        temp_min = sum([x['weight'] for x in axis_map['variables']])/1000.0
+
+    if temp_max is None:
+        temp_max = sum([x['weight'] for x in axis_map['variables']])*10
+
+    num_stands, num_mgmts, num_periods, num_variables = data.shape
+    assert len(valid_mgmts) == num_stands
+    if not isinstance(valid_mgmts, PackedValidMgmts):
+        # packed once here rather than by every chain's sampler
+        valid_mgmts = PackedValidMgmts(*pack_valid_mgmts(valid_mgmts))
+    variable_names = [x['name'] for x in axis_map['variables']]
+
+    rng = random.Random(seed)
+    temps = temperature_ladder(temp_min, temp_max, replicas)
+
+    problem = compile_problem(data, axis_map, bounds, valid_mgmts)
+    stand_range = np.arange(num_stands)
+    penalty = clump_penalty(data, axis_map, adjacency)
+
+    # one configuration per temperature, coldest first
+    states = []
+    for i in range(replicas):
+        mgmts = initial_mgmts(num_mgmts, valid_mgmts, starting_mgmts,
+                              np.random.RandomState(rng.randrange(2 ** 31)))
+        mgmts = np.array(mgmts, dtype=np.int32)
+        vars_over_time = data[stand_range, mgmts].sum(axis=0)
+        metric = IncrementalObjective(problem, vars_over_time).metric
+        if penalty is not None:
+            metric += penalty.reset(mgmts)
+        states.append({'mgmts': mgmts, 'vars_over_time': vars_over_time, 'metric': metric,
+                       'changed': True})
+    seeds = [rng.randrange(2 ** 31) for i in range(replicas)]
+
+    best = min(states, key=lambda x: x['metric'])
+    best_metric = best['metric']
+    best_mgmts = best['mgmts'].copy()
+    best_vars_over_time = best['vars_over_time']
+    best_metrics = IncrementalObjective(problem, best_vars_over_time).components.tolist()
+
+    if shared is not None:
+        # workers attach to the shared files rather than receiving arrays
+        initargs = (shared, None, problem, move_mode, axis_map, adjacency)
+    else:
+        initargs = (data, valid_mgmts, problem, move_mode, axis_map, adjacency)
+    processes = min(processes, replicas)
+    if processes > 1:
+        workers = _ReplicaWorkers(processes, initargs)
+        map_func = workers.map
+    else:
+        workers = None
+        _init_worker(*initargs)
+        map_func = lambda tasks: [_run_replica(task) for task in tasks]
+
+    swap_attempts = [0] * (replicas - 1)
+    swap_accepts = [0] * (replicas - 1)
+    num_rounds = int(math.ceil(steps / float(swap_interval)))
+    rounds_per_report = max(1, report_interval // swap_interval)
+
+    try:
+        for rnd in range(num_rounds):
+            round_steps = min(swap_interval, steps - rnd * swap_interval)
+            # replica i always runs at temps[i], a swap moves configurations
+            tasks = [(i, (state['mgmts'], state['vars_over_time']) if state['changed'] else None,
+                      temp, round_steps, seeds[i], best_metric)
+                     for i, (state, temp) in enumerate(zip(states, temps))]
+            states = map_func(tasks)
+            for state in states:
+                state['changed'] = False
+
+            for state in states:
+                if state['best'] is not None and state['best'][0] < best_metric:
+                    best_metric, best_mgmts, best_vars_over_time, best_metrics = state['best']
+
+            # exchange configurations between neighboring temperatures,
+            # alternating even and odd pairs each round
+            for i in range(rnd % 2, replicas - 1, 2):
+                swap_attempts[i] += 1
+                exponent = (1.0 / temps[i] - 1.0 / temps[i + 1]) * (
+                    states[i]['metric'] - states[i + 1]['metric'])
+                if exponent >= 0 or rng.random() < math.exp(exponent):
+                    states[i], states[i + 1] = states[i + 1], states[i]
+                    states[i]['changed'] = states[i + 1]['changed'] = True
+                    swap_accepts[i] += 1
+
+            if (rnd + 1) % rounds_per_report == 0:
+                notify(observers, 'on_replica_report', {
+                    'step': (rnd + 1) * swap_interval,
+                    'best_metric': best_metric,
+                    'metrics': [x['metric'] for x in states],
+                    'variables': variable_names,
+                    'weighted': best_metrics,
+                    'swap_acceptance': [float(a) / max(t, 1)
+                                        for a, t in zip(swap_accepts, swap_attempts)],
+                })
+    finally:
+        if workers is not None:
+            workers.close()
+        _worker.clear()
+
+    return best_metric, best_mgmts.tolist(), best_vars_over_time
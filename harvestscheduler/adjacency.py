@@ -0,0 +1,253 @@
+# encoding: utf-8
+"""
+Adjacency (maximum harvest clump size) constraints.
+
+A stand is harvested in a time period when its selected mgmt has a value
+above `threshold` for the harvest variable in that period. Harvested stands
+that are adjacent to each other form a clump; the acres of each clump above
+`max_clump` count as a violation, which enters the objective as
+
+    weight * 100 * (violating acres summed over clumps and time periods) / max_clump
+
+Configure it by passing a dict to schedule(adjacency=...):
+
+    adjacency = {
+        'graph': AdjacencyGraph.from_pairs(...),  # or prep_data.adjacency_from_geojson
+        'variable': 'timber',     # name or index of the harvest variable
+        'max_clump': 75,          # acres
+        'weight': 1.0,
+        'threshold': 0.0,
+    }
+"""
+from __future__ import absolute_import
+import numbers
+import numpy as np
+
+
+class AdjacencyGraph(object):
+    """
+    Undirected stand adjacency in CSR form: the neighbors of stand s are
+    indices[indptr[s]:indptr[s + 1]]. acres holds the area of each stand.
+    """
+
+    def __init__(self, indptr, indices, acres):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.acres = np.asarray(acres, dtype=np.float64)
+        assert len(self.indptr) == len(self.acres) + 1
+
+    @property
+    def num_stands(self):
+        return len(self.acres)
+
+    def neighbors(self, stand):
+        return self.indices[self.indptr[stand]:self.indptr[stand + 1]]
+
+    @classmethod
+    def from_pairs(cls, num_stands, pairs, acres):
+        """ Build the graph from (stand index, stand index) pairs, in either order """
+        pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        both = np.concatenate([pairs, pairs[:, ::-1]])
+        # sort by stand, then neighbor, and drop duplicates
+        both = np.unique(both[:, 0] * num_stands + both[:, 1])
+        rows, cols = both // num_stands, both % num_stands
+        indptr = np.zeros(num_stands + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_stands))
+        return cls(indptr, cols, acres)
+
+
+def _excess(size, max_clump):
+    return size - max_clump if size > max_clump else 0.0
+
+
+class ClumpPenalty(object):
+    """
+    Maintains the harvest clumps in each time period incrementally.
+
+    For every period we keep a clump label per stand (-1 when not harvested)
+    along with each clump's members and acres. Changing one stand's mgmt
+    only touches the periods where its harvest status flips: joining merges
+    the neighboring clumps, leaving re-walks the one clump it belonged to.
+    ``evaluate`` computes the new penalty without changing anything and
+    ``commit`` applies it, mirroring IncrementalObjective.
+    """
+
+    def __init__(self, graph, data, variable, max_clump, weight=1.0, threshold=0.0):
+        assert graph.num_stands == data.shape[0]
+        self.graph = graph
+        self.data = data
+        self.variable = variable
+        self.max_clump = float(max_clump)
+        self.threshold = threshold
+        self.scale = 100.0 * weight / self.max_clump
+        self.num_periods = data.shape[2]
+        self._plan = None
+
+    def harvested(self, stand, mgmt):
+        """ 1D boolean array, is the stand harvested in each time period """
+        return self.data[stand, mgmt, :, self.variable] > self.threshold
+
+    def reset(self, mgmts):
+        """ Rebuild every clump from scratch for a full set of mgmts """
+        graph = self.graph
+        num_stands = graph.num_stands
+        stand_range = np.arange(num_stands)
+        harvested = self.data[stand_range, mgmts, :, self.variable] > self.threshold
+
+        self.labels = np.full((self.num_periods, num_stands), -1, dtype=np.int64)
+        self.members = [{} for p in range(self.num_periods)]
+        self.sizes = [{} for p in range(self.num_periods)]
+        self._next_label = 0
+        self.excess = 0.0
+        for p in range(self.num_periods):
+            labels = self.labels[p]
+            for stand in np.nonzero(harvested[:, p])[0]:
+                if labels[stand] >= 0:
+                    continue
+                members, size = self._walk(p, stand, harvested[:, p].__getitem__)
+                self._add_clump(p, members, size)
+        self.penalty = self.scale * self.excess
+        return self.penalty
+
+    def get_state(self):
+        """
+        The clumps as arrays, which set_state restores exactly; reset would
+        number them differently and sum their acres in another order
+        """
+        periods, labels, sizes = [], [], []
+        for p, period_sizes in enumerate(self.sizes):
+            for label, size in period_sizes.items():
+                periods.append(p)
+                labels.append(label)
+                sizes.append(size)
+        return {
+            'labels': self.labels.copy(),
+            'clump_periods': np.array(periods, dtype=np.int64),
+            'clump_labels': np.array(labels, dtype=np.int64),
+            'clump_sizes': np.array(sizes, dtype=np.float64),
+            'next_label': np.int64(self._next_label),
+            'excess': np.float64(self.excess),
+        }
+
+    def set_state(self, state):
+        self.labels = np.array(state['labels'], dtype=np.int64)
+        self.members = [{} for p in range(self.num_periods)]
+        self.sizes = [{} for p in range(self.num_periods)]
+        for p, labels in enumerate(self.labels):
+            for stand in np.nonzero(labels >= 0)[0].tolist():
+                self.members[p].setdefault(int(labels[stand]), []).append(stand)
+        for p, label, size in zip(state['clump_periods'].tolist(), state['clump_labels'].tolist(),
+                                  state['clump_sizes'].tolist()):
+            self.sizes[p][label] = size
+        self._next_label = int(state['next_label'])
+        self.excess = float(state['excess'])
+        self.penalty = self.scale * self.excess
+        self._plan = None
+        return self.penalty
+
+    def _walk(self, period, start, is_harvested, exclude=None):
+        """ Stands and acres of the clump containing start """
+        graph = self.graph
+        seen = set([start])
+        stack = [start]
+        size = 0.0
+        while stack:
+            stand = stack.pop()
+            size += graph.acres[stand]
+            for neighbor in graph.indices[graph.indptr[stand]:graph.indptr[stand + 1]].tolist():
+                if neighbor not in seen and neighbor != exclude and is_harvested(neighbor):
+                    seen.add(neighbor)
+                    stack.append(neighbor)
+        return list(seen), size
+
+    def _add_clump(self, period, members, size):
+        label = self._next_label
+        self._next_label += 1
+        self.labels[period, members] = label
+        self.members[period][label] = members
+        self.sizes[period][label] = size
+        self.excess += _excess(size, self.max_clump)
+        return label
+
+    def _remove_clump(self, period, label):
+        del self.members[period][label]
+        self.excess -= _excess(self.sizes[period].pop(label), self.max_clump)
+
+    def evaluate(self, stand, old_mgmt, new_mgmt):
+        """ Penalty after changing the stand's mgmt, without committing it """
+        old = self.harvested(stand, old_mgmt)
+        new = self.harvested(stand, new_mgmt)
+        max_clump = self.max_clump
+        neighbors = self.graph.neighbors(stand)
+        acres = self.graph.acres[stand]
+        excess = self.excess
+        plan = []
+        for p in np.nonzero(old != new)[0].tolist():
+            labels = self.labels[p]
+            if new[p]:
+                # joins (and merges) the clumps of its harvested neighbors
+                joined = set(labels[neighbors].tolist())
+                joined.discard(-1)
+                size = acres + sum(self.sizes[p][x] for x in joined)
+                excess += _excess(size, max_clump)
+                excess -= sum(_excess(self.sizes[p][x], max_clump) for x in joined)
+                plan.append((p, joined, None))
+            else:
+                # leaves its clump, which may split apart
+                label = labels[stand]
+                excess -= _excess(self.sizes[p][label], max_clump)
+                parts = []
+                seen = set()
+                for neighbor in neighbors.tolist():
+                    if labels[neighbor] == label and neighbor not in seen:
+                        members, size = self._walk(p, neighbor, lambda x: labels[x] == label, stand)
+                        seen.update(members)
+                        parts.append((members, size))
+                        excess += _excess(size, max_clump)
+                plan.append((p, label, parts))
+        self._plan = (stand, plan, excess)
+        return self.scale * excess
+
+    def commit(self):
+        """ Apply the most recently evaluated change """
+        stand, plan, excess = self._plan
+        acres = self.graph.acres[stand]
+        for p, joined, parts in plan:
+            if parts is None:
+                members = [stand]
+                size = acres
+                for label in joined:
+                    members.extend(self.members[p][label])
+                    size += self.sizes[p][label]
+                    self._remove_clump(p, label)
+                self._add_clump(p, members, size)
+            else:
+                self._remove_clump(p, joined)
+                self.labels[p, stand] = -1
+                for members, size in parts:
+                    self._add_clump(p, members, size)
+        # use the total from evaluate so the committed penalty matches exactly
+        self.excess = excess
+        self.penalty = self.scale * excess
+        self._plan = None
+
+
+def clump_penalty(data, axis_map, adjacency):
+    """
+    Build a ClumpPenalty from the `adjacency` dict accepted by schedule(),
+    or return None if adjacency is disabled
+    """
+    if not adjacency:
+        return None
+    variable = adjacency.get('variable', 0)
+    if isinstance(variable, numbers.Integral):
+        variable = int(variable)
+    else:
+        names = [x['name'] for x in axis_map['variables']]
+        if variable not in names:
+            raise ValueError("Unknown adjacency variable `%s`" % variable)
+        variable = names.index(variable)
+    return ClumpPenalty(adjacency['graph'], data, variable, adjacency['max_clump'],
+                        weight=adjacency.get('weight', 1.0),
+                        threshold=adjacency.get('threshold', 0.0))
@@ -0,0 +1,99 @@
+# encoding: utf-8
+"""
+Checkpoints of an annealing run, to resume it after it was interrupted.
+
+    schedule(data, axis_map, valid_mgmts, steps=10 ** 7, seed=1,
+             checkpoint=Checkpointer('run.ckpt', seconds=300))
+
+    # later, with the same arguments
+    schedule(data, axis_map, valid_mgmts, steps=10 ** 7, seed=1,
+             checkpoint='run.ckpt', resume='run.ckpt')
+
+A checkpoint holds the state of the chain (current and best mgmts, the
+objective aggregates, the random number generator and the block of numbers
+drawn from it, any adjacency clumps), the step, the temperatures and the
+state of adaptive cooling, the stopping criteria, the trace and the log
+file. The continued run is step for step the one that was interrupted, so
+runs with a seed give the same result as if never interrupted.
+
+Checkpoints are only written at the end of a report interval, as an .npz of
+plain arrays (the stand data is not included) under a temporary name that
+is then renamed over the previous checkpoint, so an interruption never
+leaves a partial file. By default one is written at the end of the first
+report interval at least SECONDS after the last; pass a Checkpointer for
+every N steps (a multiple of report_interval) or another number of seconds.
+"""
+from __future__ import absolute_import
+import io
+import os
+import json
+import zlib
+import zipfile
+from timeit import default_timer
+import numpy as np
+
+VERSION = 1
+
+# default seconds between checkpoints
+SECONDS = 60
+
+
+class Checkpointer(object):
+    """
+    Writes checkpoints of a run to path, at the end of every `every` steps
+    or, by default, of the first report interval at least seconds after the
+    last checkpoint
+    """
+
+    def __init__(self, path, every=None, seconds=SECONDS):
+        self.path = path
+        self.every = every
+        self.seconds = seconds
+        self.written = 0
+        self._last = default_timer()
+
+    def due(self, steps_done):
+        """ Is a checkpoint due after steps_done steps, at the end of a report interval """
+        if self.every is not None:
+            return steps_done % self.every == 0
+        return default_timer() - self._last >= self.seconds
+
+    def save(self, state):
+        save_checkpoint(self.path, state)
+        self.written += 1
+        self._last = default_timer()
+
+
+def save_checkpoint(path, state):
+    """
+    Write a dict of arrays to path as an .npz, atomically. Each array is
+    written to the archive from memory; np.savez goes through a temporary
+    file per array, which costs more than the state itself.
+    """
+    state = dict(state, version=np.int64(VERSION))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        archive = zipfile.ZipFile(fh, 'w', zipfile.ZIP_STORED)
+        for name, value in sorted(state.items()):
+            buf = io.BytesIO()
+            np.lib.format.write_array(buf, np.asanyarray(value), allow_pickle=False)
+            archive.writestr(name + '.npy', buf.getvalue())
+        archive.close()
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp, path)
+
+
+def load_checkpoint(path):
+    """ The dict of arrays in the checkpoint at path """
+    with np.load(path, allow_pickle=False) as npz:
+        state = dict((name, npz[name]) for name in npz.files)
+    if int(state.pop('version', -1)) != VERSION:
+        raise ValueError("%s is not a version %d checkpoint" % (path, VERSION))
+    return state
+
+
+def run_fingerprint(*args):
+    """ A checksum of the JSON of args, to tell whether a checkpoint belongs to a run """
+    text = json.dumps(args, sort_keys=True, default=repr)
+    return np.int64(zlib.crc32(text.encode('utf-8')) & 0xffffffff)
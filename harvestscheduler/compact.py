@@ -0,0 +1,225 @@
+# encoding: utf-8
+"""
+Compact storage of stand data for the annealing loop.
+
+    data = quantize_stand_data(stand_data)            # int16, scaled per variable
+    schedule(data, axis_map, valid_mgmts, ...)
+
+    data = ragged_stand_data(stand_data, valid_mgmts)  # only the valid mgmts
+    schedule(data, axis_map, None, ...)
+
+Each step reads two (time periods x variables) blocks of the stand data, so
+the annealing loop is bound by memory bandwidth on large landscapes. Storing
+the values as int16 (or int32, float32) with a scale factor per variable
+halves or quarters the footprint. Values are decoded to float64 as they are
+read, so the aggregates are still accumulated in float64.
+
+When stands have few valid mgmts, most of the dense 4D array is padding.
+RaggedStandData keeps a block of time periods x variables for the valid
+(stand, mgmt) pairs only; prep_db2 and from_geojson_gyb can build it
+directly with ragged=True.
+"""
+from __future__ import absolute_import
+import numbers
+import numpy as np
+from .utils import pack_valid_mgmts, stands_per_chunk, PackedValidMgmts
+
+
+class QuantizedStandData(object):
+    """
+    Stand data stored as values * scales, where scales has one entry per
+    variable. Indexing it like the 4D stand data array returns float64.
+    """
+
+    def __init__(self, values, scales):
+        self.values = values
+        self.scales = np.asarray(scales, dtype=np.float64)
+        assert self.scales.shape == (values.shape[3],)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.scales.nbytes
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, key):
+        values = self.values[key]
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) < 4 and not any(k is Ellipsis for k in key):
+            # the variables axis is untouched
+            return values * self.scales
+        if len(key) == 4 and isinstance(key[3], (numbers.Integral, slice)):
+            return values * self.scales[key[3]]
+        return values * np.broadcast_to(self.scales, self.values.shape)[key]
+
+    def decode(self):
+        """ The full 4D array as float64 """
+        return self[:]
+
+
+def _variable_scales(data, dtype, chunk):
+    """ Per variable scales that fit each variable's largest magnitude into dtype """
+    num_variables = data.shape[3]
+    if not np.issubdtype(dtype, np.integer):
+        return np.ones(num_variables)
+    largest = np.zeros(num_variables)
+    integral = np.ones(num_variables, dtype=bool)
+    for start in range(0, len(data), chunk):
+        block = np.asarray(data[start:start + chunk], dtype=np.float64)
+        block = block.reshape(-1, num_variables)
+        if len(block):
+            largest = np.maximum(largest, np.abs(block).max(axis=0))
+            integral &= (block == np.round(block)).all(axis=0)
+    limit = np.iinfo(dtype).max
+    # whole numbers that fit are kept exactly
+    exact = integral & (largest <= limit)
+    return np.where(exact | (largest == 0), 1.0, largest / limit)
+
+
+def quantize_stand_data(data, dtype=np.int16):
+    """
+    Convert 4D stand data to a QuantizedStandData of dtype (an integer type
+    or float32), a chunk of stands at a time. Integer variables that fit
+    dtype are stored exactly; others are scaled to its range and rounded, to
+    within half a scale step of the original values.
+    """
+    dtype = np.dtype(dtype)
+    chunk = stands_per_chunk(data)
+    scales = _variable_scales(data, dtype, chunk)
+    values = np.empty(data.shape, dtype=dtype)
+    for start in range(0, len(data), chunk):
+        block = np.asarray(data[start:start + chunk], dtype=np.float64) / scales
+        if np.issubdtype(dtype, np.integer):
+            block = np.round(block)
+        values[start:start + chunk] = block
+    return QuantizedStandData(values, scales)
+
+
+class RaggedStandData(object):
+    """
+    Stand data for the valid (stand, mgmt) pairs only.
+
+    values holds a (time periods x variables) block per pair, stand by stand
+    with each stand's mgmts in increasing order, followed by one block of
+    zeros; the mgmts of stand s are indices[indptr[s]:indptr[s + 1]].
+    Indexing it like the 4D stand data array looks the pairs up in a
+    (stands x mgmts) table of positions and returns zeros for invalid pairs.
+    It is accepted as data by schedule() and parallel_tempering(), with
+    valid_mgmts None to use its own, and theoretical bounds are taken over
+    the valid mgmts only.
+    """
+
+    def __init__(self, values, indptr, indices, num_mgmts):
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int32)
+        num_pairs = len(indices)
+        assert len(values) == num_pairs + 1 and indptr[-1] == num_pairs
+        self.values = values
+        self.indptr = indptr
+        self.indices = indices
+        self.num_mgmts = num_mgmts
+
+        num_stands = len(indptr) - 1
+        self.pair_stands = np.repeat(np.arange(num_stands), np.diff(indptr))
+        # -1, the block of zeros, for invalid pairs
+        self.positions = np.full((num_stands, num_mgmts), -1, dtype=np.int64)
+        self.positions[self.pair_stands, indices] = np.arange(num_pairs)
+        self._bounds = None
+
+    @property
+    def shape(self):
+        return (len(self.indptr) - 1, self.num_mgmts) + self.values.shape[1:]
+
+    @property
+    def nbytes(self):
+        return (self.values.nbytes + self.indptr.nbytes + self.indices.nbytes +
+                self.positions.nbytes + self.pair_stands.nbytes)
+
+    @property
+    def valid_mgmts(self):
+        return PackedValidMgmts(self.indptr, self.indices)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            raise IndexError("RaggedStandData does not support indexing with ...")
+        positions = self.positions[key[:2]]
+        return self.values[(positions,) + key[2:]]
+
+    @property
+    def bounds(self):
+        """
+        The theoretical (mins, maxes) of each variable: the sum over stands
+        of the smallest and largest total over time of their valid mgmts
+        """
+        if self._bounds is None:
+            num_pairs = len(self.indices)
+            num_variables = self.values.shape[2]
+            chunk = stands_per_chunk(self.values)
+            totals = np.zeros((num_pairs, num_variables))
+            for start in range(0, num_pairs, chunk):
+                stop = min(start + chunk, num_pairs)
+                totals[start:stop] = self.values[start:stop].sum(axis=1)
+            if num_pairs:
+                # stands without valid mgmts contribute nothing
+                starts = self.indptr[:-1][np.diff(self.indptr) > 0]
+                mins = np.minimum.reduceat(totals, starts).sum(axis=0)
+                maxes = np.maximum.reduceat(totals, starts).sum(axis=0)
+            else:
+                mins, maxes = np.zeros(num_variables), np.zeros(num_variables)
+            self._bounds = (mins, maxes)
+        return self._bounds
+
+    def attach(self):
+        """ (stand_data, valid_mgmts), as for a SharedStandData handle """
+        return self, self.valid_mgmts
+
+    def arrays(self):
+        """ The arrays it is built from, see from_arrays """
+        return {'values': self.values, 'indptr': self.indptr, 'indices': self.indices,
+                'num_mgmts': np.array(self.num_mgmts)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['values'], arrays['indptr'], arrays['indices'],
+                   int(arrays['num_mgmts']))
+
+    def __getstate__(self):
+        return self.arrays()
+
+    def __setstate__(self, state):
+        self.__init__(state['values'], state['indptr'], state['indices'],
+                      int(state['num_mgmts']))
+
+    def decode(self):
+        """ The dense 4D array """
+        return self[:, :]
+
+
+def ragged_stand_data(data, valid_mgmts):
+    """
+    Convert dense 4D stand data to a RaggedStandData of the valid mgmts of
+    each stand, a chunk of stands at a time. An empty list of valid mgmts
+    means any mgmt is valid, so all of them are kept.
+    """
+    num_stands, num_mgmts = data.shape[:2]
+    valid_mgmts = [sorted(x) if len(x) else list(range(num_mgmts)) for x in valid_mgmts]
+    indptr, indices = pack_valid_mgmts(valid_mgmts)
+    values = np.zeros((len(indices) + 1,) + data.shape[2:], dtype=data.dtype)
+    chunk = stands_per_chunk(data)
+    for start in range(0, num_stands, chunk):
+        stop = min(start + chunk, num_stands)
+        block = np.asarray(data[start:stop])
+        pair_stands = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+        values[indptr[start]:indptr[stop]] = block[pair_stands, indices[indptr[start]:indptr[stop]]]
+    return RaggedStandData(values, indptr, indices, num_mgmts)
@@ -0,0 +1,152 @@
+# encoding: utf-8
+"""
+Temperature calibration and adaptive cooling for schedule().
+
+    schedule(..., temp_min='auto', temp_max='auto')
+    schedule(..., temp_max='auto', cooling={
+        'start_acceptance': 0.8,    # of uphill moves, at temp_max
+        'end_acceptance': 0.001,    # of uphill moves, at temp_min
+        'interval': 100,            # steps between adjustments
+        'reheat_after': 20000,      # steps without a new best before reheating
+        'reheat_factor': 4.0,
+    })
+
+With 'auto' temperatures, the change in metric of a sample of random moves
+from the starting configuration sets temp_max (temp_min) so that the given
+fraction of the uphill moves would be accepted at the start (end) of the run.
+
+By default the temperature falls exponentially from temp_max to temp_min.
+With cooling (a dict, or 'adaptive' for the defaults) it is instead adjusted
+every interval steps, once enough uphill moves were seen to measure their
+acceptance, so that it follows a geometric path from start_acceptance to
+end_acceptance, staying within [temp_min, temp_max]. If reheat_after is set and that many steps pass
+without a new best, the temperature is multiplied by reheat_factor.
+"""
+from __future__ import absolute_import
+import math
+import numpy as np
+from ._chain import REJECT, ACCEPT
+
+DEFAULTS = {
+    'start_acceptance': 0.8,
+    'end_acceptance': 0.001,
+    'interval': 100,
+    'reheat_after': None,
+    'reheat_factor': 4.0,
+}
+
+# random moves sampled to calibrate 'auto' temperatures
+CALIBRATION_MOVES = 500
+
+# the most the temperature changes in one adjustment
+MAX_ADJUSTMENT = 2.0
+
+# accepted uphill moves expected at the target acceptance before adjusting,
+# so low targets are not chased with too few moves to measure them
+MIN_EXPECTED_ACCEPTS = 5
+
+
+def cooling_config(cooling):
+    """ DEFAULTS updated with the cooling argument of schedule() """
+    config = dict(DEFAULTS)
+    if isinstance(cooling, dict):
+        unknown = set(cooling) - set(DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown cooling options %s" % ", ".join(sorted(unknown)))
+        config.update(cooling)
+    elif cooling not in (None, 'adaptive'):
+        raise ValueError("cooling should be None, 'adaptive' or a dict, not %r" % (cooling,))
+    for name in ('start_acceptance', 'end_acceptance'):
+        if not 0 < config[name] < 1:
+            raise ValueError("%s should be between 0 and 1" % name)
+    return config
+
+
+def calibrate_temperature(deltas, acceptance):
+    """
+    The temperature at which, on average, a fraction acceptance of the uphill
+    moves with these changes in metric are accepted; None without any
+    """
+    uphill = np.asarray(deltas)[np.asarray(deltas) > 0]
+    if not len(uphill):
+        return None
+    # mean(exp(-delta / temp)) grows with temp, bisect on log(temp)
+    low, high = math.log(uphill.min() * 1e-6), math.log(uphill.max() * 1e6)
+    for _ in range(100):
+        mid = (low + high) / 2
+        if np.exp(-uphill / math.exp(mid)).mean() < acceptance:
+            low = mid
+        else:
+            high = mid
+    return math.exp((low + high) / 2)
+
+
+class AdaptiveCooling(object):
+    """
+    Steers the temperature so the acceptance of uphill moves follows a
+    geometric path over the run, see the module docstring.
+    Call observe(outcome, new_best, progress) after every step, progress
+    being the fraction of the run done, and read temp.
+    """
+
+    def __init__(self, temp_min, temp_max, config):
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.temp = temp_max
+        self.interval = config['interval']
+        self.reheat_after = config['reheat_after']
+        self.reheat_factor = config['reheat_factor']
+        self._log_start = math.log(config['start_acceptance'])
+        self._log_end = math.log(config['end_acceptance'])
+        self.reheats = 0
+        self._step = 0
+        self._uphill = 0
+        self._accepted = 0
+        self._since_best = 0
+
+    def target(self, progress):
+        """ Acceptance of uphill moves aimed for with a fraction progress of the run done """
+        return math.exp(self._log_start + (self._log_end - self._log_start) * progress)
+
+    def observe(self, outcome, new_best, progress):
+        self._step += 1
+        # improvements are always accepted, they say nothing about the temperature
+        if outcome == ACCEPT:
+            self._uphill += 1
+            self._accepted += 1
+        elif outcome == REJECT:
+            self._uphill += 1
+        if new_best:
+            self._since_best = 0
+        else:
+            self._since_best += 1
+
+        if self._step % self.interval == 0 and self._uphill:
+            target = self.target(progress)
+            if self._uphill * target >= MIN_EXPECTED_ACCEPTS:
+                self._adjust(target)
+        if self.reheat_after and self._since_best >= self.reheat_after:
+            self.temp = min(self.temp * self.reheat_factor, self.temp_max)
+            self.reheats += 1
+            self._since_best = 0
+
+    def _adjust(self, target):
+        # acceptance ~ exp(-delta / temp), so temp scales with 1 / -log(acceptance)
+        observed = min(max(self._accepted / float(self._uphill), 1e-6), 1 - 1e-6)
+        factor = math.log(observed) / math.log(target)
+        factor = min(max(factor, 1 / MAX_ADJUSTMENT), MAX_ADJUSTMENT)
+        self.temp = min(max(self.temp * factor, self.temp_min), self.temp_max)
+        self._uphill = 0
+        self._accepted = 0
+
+    def get_state(self):
+        return {
+            'temp': np.float64(self.temp),
+            'counts': np.array([self.reheats, self._step, self._uphill, self._accepted,
+                                self._since_best], dtype=np.int64),
+        }
+
+    def set_state(self, state):
+        self.temp = float(state['temp'])
+        (self.reheats, self._step, self._uphill, self._accepted,
+         self._since_best) = state['counts'].tolist()
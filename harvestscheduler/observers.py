@@ -0,0 +1,128 @@
+# encoding: utf-8
+"""
+Observers of an annealing run.
+
+schedule() calls each of its observers at these points, with a dict of stats:
+
+    on_start(stats)             before the first step: variables, theoretical
+                                mins and maxes, temp_min, temp_max, whether
+                                they were calibrated, start_metric and
+                                resumed_at, the step a resumed run continues
+                                from (or None)
+    on_new_best(stats)          each time a step finds a new best: step,
+                                best_metric, temp
+    on_temperature_step(stats)  at the end of each temperature plateau, one
+                                per report interval: step, temp
+    on_report(stats)            at the end of each report interval, see below
+    on_finish(stats)            after the last step: steps run, stopped (why
+                                the run ended, see harvestscheduler.stopping),
+                                elapsed, steps_per_sec, best_metric, timings
+
+The stats of on_report are
+
+    step, steps, temp, elapsed      seconds since the first step; steps is
+                                    None if only a time budget limits them
+    steps_per_sec                   over the report interval
+    acceptance_rate, improvement_rate
+    best_metric
+    variables                       names, in axis_map order
+    weighted, unweighted            components of best_metric, per variable
+    adjacency_penalty               or None without an adjacency constraint
+    timings                         estimated seconds spent in the 'proposal',
+                                    'evaluation' and 'bookkeeping' of moves
+                                    over the interval, timed on a sample of
+                                    the steps
+
+parallel_tempering() reports through the same observers, instead of
+on_report, with
+
+    on_replica_report(stats)    every report_interval steps: step,
+                                best_metric, metrics of the replicas,
+                                coldest first, variables, weighted
+                                components of best_metric and
+                                swap_acceptance, the rate of accepted swaps
+                                between each pair of neighboring replicas
+
+Subclass Observer and override the methods you need. PrintObserver, which
+prints the familiar progress report, is the default.
+"""
+from __future__ import absolute_import
+
+PHASES = ('proposal', 'evaluation', 'bookkeeping')
+
+
+class Observer(object):
+    """ Ignores everything, override the methods of interest """
+
+    def on_start(self, stats):
+        pass
+
+    def on_new_best(self, stats):
+        pass
+
+    def on_temperature_step(self, stats):
+        pass
+
+    def on_report(self, stats):
+        pass
+
+    def on_finish(self, stats):
+        pass
+
+    def on_replica_report(self, stats):
+        pass
+
+
+class PrintObserver(Observer):
+    """ Prints the bounds and a progress report every report interval """
+
+    def on_start(self, stats):
+        for name, low, high in zip(stats['variables'], stats['theoretical_mins'],
+                                   stats['theoretical_maxes']):
+            print name, low, "to", high
+        if stats.get('calibrated'):
+            print "temperature: %g to %g" % (stats['temp_max'], stats['temp_min'])
+        if stats.get('resumed_at') is not None:
+            print "resumed at step %d" % stats['resumed_at']
+        print
+
+    def on_report(self, stats):
+        print "step: %-7d  accepted %0.2f %%   improved %0.2f %%   best_metric:   %-6.2f    temp: %-1.4f" % (
+            stats['step'], 100 * stats['acceptance_rate'], 100 * stats['improvement_rate'],
+            stats['best_metric'], stats['temp'])
+        print "  weighted best: ", ",  ".join(["%s: %.2f" % x
+                                               for x in zip(stats['variables'], stats['weighted'])])
+        print "unweighted best: ", ",  ".join(["%s: %.2f" % x
+                                               for x in zip(stats['variables'], stats['unweighted'])])
+        if stats['adjacency_penalty'] is not None:
+            print "adjacency penalty: %.2f" % stats['adjacency_penalty']
+        print
+
+    def on_replica_report(self, stats):
+        print "step: %-7d  best_metric:   %-6.2f    replica metrics: %s" % (
+            stats['step'], stats['best_metric'], " ".join("%.2f" % x for x in stats['metrics']))
+        print "  weighted best: ", ",  ".join(["%s: %.2f" % x
+                                               for x in zip(stats['variables'], stats['weighted'])])
+        print "   swap accepts: ", " ".join("%0.0f%%" % (100.0 * x) for x in stats['swap_acceptance'])
+        print
+
+    def on_finish(self, stats):
+        if stats['stopped'] != 'steps':
+            print "stopped after %d steps (%s), best_metric: %.2f" % (
+                stats['steps'], stats['stopped'], stats['best_metric'])
+
+
+class CallbackObserver(Observer):
+    """ An Observer from functions, e.g. CallbackObserver(on_report=monitor.send) """
+
+    def __init__(self, **callbacks):
+        for name, callback in callbacks.items():
+            if not hasattr(Observer, name):
+                raise TypeError("Unknown callback `%s`" % name)
+            setattr(self, name, callback)
+
+
+def notify(observers, event, stats):
+    """ Call method event of each observer with stats """
+    for observer in observers:
+        getattr(observer, event)(stats)
@@ -44,13 +44,11 @@ class AnalogPlot:
                 self.y1s.append(point)
                 self.x1s.append(step)
 
-        self.plt1.set_xdata(self.x1s)
-        self.plt1.set_ydata(self.y1s)
-        self.plt2.set_xdata(self.x2s)
-        self.plt2.set_ydata(self.y2s)
-        self.plt3.set_xdata(self.x3s)
-        self.plt3.set_ydata(self.y3s)
-        # import ipdb; ipdb.set_trace()
-        plt.subplot(111)
+        # in interactive mode every change redraws, even between x and y
+        plt.ioff()
+        self.plt1.set_data(self.x1s, self.y1s)
+        self.plt2.set_data(self.x2s, self.y2s)
+        self.plt3.set_data(self.x3s, self.y3s)
         plt.ylim([min(self.latest)*0.9, max(self.latest)*1.1])
+        plt.ion()
         plt.draw()
\ No newline at end of file
@@ -3,6 +3,18 @@ import json
 import math
 import sqlite3
 import os
+import shutil
+import tempfile
+import hashlib
+import inspect
+import functools
+import multiprocessing
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+
+string_types = (type(''), type(u''))
 
 
 def from_random(stands, mgmts, timeperiods, numvars, low=4, high=14):
@@ -167,6 +179,40 @@ def calculate_metrics(line, stand):
     return data
 
 
+def _cut_type(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        # no harvest so don't attempt to calculate
+        return 0
+
+
+def calculate_metrics_bulk(columns, acres, slope):
+    """
+    calculate_metrics for many rows at once. columns are arrays of
+    total_stand_carbon, removed_merch_ft3, NSONEST, FIREHZD and CUT_TYPE
+    with one entry per row, acres and slope are those of each row's stand.
+    Returns a (rows x 6) array.
+    """
+    carbon, merch, nsonest, firehzd, cut_type = columns
+    data = np.empty((len(acres), 6))
+    data[:, 0] = merch.astype(np.float64) * acres / 1000.0  # mbf
+    data[:, 1] = data[:, 0]  # include another timber column for even flow
+    data[:, 2] = carbon.astype(np.float64) * acres
+    data[:, 3] = nsonest.astype(np.float64) * acres
+
+    # Determine areas with high fire risk
+    # 0 = very low risk, 1 = low risk, 2 = medium risk
+    # 3 = medium-high risk, 4 = high risk
+    data[:, 4] = np.where(firehzd.astype(np.float64) > 3, acres, 0)
+
+    # Use slope as a stand-in for cost
+    # clear cut (3) = slope, partial cut (1, 2) = half slope, no harvest = 0
+    cut_type = np.array([_cut_type(x) for x in cut_type], dtype=np.int64)
+    data[:, 5] = np.where(cut_type == 3, slope, np.where((cut_type == 1) | (cut_type == 2), slope / 2, 0))
+    return data
+
+
 def get_stands(con, batch=None, default_site=2):
     con.row_factory = sqlite3.Row
     cur = con.cursor()
@@ -196,30 +242,290 @@ def get_stands(con, batch=None, default_site=2):
         yield dd
 
 
+# rows fetched from sqlite at a time by the bulk loaders
+CHUNK_ROWS = 100000
+
+# stand data arrays larger than this are built in a memory-mapped temporary file
+MEMMAP_BYTES = 1 << 30
+
+FVSAGGREGATE_INDEX = ('CREATE INDEX fvsaggregate_idx ON fvsaggregate '
+                      '(var, climate, cond, rx, "offset", year);')
+FVS_STANDS_INDEX = 'CREATE INDEX fvs_stands_idx ON fvs_stands (standid, rx, "offset", year);'
+
+
+def has_index(conn, table, columns):
+    """ Does the table have an index whose leading columns are `columns`, in order """
+    for index in conn.execute("PRAGMA index_list(%s)" % table).fetchall():
+        name = index[1]
+        info = conn.execute("PRAGMA index_info(%s)" % name).fetchall()
+        leading = [x[2] for x in sorted(info)][:len(columns)]
+        if leading == columns:
+            return True
+    return False
+
+
+def scatter_rows(arr, counts, stands, mgmts, values):
+    """
+    Write rows of values into arr[stand, mgmt, period], where the period of
+    each row is its position among the rows of the same stand and mgmt,
+    counting the rows already written (kept in counts, stands x mgmts).
+    Rows for each stand and mgmt must come in time period order.
+    """
+    key = stands * counts.shape[1] + mgmts
+    order = np.argsort(key, kind='mergesort')
+    key = key[order]
+    # position of each row within its run of equal keys
+    starts = np.r_[0, np.nonzero(np.diff(key))[0] + 1]
+    runs = np.diff(np.r_[starts, len(key)])
+    rank = np.arange(len(key)) - np.repeat(starts, runs)
+
+    flat_counts = counts.reshape(-1)
+    periods = flat_counts[key] + rank
+    if len(periods) and periods.max() >= arr.shape[2]:
+        raise ValueError("More rows than time periods for a stand and mgmt")
+    arr[stands[order], mgmts[order], periods] = values[order]
+    flat_counts[key[starts]] += runs
+
+
+def connect_readonly(db):
+    """ Open a sqlite database for reading only """
+    try:
+        return sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(db)), uri=True)
+    except TypeError:
+        # no uri support (python 2), refuse writes on this connection instead
+        conn = sqlite3.connect(db)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+
+def _key_ranges(keys, parts):
+    """ Split the sorted keys into at most `parts` contiguous (first, last) ranges """
+    keys = sorted(keys)
+    size = max(1, int(math.ceil(len(keys) / float(parts))))
+    return [(keys[i], keys[min(i + size, len(keys)) - 1]) for i in range(0, len(keys), size)]
+
+
+def _fill_task(args):
+    fill, db, key_range, arr_path, counts_path, fill_args = args
+    arr = np.load(arr_path, mmap_mode='r+')
+    counts = np.load(counts_path, mmap_mode='r+')
+    conn = connect_readonly(db)
+    try:
+        fill(conn, key_range, arr, counts, *fill_args)
+    finally:
+        conn.close()
+    arr.flush()
+    counts.flush()
+
+
+def allocate_array(shape, dtype):
+    """
+    A zero filled array, memory-mapped to an anonymous temporary file (in
+    TMPDIR) instead of held in memory when it is larger than MEMMAP_BYTES
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if nbytes <= MEMMAP_BYTES:
+        return np.zeros(shape, dtype=dtype)
+    fd, path = tempfile.mkstemp(prefix='harvestscheduler-', suffix='.npy')
+    os.close(fd)
+    try:
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    finally:
+        # the mapping outlives the file's name
+        os.remove(path)
+
+
+def compact_stands(arr, keep):
+    """
+    Move the stands in keep (increasing indices) to the front of arr in place
+    and return a view of them, copying at most utils.CHUNK_BYTES at a time
+    """
+    from .utils import stands_per_chunk
+    keep = np.asarray(keep, dtype=np.int64)
+    chunk = stands_per_chunk(arr)
+    # runs of consecutive stands move together
+    breaks = np.nonzero(np.diff(keep) != 1)[0] + 1
+    dest = 0
+    for run in np.split(keep, breaks):
+        if not len(run):
+            continue
+        src = int(run[0])
+        if src != dest:
+            for start in range(0, len(run), chunk):
+                stop = min(start + chunk, len(run))
+                arr[dest + start:dest + stop] = arr[src + start:src + stop]
+        dest += len(run)
+    return arr[:dest]
+
+
+def fill_parallel(fill, db, conn, keys, shape, dtype, processes, fill_args):
+    """
+    Allocate the 4D array (and the rows seen for each of its first two axes)
+    and fill it by calling
+        fill(conn, key_range, arr, counts, *fill_args)
+    where key_range limits the rows read to keys between (first, last),
+    or is None for all of them.
+
+    With processes > 1 the keys are split into contiguous ranges that a pool
+    of processes fills concurrently, each with its own read-only connection,
+    writing straight into memory-mapped output arrays.
+    Arrays larger than MEMMAP_BYTES are memory-mapped to a temporary file
+    rather than held in memory, see allocate_array.
+    Returns (arr, counts)
+    """
+    if not processes or processes == 1 or len(keys) < 2:
+        arr = allocate_array(shape, dtype)
+        counts = np.zeros(shape[:2], dtype=np.int64)
+        fill(conn, None, arr, counts, *fill_args)
+        return arr, counts
+
+    from .shared import SHM_DIR
+    out_of_core = int(np.prod(shape)) * np.dtype(dtype).itemsize > MEMMAP_BYTES
+    directory = tempfile.mkdtemp(
+        prefix='harvestscheduler-prep-',
+        dir=SHM_DIR if os.path.isdir(SHM_DIR) and not out_of_core else None)
+    try:
+        arr_path = os.path.join(directory, 'arr.npy')
+        counts_path = os.path.join(directory, 'counts.npy')
+        # created zero filled
+        np.lib.format.open_memmap(arr_path, mode='w+', dtype=dtype, shape=shape).flush()
+        np.lib.format.open_memmap(counts_path, mode='w+', dtype=np.int64, shape=shape[:2]).flush()
+
+        # a few ranges per process to even out the load
+        tasks = [(fill, db, key_range, arr_path, counts_path, fill_args)
+                 for key_range in _key_ranges(keys, processes * 4)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_fill_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        # the mapping outlives the directory
+        return np.load(arr_path, mmap_mode='r+' if out_of_core else None), np.load(counts_path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _key_range(key_column, key_range):
+    """
+    The condition limiting key_column to key_range, for the {range} slot of
+    a fill's query, and its parameters. Nothing limits it when key_range
+    is None.
+    """
+    if key_range is None:
+        return '', ()
+    return 'AND %s BETWEEN ? AND ?' % key_column, tuple(key_range)
+
+
+def _stream(conn, sql, params):
+    """ Chunks of rows, as lists of columns """
+    rows = conn.cursor()
+    rows.row_factory = None
+    rows.execute(sql, params)
+    while True:
+        chunk = rows.fetchmany(CHUNK_ROWS)
+        if not chunk:
+            break
+        yield list(zip(*chunk))
+
+
+def _fill_fvs_stands(conn, key_range, arr, counts, climate, stand_index, mgmt_index,
+                     positions=None):
+    """
+    Scatter the rows of fvs_stands into the stand data array, or with
+    positions, into the (pairs x 1 x periods x variables) values of a
+    RaggedStandData
+    """
+    range_sql, range_params = _key_range('standid', key_range)
+    sql = """SELECT standid, rx, "offset", timber, carbon, owl, cost
+        FROM fvs_stands
+        WHERE climate = ?
+        {range}
+        ORDER BY standid, rx, "offset", year""".format(range=range_sql)
+    for columns in _stream(conn, sql, (climate,) + range_params):
+        stands = np.array([stand_index[x] for x in columns[0]], dtype=np.int64)
+        mgmts = np.array([mgmt_index[x] for x in zip(columns[1], columns[2])], dtype=np.int64)
+        values = np.array(columns[3:], dtype=np.float64).T
+        if positions is not None:
+            stands, mgmts = positions[stands, mgmts], np.zeros_like(mgmts)
+        scatter_rows(arr, counts, stands, mgmts, values)
+
+
+def _fill_fvsaggregate(conn, key_range, arr, counts, variant, climate,
+                       stand_index, mgmt_index, sites, acres, slopes):
+    """ Compute the metrics of the fvsaggregate rows and scatter them into the array """
+    range_sql, range_params = _key_range('cond', key_range)
+    sql = """SELECT cond, site, rx, "offset",
+            total_stand_carbon, removed_merch_ft3, NSONEST, FIREHZD, CUT_TYPE
+        FROM fvsaggregate
+        WHERE var = ?
+        AND climate = ?
+        AND total_stand_carbon is not null  -- should remove any blanks
+        {range}
+        ORDER BY cond, rx, "offset", year""".format(range=range_sql)
+    for columns in _stream(conn, sql, (variant, climate) + range_params):
+        stand_ids = np.array([stand_index.get(x, -1) for x in columns[0]], dtype=np.int64)
+        mgmt_ids = np.array([mgmt_index[x] for x in zip(columns[2], columns[3])], dtype=np.int64)
+        # only the stands being prepped, at their own site class
+        keep = stand_ids >= 0
+        keep[keep] = sites[stand_ids[keep]] == np.array(columns[1], dtype=np.int64)[keep]
+        stand_ids = stand_ids[keep]
+        metrics = calculate_metrics_bulk(
+            [np.array(col, dtype=object)[keep] for col in columns[4:]],
+            acres[stand_ids], slopes[stand_ids])
+        scatter_rows(arr, counts, stand_ids, mgmt_ids[keep], metrics)
+
+
+def _fill_trees_fvsaggregate(conn, key_range, arr, counts, cond_index, mgmt_index):
+    """ Scatter the per acre Growth-Yield Batch values of each condition into the array """
+    range_sql, range_params = _key_range('cond', key_range)
+    sql = """SELECT cond, rx, "offset",
+            -- Timber
+            removed_merch_bdft / 1000.0 as timber, -- mbf/acre
+            -- Carbon
+            total_stand_carbon as carbon, -- tons/acre
+            -- Fire
+            (CASE WHEN FIREHZD > 3 THEN 1 ELSE 0 END) as fire --binary
+        from trees_fvsaggregate
+        where total_stand_carbon is not null -- remove any blanks
+        {range}
+        ORDER BY cond, rx, "offset", year""".format(range=range_sql)
+    for columns in _stream(conn, sql, range_params):
+        # skip conditions that no stand uses
+        cond_ids = np.array([cond_index.get(x, -1) for x in columns[0]], dtype=np.int64)
+        keep = cond_ids >= 0
+        mgmt_ids = np.array([mgmt_index[x] for x in zip(columns[1], columns[2])], dtype=np.int64)
+        values = np.array(columns[3:], dtype=np.float64).T
+        scatter_rows(arr, counts, cond_ids[keep], mgmt_ids[keep], values[keep])
+
+
 def handle_error(inputs):
     raise Exception("\nNo fvs outputs found for the following case (check your input shp):\n%s" % json.dumps(inputs, indent=2))
 
 
-def prep_db(db, batch=None, variant="PN", climate="Ensemble-rcp60", cache=False, verbose=False):
+def prep_db(db, batch=None, variant="PN", climate="Ensemble-rcp60", cache=False, verbose=False,
+            processes=None):
+    """
+    Read the fvsaggregate table for one variant and climate into the 4D
+    stand data array, streaming it once and computing the metrics of
+    calculate_metrics a chunk of rows at a time. Stands come from the stands
+    table; a stand's mgmts are valid if they have data and, when the stand
+    restricts its rxs, use one of them. Stands without valid mgmts are dropped,
+    compacting the array in place.
+    With processes > 1 the stands are split across a pool of processes.
+    With cache=True the result is kept in .cache, see cache_prep.
+    """
+    # Check cache, keyed by the arguments and the database file
+    if cache:
+        return cache_prep(prep_db)(db, batch=batch, variant=variant, climate=climate,
+                                   verbose=verbose, processes=processes)
+
     conn = sqlite3.connect(db)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
-
-    # Check cache
-    if cache:
-        try:
-            stand_data = np.load('cache.array.npy')
-            axis_map = json.loads(open('cache.axis_map').read())
-            valid_mgmts = json.loads(open('cache.valid_mgmts').read())
-            print "Using cached data to reduce calculation time..."
-            return stand_data, axis_map, valid_mgmts
-        except:
-            pass  # calculate it
-
-
     # find all rx, offsets
-    axis_map = {'mgmt': [], 'standids': []}
+    axis_map = {'mgmt': [], 'standids': [], 'acres': []}
     sql = """
         SELECT rx, offset
         FROM fvsaggregate
@@ -228,103 +534,78 @@ def prep_db(db, batch=None, variant="PN", climate="Ensemble-rcp60", cache=False,
     for row in cursor.execute(sql):
         axis_map['mgmt'].append((row['rx'], row['offset']))
 
-    valid_mgmts = [] # 2D array holding valid mgmt ids for each stand
-    property_stands = []
-
-    for stand in get_stands(conn, batch):
-        if verbose:
-            print stand['cond']
+    stands = list(get_stands(conn, batch))
+    stand_index = dict((stand['cond'], i) for i, stand in enumerate(stands))
+    mgmt_index = dict((tuple(mgmt), i) for i, mgmt in enumerate(axis_map['mgmt']))
+    sites = np.array([stand['site'] for stand in stands], dtype=np.int64)
+    acres = np.array([stand['acres'] for stand in stands], dtype=np.float64)
+    slopes = np.array([stand['slope'] for stand in stands], dtype=np.float64)
+
+    sql = """SELECT count(distinct(year)) FROM fvsaggregate
+        WHERE var = ? AND climate = ? AND total_stand_carbon is not null"""
+    num_periods = cursor.execute(sql, (variant, climate)).fetchone()[0]
+
+    if not has_index(conn, 'fvsaggregate', ['var', 'climate', 'cond', 'rx', 'offset']):
+        print 'No index on fvsaggregate (var, climate, cond, rx, "offset"), sqlite will ' \
+              'sort the table while reading it. To avoid that, run\n    %s' % FVSAGGREGATE_INDEX
+
+    shape = (len(stands), len(mgmt_index), num_periods, 6)
+    arr, counts = fill_parallel(
+        _fill_fvsaggregate, db, conn, list(stand_index), shape, np.float64, processes,
+        (variant, climate, stand_index, mgmt_index, sites, acres, slopes))
+    if verbose:
+        print "%d rows read" % counts.sum()
+
+    valid = counts > 0
+    if verbose:
+        for s, m in zip(*np.nonzero(~valid)):
+            print "WARNING: no data for cond %s rx %s off %s" % (
+                stands[s]['cond'], axis_map['mgmt'][m][0], axis_map['mgmt'][m][1])
 
+    valid_mgmts = [] # 2D array holding valid mgmt ids for each stand
+    keep = []
+    for s, stand in enumerate(stands):
         temporary_mgmt_list = []
-        stand_mgmts = []
-
-        for mgmt_id, mgmt in enumerate(axis_map['mgmt']):
-            rx, offset = mgmt
-            if verbose:
-                print "\t", rx, offset
-
-            inputs = {
-                'var': variant,
-                'rx': rx,
-                'cond': stand['cond'],
-                'site': stand['site'],
-                'climate': climate,
-                'offset': offset }
-
-            sql = """
-              SELECT *
-              FROM fvsaggregate
-              WHERE var = '%(var)s'
-              AND rx = %(rx)d
-              AND cond = %(cond)d
-              AND site = %(site)d
-              AND climate = '%(climate)s'
-              AND "offset" = %(offset)d
-              AND total_stand_carbon is not null  -- should remove any blanks
-              ORDER BY year
-            """ % inputs
-
-            empty = True
-            mgmt_timeperiods = []
-            for row in cursor.execute(sql):
-                empty = False
-                year = row['year']
-
-                yeardata = calculate_metrics(row, stand)
-                if verbose:
-                    print "\t\t", year, yeardata
-
-                assert len(yeardata) == 6
-                mgmt_timeperiods.append(yeardata)
-
-            if empty:
-                #handle_error(inputs)
-                print "WARNING: skipping cond %s rx %s off %s" % (inputs['cond'], inputs['rx'], inputs['offset'])
-                break
-
-            if stand['restricted_rxs']:
-                if rx in stand['restricted_rxs']:
-                    temporary_mgmt_list.append(mgmt_id)
-            else:
+        for mgmt_id in np.nonzero(valid[s])[0].tolist():
+            rx = axis_map['mgmt'][mgmt_id][0]
+            if not stand['restricted_rxs'] or rx in stand['restricted_rxs']:
                 temporary_mgmt_list.append(mgmt_id)
 
-            assert len(mgmt_timeperiods) == 20
-            stand_mgmts.append(mgmt_timeperiods)
-
         if len(temporary_mgmt_list) == 0:
             #handle_error({'rxs': stand['restricted_rxs']})
             continue
 
+        keep.append(s)
         axis_map['standids'].append(stand['standid'])
+        axis_map['acres'].append(stand['acres'])
         valid_mgmts.append(temporary_mgmt_list)
-        property_stands.append(stand_mgmts)
 
-    arr = np.array(property_stands)
-
-    # caching
-    np.save('cache.array', arr)
-    with open('cache.axis_map', 'w') as fh:
-        fh.write(json.dumps(axis_map, indent=2))
-    with open('cache.valid_mgmts', 'w') as fh:
-        fh.write(json.dumps(valid_mgmts, indent=2))
+    if len(keep) < len(stands):
+        arr = compact_stands(arr, keep)
 
     return arr, axis_map, valid_mgmts
 
 
-def prep_db2(db, climate="Ensemble-rcp60", cache=False, verbose=False):
+def prep_db2(db, climate="Ensemble-rcp60", cache=False, verbose=False, processes=None,
+             ragged=False):
+    """
+    Read the fvs_stands table (standid, rx, offset, climate, year, timber,
+    carbon, owl, cost) into the 4D stand data array with a single ordered scan.
+    Combinations of stand and mgmt without rows are left as zeros and are
+    not valid mgmts for that stand.
+    With ragged=True only the combinations with rows are stored, in a
+    compact.RaggedStandData, and the dense array is never allocated.
+    With processes > 1 the stands are split across a pool of processes.
+    With cache=True the result is kept in .cache, see cache_prep.
+    """
+    # Check cache, keyed by the arguments and the database file
+    if cache:
+        return cache_prep(prep_db2)(db, climate=climate, verbose=verbose, processes=processes,
+                                    ragged=ragged)
+
     conn = sqlite3.connect(db)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
-    # Check cache
-    if cache:
-        try:
-            stand_data = np.load('cache.array.%s.npy' % cache)
-            axis_map = json.loads(open('cache.axis_map.%s.json' % climate).read())
-            valid_mgmts = json.loads(open('cache.valid_mgmts.%s.json' % climate).read())
-            print "Using cached data to reduce calculation time..."
-            return stand_data, axis_map, valid_mgmts
-        except:
-            pass  # calculate it
 
     axis_map = {'mgmt': [], 'standids': []}
 
@@ -339,65 +620,69 @@ def prep_db2(db, climate="Ensemble-rcp60", cache=False, verbose=False):
         # mgmt is a tuple of rx and offset
         axis_map['mgmt'].append((row['rx'], row['offset']))
 
-    valid_mgmts = [] # 2D array holding valid mgmt ids for each stand
+    stand_index = dict((standid, i) for i, standid in enumerate(axis_map['standids']))
+    mgmt_index = dict((tuple(mgmt), i) for i, mgmt in enumerate(axis_map['mgmt']))
 
-    list4D = []
-    for standid in axis_map['standids']:
-        if verbose:
-            print standid
+    # the number of time periods is the number of distinct years
+    sql = "SELECT count(distinct(year)) FROM fvs_stands WHERE climate = ?"
+    num_periods = cursor.execute(sql, (climate,)).fetchone()[0]
 
-        temporary_mgmt_list = []
-        list3D = []
-        for i, mgmt in enumerate(axis_map['mgmt']):
-            rx, offset = mgmt
-            if verbose:
-                print "\t", rx, offset
-
-            sql = """SELECT year, carbon, timber as timber, owl, cost
-                from fvs_stands
-                WHERE standid = '%(standid)s'
-                and rx = %(rx)d
-                and "offset" = %(offset)d
-                and climate = '%(climate)s';
-                -- original table MUST be ordered by standid, year
-            """ % locals()
-
-            list2D = [ map(float, [r['timber'], r['carbon'], r['owl'], r['cost']]) for r in cursor.execute(sql)]
-            if list2D == []:
-                list2D = [[0.0, 0.0, 0.0, 0.0]] * 20
-            else:
-                temporary_mgmt_list.append(i)
-
-            ## Instead we assume that if it's in fvs_stands, we consider it
-            # if stand['restricted_rxs']:
-            #     if rx in stand['restricted_rxs']:
-            #         temporary_mgmt_list.append(mgmt_id)
-            # else:
-            #     temporary_mgmt_list.append(mgmt_id)
-            #assert len(list2D) == 20
-
-            list3D.append(list2D)
-
-        list4D.append(list3D)
-
-        assert len(temporary_mgmt_list) > 0
-        valid_mgmts.append(temporary_mgmt_list)
+    if not has_index(conn, 'fvs_stands', ['standid', 'rx', 'offset']):
+        print 'No index on fvs_stands (standid, rx, "offset"), sqlite will sort the ' \
+              'table while reading it. To avoid that, run\n    %s' % FVS_STANDS_INDEX
+
+    if ragged:
+        return _prep_db2_ragged(db, conn, climate, verbose, processes, num_periods,
+                                stand_index, mgmt_index, axis_map)
 
-    arr = np.asarray(list4D, dtype=np.float32)
+    shape = (len(stand_index), len(mgmt_index), num_periods, 4)
+    arr, counts = fill_parallel(_fill_fvs_stands, db, conn, list(stand_index), shape,
+                                np.float32, processes, (climate, stand_index, mgmt_index))
+    if verbose:
+        print "%d rows read" % counts.sum()
 
-    # caching
-    np.save('cache.array.%s' % cache, arr)
-    with open('cache.axis_map.%s.json' % cache, 'w') as fh:
-        fh.write(json.dumps(axis_map, indent=2))
-    with open('cache.valid_mgmts.%s.json' % cache, 'w') as fh:
-        fh.write(json.dumps(valid_mgmts, indent=2))
+    valid = counts > 0
+    assert valid.any(axis=1).all()
+    valid_mgmts = [np.nonzero(row)[0].tolist() for row in valid]
 
     return arr, axis_map, valid_mgmts
 
 
+def _prep_db2_ragged(db, conn, climate, verbose, processes, num_periods,
+                     stand_index, mgmt_index, axis_map):
+    """ prep_db2 into a RaggedStandData, reading the (stand, mgmt) pairs first """
+    from .compact import RaggedStandData
+    sql = """SELECT DISTINCT standid, rx, "offset" FROM fvs_stands WHERE climate = ?"""
+    rows = conn.cursor()
+    rows.row_factory = None
+    pairs = np.array([(stand_index[standid], mgmt_index[(rx, offset)])
+                      for standid, rx, offset in rows.execute(sql, (climate,))],
+                     dtype=np.int64).reshape(-1, 2)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    indptr = np.zeros(len(stand_index) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(pairs[:, 0], minlength=len(stand_index)))
+    assert (np.diff(indptr) > 0).all()
+    positions = np.full((len(stand_index), len(mgmt_index)), -1, dtype=np.int64)
+    positions[pairs[:, 0], pairs[:, 1]] = np.arange(len(pairs))
+
+    # one more block, of zeros, for the invalid pairs
+    shape = (len(pairs) + 1, 1, num_periods, 4)
+    arr, counts = fill_parallel(_fill_fvs_stands, db, conn, list(stand_index), shape,
+                                np.float32, processes,
+                                (climate, stand_index, mgmt_index, positions))
+    if verbose:
+        print "%d rows read" % counts.sum()
+
+    data = RaggedStandData(arr[:, 0], indptr, pairs[:, 1], len(mgmt_index))
+    return data, axis_map, list(data.valid_mgmts)
+
+
 def from_geojson_gyb(geojson, gyb_db,
                      standid_field="ID",
-                     condid_field="condid"):
+                     condid_field="condid",
+                     chunk_features=10000,
+                     processes=None,
+                     ragged=False):
     """
     If you expect to run this and just get good results without fully
         understanding this code, you will have a bad time. It is meant as an
@@ -408,79 +693,301 @@ def from_geojson_gyb(geojson, gyb_db,
     Geojson is assumed to be in an equal area projection using meters
       Good start is Albers equal area (epsg 2163) which can be created by:
       ogr2ogr -f GeoJSON -t_srs epsg:2163 stands.geojson stands.shp stands
+    The geojson is read incrementally, chunk_features features at a time,
+        and the Growth-Yield Batch rows for all conditions in bulk, split
+        across a pool of processes when processes > 1.
+    With ragged=True, stand_data is a compact.RaggedStandData holding only
+        the valid mgmts of each stand.
     Returns
         stand_data: 4d array with shape == (nstands, nmgmts, ntimesteps, nvars)
         axis_map: dict with the following keys
             standids : list of standids with length == nstands
             mgmt: list of 2-tuples with (rx, offset as string)
+            acres: list of stand areas with length == nstands
         valid_mgmts : list with length == nstands
+    The number of time periods is the number of distinct years in the database
     """
-    from shapely.geometry import shape
-
     conn = sqlite3.connect(gyb_db)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
-    axis_map = {'mgmt': [], 'standids': []}
-    valid_mgmts = []  # 2D array holding valid mgmt ids for each stand
-    list4D = []
+    axis_map = {'mgmt': [], 'standids': [], 'acres': []}
 
     # Get all unique mgmts
     sql = 'select rx, "offset" from trees_fvsaggregate group by rx, "offset"'
     for row in cursor.execute(sql):
         # mgmt is a tuple of rx and offset
         axis_map['mgmt'].append((row['rx'], row['offset']))
+    mgmt_index = dict((tuple(mgmt), i) for i, mgmt in enumerate(axis_map['mgmt']))
+
+    # Get all unique stands, reading the features a batch at a time
+    condids = []
+    for batch in _batches(iter_geojson_features(geojson), chunk_features):
+        for feat in batch:
+            condids.append(feat['properties'][condid_field])
+            axis_map['standids'].append(feat['properties'][standid_field])
+        # assume sq. meters -> acres
+        axis_map['acres'].extend(_polygons_acres([f['geometry'] for f in batch]).tolist())
+
+    # several stands may share a condition, read each condition once
+    conds = sorted(set(condids))
+    cond_index = dict((cond, i) for i, cond in enumerate(conds))
+
+    sql = """SELECT count(distinct(year)) FROM trees_fvsaggregate
+        WHERE total_stand_carbon is not null"""
+    num_periods = cursor.execute(sql).fetchone()[0]
+
+    shape = (len(conds), len(mgmt_index), num_periods, 3)
+    per_acre, counts = fill_parallel(_fill_trees_fvsaggregate, gyb_db, conn, conds, shape,
+                                     np.float64, processes, (cond_index, mgmt_index))
+
+    # scale each stand's per acre values by its area
+    stand_conds = np.array([cond_index[x] for x in condids], dtype=np.int64)
+    acres = np.array(axis_map['acres'])
+    if ragged:
+        from .compact import RaggedStandData
+        valid = counts[stand_conds] > 0
+        assert valid.any(axis=1).all()
+        pair_stands, pair_mgmts = np.nonzero(valid)
+        indptr = np.zeros(len(condids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(valid.sum(axis=1))
+        # one more block, of zeros, for the invalid pairs
+        values = allocate_array((len(pair_stands) + 1,) + per_acre.shape[2:], np.float32)
+        for start in range(0, len(pair_stands), chunk_features):
+            stop = min(start + chunk_features, len(pair_stands))
+            stands = pair_stands[start:stop]
+            per_stand = per_acre[stand_conds[stands], pair_mgmts[start:stop]]
+            values[start:stop] = per_stand * acres[stands, None, None]
+        data = RaggedStandData(values, indptr, pair_mgmts, len(mgmt_index))
+        return data, axis_map, list(data.valid_mgmts)
+
+    arr = allocate_array((len(condids),) + per_acre.shape[1:], np.float32)
+    for start in range(0, len(condids), chunk_features):
+        stop = start + chunk_features
+        arr[start:stop] = per_acre[stand_conds[start:stop]] * acres[start:stop, None, None, None]
+
+    valid = counts[stand_conds] > 0
+    assert valid.any(axis=1).all()
+    valid_mgmts = [np.nonzero(row)[0].tolist() for row in valid]
+    return arr, axis_map, valid_mgmts
 
-    # Get all unique stands
-    fc = json.loads(open(geojson, 'r').read())
-    for feat in fc['features']:
-        condid = feat['properties'][condid_field]
-        standid = feat['properties'][standid_field]
 
-        geom = shape(feat['geometry'])
-        acres = geom.area / 4046.86  # assume sq. meters -> acres
+def iter_geojson_features(path, buffer_size=1 << 20):
+    """
+    Yield the features of a GeoJSON FeatureCollection one at a time,
+    without loading the whole file
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as fh:
+        buf = fh.read(buffer_size)
+        # find the start of the features array
+        while True:
+            key = buf.find('"features"')
+            bracket = buf.find('[', key) if key >= 0 else -1
+            if bracket >= 0:
+                break
+            more = fh.read(buffer_size)
+            if not more:
+                raise ValueError("%s is not a GeoJSON FeatureCollection" % path)
+            buf += more
+        buf = buf[bracket + 1:]
+
+        while True:
+            pos = 0
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                feature, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the feature continues past the end of the buffer
+                more = fh.read(buffer_size)
+                if not more:
+                    if buf[pos:].strip():
+                        raise
+                    return
+                buf = buf[pos:] + more
+                continue
+            yield feature
+            buf = buf[end:]
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-        temporary_mgmt_list = []
-        list3D = []
-        for i, mgmt in enumerate(axis_map['mgmt']):
-            rx, offset = mgmt
-
-            sql = """SELECT
-                -- Timber
-                removed_merch_bdft / 1000.0 as timber, -- mbf/acre
-                -- Carbon
-                total_stand_carbon as carbon, -- tons/acre
-                -- Fire
-                (CASE WHEN FIREHZD > 3 THEN 1 ELSE 0 END) as fire --binary
-            from trees_fvsaggregate
-            where total_stand_carbon is not null -- remove any blanks
-            and cond = {condid}
-            and rx = {rx}
-            and "offset" = '{offset}'
-            ORDER BY year;
-            """.format(condid=condid, rx=rx, offset=offset)
-
-            list2D = [map(float,
-                          [r['timber'] * acres,
-                           r['carbon'] * acres,
-                           r['fire'] * acres,
-                           ]) for r in cursor.execute(sql)]
-            if list2D == []:
-                list2D = [[0.0] * 3] * 20  # assumes 20 time periods, 3 vars
-            else:
-                temporary_mgmt_list.append(i)
-
-            list3D.append(list2D)
-        list4D.append(list3D)
-        assert len(temporary_mgmt_list) > 0
-        valid_mgmts.append(temporary_mgmt_list)
-        axis_map['standids'].append(standid)
 
-    arr = np.asarray(list4D, dtype=np.float32)
-    return arr, axis_map, valid_mgmts
+def _positions(coords):
+    """ Flatten the nested coordinates of any geojson geometry to (x, y) pairs """
+    if coords and isinstance(coords[0], (int, long, float)):
+        yield tuple(coords[:2])
+    else:
+        for c in coords:
+            for pt in _positions(c):
+                yield pt
+
+
+def _polygons_acres(geometries):
+    """
+    Areas of (Multi)Polygons in acres, assuming sq. meters, computed
+    with the shoelace formula over all of their rings at once
+    """
+    rings = []
+    signs = []  # holes subtract from the area
+    owners = []
+    for i, geometry in enumerate(geometries):
+        polygons = geometry['coordinates']
+        if geometry['type'] == 'Polygon':
+            polygons = [polygons]
+        for polygon in polygons:
+            for r, ring in enumerate(polygon):
+                rings.append(np.asarray(ring, dtype=np.float64)[:, :2])
+                signs.append(1.0 if r == 0 else -1.0)
+                owners.append(i)
+    areas = np.zeros(len(geometries))
+    if not rings:
+        return areas
+
+    lengths = np.array([len(ring) for ring in rings])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    xy = np.concatenate(rings)
+    # each vertex paired with the next one in its ring, wrapping around
+    following = np.arange(1, len(xy) + 1)
+    following[ends - 1] = starts
+    cross = xy[:, 0] * xy[following, 1] - xy[following, 0] * xy[:, 1]
+    ring_areas = np.abs(np.add.reduceat(cross, starts)) / 2.0
+
+    np.add.at(areas, owners, ring_areas * signs)
+    return areas / 4046.86
+
+
+def adjacency_from_geojson(geojson, axis_map, standid_field="ID",
+                           precision=3, min_shared=1):
+    """
+    Stand adjacency graph for the adjacency constraint of schedule()
+
+    Two stands are adjacent when their boundaries share at least
+    `min_shared` vertices, after rounding coordinates to `precision`
+    decimal places. This assumes a clean polygon coverage (shared edges
+    digitized once), which is what most stand layers are.
+    Features are matched to the stand data by axis_map['standids'];
+    acres come from axis_map['acres'] when the prep function recorded
+    them, otherwise from the polygon areas (see from_geojson_gyb).
+    """
+    from .adjacency import AdjacencyGraph
+
+    index = dict((standid, i) for i, standid in enumerate(axis_map['standids']))
+    num_stands = len(index)
+    acres = np.zeros(num_stands)
+
+    # vertex -> stands touching it
+    vertices = {}
+    for batch in _batches(iter_geojson_features(geojson), 10000):
+        batch = [(index.get(f['properties'][standid_field]), f['geometry']) for f in batch]
+        # skip features that are not part of the stand data
+        batch = [(i, geometry) for i, geometry in batch if i is not None]
+        if not batch:
+            continue
+        acres[[i for i, geometry in batch]] = _polygons_acres([g for i, g in batch])
+        for i, geometry in batch:
+            for x, y in set(_positions(geometry['coordinates'])):
+                vertices.setdefault((round(x, precision), round(y, precision)), set()).add(i)
+
+    shared = {}
+    for stands in vertices.values():
+        if len(stands) < 2:
+            continue
+        stands = sorted(stands)
+        for a in range(len(stands)):
+            for b in range(a + 1, len(stands)):
+                pair = (stands[a], stands[b])
+                shared[pair] = shared.get(pair, 0) + 1
+    pairs = [pair for pair, count in shared.items() if count >= min_shared]
 
+    if axis_map.get('acres'):
+        acres = axis_map['acres']
+    return AdjacencyGraph.from_pairs(num_stands, pairs, acres)
 
-def cache_prep(func, cache_dir=".cache"):
+
+def _cache_key(func, args, kwargs):
+    """
+    Hash of the function, its arguments (defaults filled in) and the size
+    and modification time of any arguments that are files
+    """
+    try:
+        call = inspect.getcallargs(func, *args, **kwargs)
+    except TypeError:
+        call = {'args': args, 'kwargs': kwargs}
+    for name in ('cache', 'verbose', 'processes'):
+        # these don't change the result
+        call.pop(name, None)
+    sources = []
+    for name, value in sorted(call.items()):
+        if isinstance(value, string_types) and os.path.isfile(value):
+            stat = os.stat(value)
+            sources.append((name, os.path.abspath(value), stat.st_size, stat.st_mtime))
+    description = json.dumps([func.__module__, func.__name__, sorted(call.items()), sources],
+                             default=repr)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def _evict(cache_dir, max_bytes, keep):
+    """ Remove the least recently used entries until the cache fits in max_bytes """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if len(name) != 40 or not os.path.isdir(path):
+            continue  # not an entry, or one being written
+        try:
+            entries.append((os.path.getmtime(path), _entry_size(path), path))
+        except OSError:
+            pass  # removed by another process
+    total = sum(size for used, size, path in entries)
+    for used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def _save_cached_array(directory, stand_data):
+    """ Save the stand data array, or the arrays of a RaggedStandData """
+    if hasattr(stand_data, 'arrays'):
+        for name, arr in stand_data.arrays().items():
+            np.save(os.path.join(directory, 'ragged-%s.npy' % name), arr)
+    else:
+        np.save(os.path.join(directory, 'array.npy'), stand_data)
+
+
+def _load_array(path):
+    # large arrays are mapped copy-on-write rather than read in
+    return np.load(path, mmap_mode='c' if os.path.getsize(path) > MEMMAP_BYTES else None)
+
+
+def _load_cached_array(directory):
+    """ The stand data saved by _save_cached_array """
+    if not os.path.exists(os.path.join(directory, 'ragged-values.npy')):
+        return _load_array(os.path.join(directory, 'array.npy'))
+    from .compact import RaggedStandData
+    return RaggedStandData.from_arrays(dict(
+        (name, _load_array(os.path.join(directory, 'ragged-%s.npy' % name)))
+        for name in ('values', 'indptr', 'indices', 'num_mgmts')))
+
+
+def cache_prep(func, cache_dir=".cache", max_bytes=None):
     """
     cache the results of a prep function
     Can be used as a decorator or like:
@@ -488,27 +995,55 @@ def cache_prep(func, cache_dir=".cache"):
         func(...)
     And the expensive query results will be cached to disk and
     nearly instantaneous the next time
+
+    Each result is stored under a key made from the function, its arguments
+    and the size and modification time of the input files, so changing any
+    of them (another climate, an updated database) reads from the sources
+    again. Results are written to a temporary directory and renamed into
+    place, so concurrent processes never see a partial entry. If max_bytes
+    is given, the least recently used entries are removed to keep the
+    cache under that size.
     """
+    @functools.wraps(func)
     def caching_func(*args, **kwargs):
-        sdpath = os.path.join(cache_dir, 'array.npy')
-        ampath = os.path.join(cache_dir, 'axis_map.json')
-        vmpath = os.path.join(cache_dir, 'valid_mgmts.json')
+        entry = os.path.join(cache_dir, _cache_key(func, args, kwargs))
+        ampath = os.path.join(entry, 'axis_map.json')
+        vmpath = os.path.join(entry, 'valid_mgmts.json')
         try:
-            stand_data = np.load(sdpath)
+            stand_data = _load_cached_array(entry)
             axis_map = json.loads(open(ampath).read())
             valid_mgmts = json.loads(open(vmpath).read())
+            os.utime(entry, None)  # mark as recently used
             print "Using cached data..."
-        except:
-            print "Querying data from sources ..."
-            stand_data, axis_map, valid_mgmts = func(*args, **kwargs)
-            # cache results to disk
-            if not os.path.exists(cache_dir):
+            return stand_data, axis_map, valid_mgmts
+        except (IOError, OSError, ValueError):
+            pass
+
+        print "Querying data from sources ..."
+        stand_data, axis_map, valid_mgmts = func(*args, **kwargs)
+
+        # cache results to disk
+        if not os.path.exists(cache_dir):
+            try:
                 os.makedirs(cache_dir)
-            np.save(sdpath, stand_data)
-            with open(ampath, 'w') as fh:
+            except OSError:
+                pass  # created concurrently
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+        try:
+            _save_cached_array(tmp, stand_data)
+            with open(os.path.join(tmp, 'axis_map.json'), 'w') as fh:
                 fh.write(json.dumps(axis_map, indent=2))
-            with open(vmpath, 'w') as fh:
+            with open(os.path.join(tmp, 'valid_mgmts.json'), 'w') as fh:
                 fh.write(json.dumps(valid_mgmts, indent=2))
-
+            os.rename(tmp, entry)
+        except OSError:
+            # another process cached the same result first
+            pass
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        if max_bytes is not None:
+            _evict(cache_dir, max_bytes, entry)
         return stand_data, axis_map, valid_mgmts
     return caching_func
@@ -0,0 +1,209 @@
+# encoding: utf-8
+"""
+Progress of an annealing run, published off the annealing loop.
+
+    schedule(..., progress=[RedisSink(), MemorySink()])
+
+Each step's proposed metric, outcome and best metric go into a preallocated
+buffer. At every report interval the buffer is handed to a background thread
+through a bounded queue, and the thread passes it on to each sink as a list
+of (metric, step, type, best_metric) tuples, type being one of 'reject',
+'accept', 'acceptimprove' or 'newbest'. If the queue is full, because a sink
+is slow, the batch is dropped rather than making the annealing loop wait.
+
+A sink is any object with write(batch) and close() methods. Sinks with a
+true main_thread attribute, such as PlotSink (GUI toolkits only draw from
+the main thread), are written from the thread running the schedule instead,
+at the next report after their batch is ready. A sink that raises is warned
+about and written no more.
+"""
+from __future__ import absolute_import
+import json
+import warnings
+import threading
+import traceback
+import numpy as np
+from ._chain import REJECT, ACCEPT, IMPROVE, NEW_BEST
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# batches waiting for the publisher thread before new ones are dropped
+QUEUE_SIZE = 16
+
+STEP_TYPES = {
+    REJECT: 'reject',
+    ACCEPT: 'accept',
+    IMPROVE: 'acceptimprove',
+    NEW_BEST: 'newbest',
+}
+
+_STOP = object()
+
+
+class MemorySink(object):
+    """ Keeps every batch in memory, in self.batches """
+
+    def __init__(self):
+        self.batches = []
+
+    def write(self, batch):
+        self.batches.append(batch)
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """ Appends each batch to a file as a line of JSON """
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+
+    def write(self, batch):
+        if self._fh is None:
+            self._fh = open(self.path, 'a')
+        self._fh.write(json.dumps(batch) + '\n')
+        self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class RedisSink(object):
+    """ Publishes each batch as {'plot_cache': batch} on a redis channel """
+
+    def __init__(self, channel="test_channel", client=None):
+        self.channel = channel
+        self.client = client
+
+    def write(self, batch):
+        if self.client is None:
+            import redis
+            self.client = redis.Redis()
+        self.client.publish(self.channel, json.dumps({'plot_cache': batch}))
+
+    def close(self):
+        pass
+
+
+class PlotSink(object):
+    """
+    Draws the batches with harvestscheduler.plot.AnalogPlot, which (with
+    matplotlib) is only imported once the first batch arrives. It is written
+    from the main thread, see the module docstring.
+    """
+    main_thread = True
+
+    def __init__(self, width):
+        self.width = width
+        self._plot = None
+
+    def write(self, batch):
+        if self._plot is None:
+            from .plot import AnalogPlot
+            self._plot = AnalogPlot(self.width)
+        self._plot.append(batch)
+
+    def close(self):
+        pass
+
+
+class ProgressPublisher(object):
+    """
+    Buffers the steps of an annealing run and publishes them to sinks from
+    a background thread. batch_size steps are buffered before a batch is
+    queued, unless flush() queues them first. dropped counts the batches
+    lost to a full queue.
+    """
+
+    def __init__(self, sinks, batch_size=1000, queue_size=QUEUE_SIZE):
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        # batches ready for the sinks written from the main thread
+        self._main_sinks = [x for x in self.sinks if getattr(x, 'main_thread', False)]
+        self._thread_sinks = [x for x in self.sinks if x not in self._main_sinks]
+        self._ready = queue.Queue(queue_size)
+        self._metrics = np.zeros(batch_size)
+        self._best = np.zeros(batch_size)
+        self._outcomes = np.zeros(batch_size, dtype=np.int8)
+        self._first_step = 0
+        self._pos = 0
+        self._thread = threading.Thread(target=self._run, name='harvestscheduler-progress')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, step, metric, outcome, best):
+        i = self._pos
+        if i == 0:
+            self._first_step = step
+        self._metrics[i] = metric
+        self._outcomes[i] = outcome
+        self._best[i] = best
+        self._pos = i + 1
+        if self._pos == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Queue the buffered steps, or drop them if the queue is full """
+        n = self._pos
+        if not n:
+            return
+        self._pos = 0
+        batch = (self._first_step, self._metrics[:n].copy(), self._outcomes[:n].copy(),
+                 self._best[:n].copy())
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            first_step, metrics, outcomes, best = item
+            batch = [(metric, first_step + i, STEP_TYPES[outcome], best_metric)
+                     for i, (metric, outcome, best_metric)
+                     in enumerate(zip(metrics.tolist(), outcomes.tolist(), best.tolist()))]
+            _write(self._thread_sinks, batch)
+            if self._main_sinks:
+                try:
+                    self._ready.put_nowait(batch)
+                except queue.Full:
+                    self.dropped += 1
+
+    def drain(self):
+        """ Write the batches that are ready to the main thread's sinks, from the main thread """
+        while True:
+            try:
+                batch = self._ready.get_nowait()
+            except queue.Empty:
+                return
+            _write(self._main_sinks, batch)
+
+    def close(self):
+        """ Publish what's buffered, wait for the queue to drain and close the sinks """
+        self.flush()
+        self._queue.put(_STOP)
+        self._thread.join()
+        self.drain()
+        for sink in self.sinks:
+            sink.close()
+
+
+def _write(sinks, batch):
+    """ Write batch to each sink; one that fails is dropped, it must not stop the others """
+    for sink in list(sinks):
+        try:
+            sink.write(batch)
+        except Exception:
+            sinks.remove(sink)
+            warnings.warn("Progress sink %r failed and is no longer written to:\n%s"
+                          % (sink, traceback.format_exc()), RuntimeWarning)
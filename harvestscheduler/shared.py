@@ -0,0 +1,114 @@
+# encoding: utf-8
+"""
+Share one copy of the stand data between processes.
+
+    with share_stand_data(stand_data, valid_mgmts) as shared:
+        parallel_tempering(shared, axis_map, None, ...)
+        # or pool.map(star_schedule, [(shared, axis_map, None, ...), ...])
+
+The 4D array and the packed valid mgmts are written once to memory-mapped
+.npy files (in /dev/shm when available, so they live in RAM). The handle
+is tiny to pickle and every process that attaches maps the same pages.
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import numpy as np
+from .utils import pack_valid_mgmts, stands_per_chunk, PackedValidMgmts
+
+SHM_DIR = '/dev/shm'
+
+
+class SharedStandData(object):
+    """
+    Handle to stand data and valid mgmts in memory-mapped files.
+    Pickling it only sends the directory name.
+    """
+
+    def __init__(self, directory, owner=False):
+        self.directory = directory
+        self.owner = owner
+        self._attached = None
+
+    def attach(self):
+        """
+        Map the shared files (read-only, zero-copy) and return
+        (stand_data, valid_mgmts)
+        """
+        if self._attached is None:
+            def load(name):
+                return np.load(os.path.join(self.directory, name), mmap_mode='r')
+            stand_data = load('stand_data.npy')
+            valid_mgmts = PackedValidMgmts(load('valid_indptr.npy'), load('valid_indices.npy'))
+            self._attached = (stand_data, valid_mgmts)
+        return self._attached
+
+    @property
+    def shape(self):
+        return self.attach()[0].shape
+
+    def unlink(self):
+        """ Remove the shared files; only the process that created them does so """
+        self._attached = None
+        if self.owner and os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+    def __getstate__(self):
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unlink()
+
+
+def share_stand_data(stand_data, valid_mgmts, directory=None):
+    """
+    Copy stand_data and valid_mgmts into memory-mapped files that worker
+    processes can attach to. Returns a SharedStandData handle; call its
+    unlink() (or use it as a context manager) to remove the files.
+    """
+    if directory is None and os.path.isdir(SHM_DIR):
+        directory = SHM_DIR
+    path = tempfile.mkdtemp(prefix='harvestscheduler-', dir=directory)
+
+    out = np.lib.format.open_memmap(os.path.join(path, 'stand_data.npy'), mode='w+',
+                                    dtype=stand_data.dtype, shape=stand_data.shape)
+    chunk = stands_per_chunk(stand_data)
+    for start in range(0, stand_data.shape[0], chunk):
+        out[start:start + chunk] = stand_data[start:start + chunk]
+    out.flush()
+    del out
+
+    indptr, indices = pack_valid_mgmts(valid_mgmts)
+    np.save(os.path.join(path, 'valid_indptr.npy'), indptr)
+    np.save(os.path.join(path, 'valid_indices.npy'), indices)
+
+    return SharedStandData(path, owner=True)
+
+
+def is_stand_data_handle(data):
+    """ Is data a handle (SharedStandData, store.StandDataFile) rather than an array """
+    return hasattr(data, 'attach')
+
+
+def resolve_stand_data(data, valid_mgmts):
+    """
+    Accept either arrays or a handle with an attach() method (SharedStandData,
+    store.StandDataFile), return (data, valid_mgmts).
+    valid_mgmts passed explicitly take precedence over the shared ones.
+    """
+    if is_stand_data_handle(data):
+        shared_data, shared_valid = data.attach()
+        return shared_data, (shared_valid if valid_mgmts is None else valid_mgmts)
+    return data, valid_mgmts
+
+
+def stand_data_bounds(data):
+    """ Theoretical (mins, maxes) stored with the data, or None to compute them """
+    return getattr(data, 'bounds', None)
@@ -0,0 +1,152 @@
+# encoding: utf-8
+"""
+Stopping criteria for schedule().
+
+    schedule(..., steps=None, stopping={'wall_time': 600})
+    schedule(..., stopping={
+        'patience': 20000,          # steps without the best improving ...
+        'tolerance': 0.0,           # ... by more than this
+        'min_acceptance': 0.0005,   # stop once the acceptance rate stays below this ...
+        'acceptance_intervals': 3,  # ... for this many report intervals
+        'wall_time': 600,           # seconds
+        'cpu_time': None,           # seconds of CPU time of this process
+    })
+
+The run ends at whichever comes first: steps or one of the criteria. steps
+may be None under a wall_time or cpu_time budget, which counts from the call
+to schedule(). Under a budget the temperature follows the fraction of the
+budget used, or of the steps if that is further along, so the run still ends
+at temp_min however many steps fit in. The clocks are read every
+CLOCK_INTERVAL steps.
+
+The reason the run stopped is reported to the observers' on_finish as
+'stopped': 'steps', 'patience', 'acceptance', 'wall_time' or 'cpu_time'.
+"""
+from __future__ import absolute_import
+import time
+import numpy as np
+from timeit import default_timer
+
+DEFAULTS = {
+    'patience': None,
+    'tolerance': 0.0,
+    'min_acceptance': None,
+    'acceptance_intervals': 3,
+    'wall_time': None,
+    'cpu_time': None,
+}
+
+# steps between readings of the clocks
+CLOCK_INTERVAL = 16
+
+try:
+    cpu_timer = time.process_time
+except AttributeError:
+    # python 2, where time.clock is the CPU time on unix
+    cpu_timer = time.clock
+
+
+def stopping_config(stopping):
+    """ DEFAULTS updated with the stopping argument of schedule() """
+    config = dict(DEFAULTS)
+    if stopping is not None:
+        if not isinstance(stopping, dict):
+            raise ValueError("stopping should be None or a dict, not %r" % (stopping,))
+        unknown = set(stopping) - set(DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown stopping options %s" % ", ".join(sorted(unknown)))
+        config.update(stopping)
+    for name in ('patience', 'wall_time', 'cpu_time'):
+        if config[name] is not None and config[name] <= 0:
+            raise ValueError("%s should be positive" % name)
+    return config
+
+
+class StoppingCriteria(object):
+    """
+    Decides when schedule() stops, see the module docstring. Call step()
+    after every step and report() at the end of every report interval; each
+    returns the reason to stop, or None to go on. progress is the fraction
+    of the run done, by steps or by budget, whichever is further along.
+    """
+
+    def __init__(self, steps, config):
+        self.steps = steps
+        self.patience = config['patience']
+        self.tolerance = config['tolerance']
+        self.min_acceptance = config['min_acceptance']
+        self.acceptance_intervals = config['acceptance_intervals']
+        self.wall_time = config['wall_time']
+        self.cpu_time = config['cpu_time']
+        self.budgeted = self.wall_time is not None or self.cpu_time is not None
+        if steps is None and not self.budgeted:
+            # without either the temperature has nothing to cool over
+            raise ValueError("steps=None needs a wall_time or cpu_time budget")
+        self.progress = 0.0
+        self._budget_used = 0.0
+        self._reference = None
+        self._improved_at = 0
+        self._low_acceptance = 0
+        self._started = default_timer()
+        self._cpu_started = cpu_timer()
+
+    def step(self, step, best_metric):
+        """ After step (counted from 0) with the current best_metric """
+        steps_done = step + 1
+        if self.steps is not None:
+            self.progress = max(steps_done / float(self.steps), self._budget_used)
+            if steps_done >= self.steps:
+                return 'steps'
+
+        if self.patience is not None:
+            if self._reference is None or best_metric < self._reference - self.tolerance:
+                self._reference = best_metric
+                self._improved_at = steps_done
+            elif steps_done - self._improved_at >= self.patience:
+                return 'patience'
+
+        if self.budgeted and steps_done % CLOCK_INTERVAL == 0:
+            return self._check_budget()
+        return None
+
+    def _check_budget(self):
+        fractions = []
+        if self.wall_time is not None:
+            fractions.append(((default_timer() - self._started) / self.wall_time, 'wall_time'))
+        if self.cpu_time is not None:
+            fractions.append(((cpu_timer() - self._cpu_started) / self.cpu_time, 'cpu_time'))
+        fraction, reason = max(fractions)
+        self._budget_used = fraction
+        self.progress = max(self.progress, fraction)
+        if fraction >= 1:
+            return reason
+        return None
+
+    def report(self, acceptance_rate):
+        """ At the end of a report interval with its acceptance_rate """
+        if self.min_acceptance is None:
+            return None
+        if acceptance_rate < self.min_acceptance:
+            self._low_acceptance += 1
+        else:
+            self._low_acceptance = 0
+        if self._low_acceptance >= self.acceptance_intervals:
+            return 'acceptance'
+        return None
+
+    def get_state(self):
+        """ Progress towards each criterion; the budgets carry over the time used so far """
+        reference = np.nan if self._reference is None else self._reference
+        return {
+            'progress': np.array([self.progress, self._budget_used, reference,
+                                  default_timer() - self._started, cpu_timer() - self._cpu_started]),
+            'counts': np.array([self._improved_at, self._low_acceptance], dtype=np.int64),
+        }
+
+    def set_state(self, state):
+        progress, self._budget_used, reference, wall, cpu = state['progress'].tolist()
+        self.progress = progress
+        self._reference = None if np.isnan(reference) else reference
+        self._started = default_timer() - wall
+        self._cpu_started = cpu_timer() - cpu
+        self._improved_at, self._low_acceptance = state['counts'].tolist()
@@ -0,0 +1,188 @@
+# encoding: utf-8
+"""
+Single-file, memory-mappable storage of prepared stand data.
+
+    save_stand_data('problem.hsd', stand_data, axis_map, valid_mgmts)
+
+    data = StandDataFile('problem.hsd')
+    axis_map = data.axis_map
+    axis_map['variables'] = [...]
+    schedule(data, axis_map, None, ...)
+
+Layout of the file:
+
+    8 bytes   magic, MAGIC
+    8 bytes   length of the header, little endian uint64
+    header    JSON: shape, dtype, axis_map, the theoretical bounds of each
+              variable over the valid mgmts and the offset of each array below
+    indptr    int64, valid mgmts packed CSR style (see utils.pack_valid_mgmts)
+    indices   int32
+    data      the 4D stand data, C order, starting on a page boundary
+
+Opening the file only reads the header; the stand data is memory-mapped so
+only the stands that annealing touches are paged in, and the stored bounds
+spare compile_problem a pass over the whole array.
+"""
+from __future__ import absolute_import
+import os
+import json
+import struct
+import numpy as np
+from .utils import pack_valid_mgmts, stands_per_chunk, valid_mgmt_mask, PackedValidMgmts
+from ._objective import stand_bounds
+
+MAGIC = b'HSCHED\x00\x01'
+PREFIX = len(MAGIC) + 8
+
+# the stand data starts on a page boundary
+ALIGNMENT = 4096
+
+
+def _align(offset, alignment):
+    return -(-offset // alignment) * alignment
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def save_stand_data(path, stand_data, axis_map, valid_mgmts):
+    """
+    Write stand data, its axis_map and valid_mgmts to a single file at path.
+    The stand data is copied a chunk of stands at a time, so it may itself
+    be memory-mapped. The file is written under a temporary name and renamed
+    into place.
+    """
+    stand_data = np.asanyarray(stand_data)
+    num_stands, num_mgmts, num_periods, num_variables = stand_data.shape
+    indptr, indices = pack_valid_mgmts(valid_mgmts)
+    assert len(indptr) == num_stands + 1
+
+    header = {
+        'version': 1,
+        'shape': list(stand_data.shape),
+        'dtype': stand_data.dtype.str,
+        'axis_map': axis_map,
+    }
+    chunk = stands_per_chunk(stand_data)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        # reserve room for the header, it's filled in once the bounds are known
+        header_size = 0
+        while True:
+            indptr_offset = _align(PREFIX + header_size, 64)
+            indices_offset = _align(indptr_offset + indptr.nbytes, 64)
+            data_offset = _align(indices_offset + indices.nbytes, ALIGNMENT)
+            header['offsets'] = {'indptr': indptr_offset, 'indices': indices_offset,
+                                 'data': data_offset}
+            # placeholders as wide as the JSON of any float
+            widest = [-1.2345678901234567e-300] * num_variables
+            header['bounds'] = {'mins': widest, 'maxes': widest}
+            text = json.dumps(header, default=_json_default).encode('utf-8')
+            if len(text) <= header_size:
+                break
+            header_size = len(text)
+
+        fh.seek(indptr_offset)
+        fh.write(indptr.astype('<i8').tobytes())
+        fh.seek(indices_offset)
+        fh.write(indices.astype('<i4').tobytes())
+
+        # copy the stand data, accumulating the theoretical bounds over the
+        # valid mgmts as we go
+        valid = valid_mgmt_mask(PackedValidMgmts(indptr, indices), num_mgmts)
+        mins = np.zeros(num_variables)
+        maxes = np.zeros(num_variables)
+        fh.seek(data_offset)
+        for start in range(0, num_stands, chunk):
+            block = np.ascontiguousarray(stand_data[start:start + chunk])
+            block_mins, block_maxes = stand_bounds(block.sum(axis=2),
+                                                   valid[start:start + chunk])
+            mins += block_mins
+            maxes += block_maxes
+            fh.write(block.tobytes())
+
+        header['bounds'] = {'mins': mins.tolist(), 'maxes': maxes.tolist()}
+        text = json.dumps(header, default=_json_default).encode('utf-8')
+        assert len(text) <= header_size
+        fh.seek(0)
+        fh.write(MAGIC)
+        fh.write(struct.pack('<Q', header_size))
+        fh.write(text.ljust(header_size))
+    os.rename(tmp, path)
+
+
+def read_header(path):
+    """ The JSON header of a stand data file, as a dict """
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a stand data file" % path)
+        header_size, = struct.unpack('<Q', fh.read(8))
+        return json.loads(fh.read(header_size).decode('utf-8'))
+
+
+class StandDataFile(object):
+    """
+    Handle to a file written by save_stand_data. Accepted as data by
+    schedule() and parallel_tempering(), in which case valid_mgmts may be
+    None to use the stored ones. Pickling it only sends the path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self._attached = None
+
+    @property
+    def shape(self):
+        return tuple(self.header['shape'])
+
+    @property
+    def axis_map(self):
+        """ A fresh copy of the stored axis_map, with mgmts as (rx, offset) tuples """
+        axis_map = json.loads(json.dumps(self.header['axis_map']))
+        if 'mgmt' in axis_map:
+            axis_map['mgmt'] = [tuple(x) for x in axis_map['mgmt']]
+        return axis_map
+
+    @property
+    def bounds(self):
+        """ The theoretical (mins, maxes) of each variable """
+        bounds = self.header['bounds']
+        return np.array(bounds['mins']), np.array(bounds['maxes'])
+
+    def attach(self):
+        """
+        Memory-map the file (read-only) and return (stand_data, valid_mgmts)
+        """
+        if self._attached is None:
+            offsets = self.header['offsets']
+            num_stands = self.shape[0]
+            indptr = np.memmap(self.path, dtype='<i8', mode='r',
+                               offset=offsets['indptr'], shape=(num_stands + 1,))
+            num_indices = int(indptr[-1])
+            if num_indices:
+                indices = np.memmap(self.path, dtype='<i4', mode='r',
+                                    offset=offsets['indices'], shape=(num_indices,))
+            else:
+                indices = np.zeros(0, dtype=np.int32)
+            stand_data = np.memmap(self.path, dtype=np.dtype(self.header['dtype']), mode='r',
+                                   offset=offsets['data'], shape=self.shape)
+            self._attached = (stand_data, PackedValidMgmts(indptr, indices))
+        return self._attached
+
+    def load(self):
+        """ Read everything into memory, returns (stand_data, axis_map, valid_mgmts) """
+        stand_data, valid_mgmts = self.attach()
+        return np.array(stand_data), self.axis_map, list(valid_mgmts)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
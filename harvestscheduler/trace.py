@@ -0,0 +1,154 @@
+# encoding: utf-8
+"""
+Binary trace of an annealing run, for convergence analysis after the fact.
+
+    schedule(data, axis_map, valid_mgmts, trace='trace.npy')
+
+    trace = np.load('trace.npy')
+    trace['step'], trace['metric'], trace['best'], trace['components'],
+    trace['outcome'], trace['temp']
+
+Steps are recorded into a preallocated structured buffer and written to a
+.npy file a buffer at a time, so the annealing loop does no text formatting
+or per-step I/O. outcome is one of the codes in OUTCOMES. Pass a
+TraceRecorder instead of a path to only keep every Nth step, or only
+accepted moves or new bests.
+"""
+from __future__ import absolute_import
+import numpy as np
+from ._chain import REJECT, ACCEPT, IMPROVE, NEW_BEST
+
+# outcome codes, as in the text log
+OUTCOMES = {
+    REJECT: 'reject',
+    ACCEPT: 'accept',
+    IMPROVE: 'accept+improve',
+    NEW_BEST: 'new best',
+}
+
+# steps held in memory before they are written out
+BUFFER_SIZE = 1 << 16
+
+MAGIC = b'\x93NUMPY\x01\x00'
+
+# room left in the header for the final number of steps
+SHAPE_DIGITS = 20
+
+
+def trace_dtype(num_variables):
+    return np.dtype([
+        ('step', np.int64),
+        ('metric', np.float64),
+        ('best', np.float64),
+        ('components', np.float64, (num_variables,)),
+        ('outcome', np.int8),
+        ('temp', np.float64),
+    ])
+
+
+def _npy_header(dtype, length, size=None):
+    """ A version 1.0 .npy header for a 1D array, padded to size bytes """
+    text = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(dtype), length)
+    if size is None:
+        # the data starts on a 64 byte boundary whatever the final length is
+        size = len(MAGIC) + 2 + len(text) + SHAPE_DIGITS + 1
+        size += -size % 64
+    text = text.ljust(size - len(MAGIC) - 2 - 1) + '\n'
+    assert len(MAGIC) + 2 + len(text) == size
+    return MAGIC + np.array([len(text)], dtype='<u2').tobytes() + text.encode('latin1')
+
+
+class TraceRecorder(object):
+    """
+    Records the steps of an annealing run to a .npy file at path.
+
+    every keeps only every Nth step, and min_outcome only the steps with at
+    least that outcome (ACCEPT for accepted moves, NEW_BEST for new bests).
+    Like metric, components describe the proposed configuration of each
+    step, accepted or not: the weighted contribution of each variable to
+    its metric, before any adjacency penalty, passed in compiled order (see
+    CompiledProblem.order).
+    """
+
+    def __init__(self, path, every=1, min_outcome=REJECT, buffer_size=BUFFER_SIZE):
+        self.path = path
+        self.every = every
+        self.min_outcome = min_outcome
+        self.buffer_size = buffer_size
+        self.length = 0
+        self._fh = None
+
+    def open(self, problem, length=0):
+        """
+        Start the file for a CompiledProblem's variables, or with length,
+        continue it after its first length steps, dropping any after them
+        """
+        self.dtype = trace_dtype(problem.num_variables)
+        self._order = problem.order[:problem.num_terms]
+        self._buffer = np.zeros(self.buffer_size, dtype=self.dtype)
+        self._terms = np.zeros((self.buffer_size, problem.num_terms))
+        self._pos = 0
+        # views of each column, assigned a value at a time
+        self._step = self._buffer['step']
+        self._metric = self._buffer['metric']
+        self._best = self._buffer['best']
+        self._outcome = self._buffer['outcome']
+        self._temp = self._buffer['temp']
+
+        self._header = _npy_header(self.dtype, 0)
+        if length:
+            self._fh = open(self.path, 'r+b')
+            self._fh.truncate(len(self._header) + length * self.dtype.itemsize)
+            self._fh.seek(0, 2)
+        else:
+            self._fh = open(self.path, 'wb')
+            self._fh.write(self._header)
+        self.length = length
+        return self
+
+    def record(self, step, metric, best, components, outcome, temp):
+        if step % self.every or outcome < self.min_outcome:
+            return
+        i = self._pos
+        self._step[i] = step
+        self._metric[i] = metric
+        self._best[i] = best
+        self._terms[i] = components
+        self._outcome[i] = outcome
+        self._temp[i] = temp
+        self._pos = i + 1
+        if self._pos == self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered steps to the file """
+        n = self._pos
+        if n:
+            chunk = self._buffer[:n]
+            chunk['components'][:, self._order] = self._terms[:n]
+            self._fh.write(chunk.tobytes())
+            self.length += n
+            self._pos = 0
+        self._fh.flush()
+
+    def close(self):
+        """ Write out what's left and the final number of steps """
+        if self._fh is None:
+            return
+        self.flush()
+        self._fh.seek(0)
+        self._fh.write(_npy_header(self.dtype, self.length, len(self._header)))
+        self._fh.close()
+        self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_trace(path, mmap_mode=None):
+    """ The trace as a structured array, see trace_dtype """
+    return np.load(path, mmap_mode=mmap_mode)
@@ -1,3 +1,8 @@
+import numpy as np
+
+# bytes of stand data handled at a time by the chunked passes over it
+CHUNK_BYTES = 64 * 1024 * 1024
+
 
 # Report results
 def print_results(axis_map, vars_over_time):
@@ -31,7 +36,72 @@ def star_schedule(args):
     so we make that one argument a tuple of args and expand it with
     this wrapper function
     """
-    from scheduler import schedule
+    from harvestscheduler import schedule
     return schedule(*args)
 
 
+def stands_per_chunk(arr):
+    """ How many stands of arr (stands first) fit in CHUNK_BYTES, at least one """
+    return max(1, CHUNK_BYTES // max(1, arr[:1].nbytes))
+
+
+def pack_valid_mgmts(valid_mgmts):
+    """
+    Pack the list of valid mgmt ids for each stand into two flat arrays,
+    CSR style: the mgmts of stand s are indices[indptr[s]:indptr[s + 1]].
+    An empty list (any mgmt is valid) packs to an empty row.
+    """
+    indptr = np.zeros(len(valid_mgmts) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(x) for x in valid_mgmts])
+    indices = np.zeros(indptr[-1], dtype=np.int32)
+    for s, mgmts in enumerate(valid_mgmts):
+        indices[indptr[s]:indptr[s + 1]] = mgmts
+    return indptr, indices
+
+
+def stand_mgmts(valid_mgmts, stand, num_mgmts):
+    """
+    The valid mgmts of a stand as a list, all num_mgmts of them when its
+    list is empty
+    """
+    valid = valid_mgmts[stand]
+    if len(valid):
+        return list(valid)
+    return list(range(num_mgmts))
+
+
+class PackedValidMgmts(object):
+    """
+    Read-only list of valid mgmts for each stand backed by packed arrays,
+    usable anywhere the list of lists from prep_data is expected
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, stand):
+        return self.indices[self.indptr[stand]:self.indptr[stand + 1]].tolist()
+
+    def __iter__(self):
+        for stand in range(len(self)):
+            yield self[stand]
+
+
+def valid_mgmt_mask(valid_mgmts, num_mgmts):
+    """
+    Boolean (stands x mgmts) array, True for the valid mgmts of each stand
+    and for every mgmt of a stand with an empty list
+    """
+    if isinstance(valid_mgmts, PackedValidMgmts):
+        indptr, indices = valid_mgmts.indptr, valid_mgmts.indices
+    else:
+        indptr, indices = pack_valid_mgmts(valid_mgmts)
+    counts = np.diff(indptr)
+    mask = np.zeros((len(counts), num_mgmts), dtype=bool)
+    mask[np.repeat(np.arange(len(counts)), counts), indices] = True
+    mask[counts == 0] = True
+    return mask
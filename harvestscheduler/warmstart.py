@@ -0,0 +1,106 @@
+# encoding: utf-8
+"""
+Constructive starting configurations for schedule().
+
+    schedule(..., warm_start='greedy', polish=1)
+
+greedy_mgmts builds a configuration one stand at a time. Stands not yet
+assigned count at the mean of their mgmts, so the objective is always
+scored on totals of the full size and bounds and targets keep their
+meaning. Stands are taken in order of impact, the spread between their
+best and worst mgmts relative to each variable's theoretical range, and
+each is given the mgmt that scores best on the compiled objective. The big
+decisions are made first and the small stands fill in around them.
+
+polish_mgmts is local descent: each stand in turn moves to its best mgmt
+given all the others, for a number of passes over the stands or until a
+pass moves none.
+
+Both score every candidate mgmt of a stand at once with the same
+incremental aggregates the annealing uses.
+"""
+from __future__ import absolute_import
+import numpy as np
+from ._objective import IncrementalObjective
+from .utils import stand_mgmts
+
+WARM_STARTS = (None, 'random', 'greedy')
+
+
+def impact_order(data, valid_mgmts, problem):
+    """
+    Stands ordered by the spread between their mgmts, largest first, and
+    the totals (time periods x variables) with every stand at the mean of
+    its mgmts. Each variable's spread counts by its weight over its
+    theoretical range.
+    """
+    num_stands, num_mgmts, num_periods, num_variables = data.shape
+    ranges = problem.theoretical_maxes - problem.theoretical_mins
+    # variables with no variation have no impact
+    scales = np.where(ranges > 0, problem.weights / np.where(ranges > 0, ranges, 1), 0)
+    impact = np.zeros(num_stands)
+    mean_totals = np.zeros((num_periods, num_variables))
+    for stand in range(num_stands):
+        block = data[stand, stand_mgmts(valid_mgmts, stand, num_mgmts)]
+        mean_totals += block.mean(axis=0)
+        totals = block.sum(axis=1)
+        impact[stand] = ((totals.max(axis=0) - totals.min(axis=0)) * scales).sum()
+    return np.argsort(-impact, kind='mergesort').tolist(), mean_totals
+
+
+def greedy_mgmts(data, valid_mgmts, problem):
+    """
+    A starting mgmt for each stand, assigned greedily in impact_order
+    against the CompiledProblem problem
+    """
+    num_stands, num_mgmts = data.shape[:2]
+    order, mean_totals = impact_order(data, valid_mgmts, problem)
+    objective = IncrementalObjective(problem, mean_totals)
+    mgmts = [None] * num_stands
+    for stand in order:
+        candidates = stand_mgmts(valid_mgmts, stand, num_mgmts)
+        # from the stand's mean to each of its mgmts
+        block = data[stand, candidates]
+        diffs = block - block.mean(axis=0)
+        chosen = int(np.argmin(objective.evaluate_batch(diffs))) if len(candidates) > 1 else 0
+        objective.evaluate(diffs[chosen])
+        objective.commit()
+        mgmts[stand] = candidates[chosen]
+    return mgmts
+
+
+def polish_mgmts(data, valid_mgmts, objective, mgmts, adjacency=None, passes=1):
+    """
+    Local descent from mgmts, changed in place along with the objective's
+    aggregates (and adjacency's clumps, if given). Returns the number of
+    stands moved.
+    """
+    num_stands, num_mgmts = data.shape[:2]
+    moved = 0
+    for _ in range(passes):
+        moved_in_pass = 0
+        for stand in range(num_stands):
+            candidates = stand_mgmts(valid_mgmts, stand, num_mgmts)
+            if len(candidates) < 2:
+                continue
+            old_mgmt = mgmts[stand]
+            diffs = data[stand, candidates] - data[stand, old_mgmt]
+            deltas = objective.evaluate_batch(diffs) - objective.metric
+            if adjacency is not None:
+                deltas += [adjacency.evaluate(stand, old_mgmt, mgmt) - adjacency.penalty
+                           for mgmt in candidates]
+            chosen = int(np.argmin(deltas))
+            new_mgmt = candidates[chosen]
+            if new_mgmt == old_mgmt or deltas[chosen] >= 0:
+                continue
+            objective.evaluate(diffs[chosen])
+            objective.commit()
+            if adjacency is not None:
+                adjacency.evaluate(stand, old_mgmt, new_mgmt)
+                adjacency.commit()
+            mgmts[stand] = new_mgmt
+            moved_in_pass += 1
+        moved += moved_in_pass
+        if not moved_in_pass:
+            break
+    return moved
@@ -0,0 +1,29 @@
+"""
+Fixtures shared by the tests
+"""
+import numpy as np
+import pytest
+from harvestscheduler.adjacency import AdjacencyGraph
+
+
+@pytest.fixture
+def variables():
+    """ axis_map['variables'] with an evenflow, a maximized and a minimized variable """
+    return [
+        {'name': 'a', 'strategy': 'evenflow', 'weight': 1.0},
+        {'name': 'b', 'strategy': 'cumulative_maximize', 'weight': 1.0},
+        {'name': 'c', 'strategy': 'cumulative_minimize', 'weight': 1.0},
+    ]
+
+
+@pytest.fixture
+def grid_graph():
+    """
+    grid_graph(side) is the AdjacencyGraph of a side x side grid of stands,
+    each adjacent to the stands on each side, of 5 to 25 acres
+    """
+    def make(side):
+        pairs = ([(i, i + 1) for i in range(side * side) if (i + 1) % side] +
+                 [(i, i + side) for i in range(side * (side - 1))])
+        return AdjacencyGraph.from_pairs(side * side, pairs, np.linspace(5, 25, side * side))
+    return make
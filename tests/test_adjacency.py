@@ -0,0 +1,133 @@
+"""
+Tests for the maximum harvest clump (adjacency) constraint
+"""
+import json
+import random
+import pytest
+import numpy as np
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.adjacency import AdjacencyGraph, ClumpPenalty, clump_penalty
+from harvestscheduler._objective import IncrementalObjective, compile_problem
+
+# stands on a 10 x 10 grid, see the grid_graph fixture
+SIDE = 10
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(SIDE * SIDE, 6, 8, 3)
+
+
+def full_excess(graph, harvested, max_clump):
+    """ Violating acres, found with a fresh flood fill of every period """
+    excess = 0.0
+    for p in range(harvested.shape[1]):
+        seen = set()
+        for start in np.nonzero(harvested[:, p])[0]:
+            if start in seen:
+                continue
+            stack, size = [start], 0.0
+            seen.add(start)
+            while stack:
+                stand = stack.pop()
+                size += graph.acres[stand]
+                for n in graph.neighbors(stand):
+                    if harvested[n, p] and n not in seen:
+                        seen.add(n)
+                        stack.append(n)
+            excess += max(0.0, size - max_clump)
+    return excess
+
+
+def test_from_pairs():
+    graph = AdjacencyGraph.from_pairs(4, [(0, 1), (2, 1), (1, 0), (3, 3)], [1, 2, 3, 4])
+    assert graph.neighbors(0).tolist() == [1]
+    assert graph.neighbors(1).tolist() == [0, 2]
+    assert graph.neighbors(3).tolist() == []
+
+
+def test_incremental_clumps_match_full(grid_graph):
+    graph = grid_graph(SIDE)
+    penalty = ClumpPenalty(graph, STAND_DATA, 1, max_clump=60.0, threshold=9)
+    rng = random.Random(1)
+    mgmts = [rng.randrange(6) for x in range(SIDE * SIDE)]
+    penalty.reset(mgmts)
+
+    stand_range = np.arange(SIDE * SIDE)
+    for i in range(300):
+        stand = rng.randrange(SIDE * SIDE)
+        new_mgmt = rng.randrange(6)
+        proposed = penalty.evaluate(stand, mgmts[stand], new_mgmt)
+        if rng.random() < 0.5:
+            continue  # rejected, nothing should change
+        penalty.commit()
+        mgmts[stand] = new_mgmt
+        harvested = STAND_DATA[stand_range, mgmts, :, 1] > 9
+        expected = full_excess(graph, harvested, 60.0)
+        assert np.isclose(penalty.excess, expected)
+        assert np.isclose(proposed, penalty.scale * expected)
+    # rebuilding from scratch agrees with the incremental state
+    assert np.isclose(penalty.penalty, penalty.reset(mgmts))
+
+
+def test_schedule_adjacency(grid_graph):
+    axis_map = AXIS_MAP.copy()
+    axis_map['variables'] = [
+        {'name': 'timber', 'strategy': 'cumulative_maximize', 'weight': 1.0},
+        {'name': 'harvest', 'strategy': 'cumulative_maximize', 'weight': 1.0},
+        {'name': 'cost proxy', 'strategy': 'cumulative_minimize', 'weight': 1.0},
+    ]
+    adjacency = {
+        'graph': grid_graph(SIDE),
+        'variable': 'harvest',
+        'max_clump': 40,
+        'weight': 5.0,
+        'threshold': 9,
+    }
+    best, mgmts, vars_over_time = schedule(
+        STAND_DATA, axis_map, VALID_MGMTS, steps=3000, report_interval=1000,
+        adjacency=adjacency, move_mode='heatbath')
+
+    # the reported best includes the penalty of the returned mgmts
+    check = ClumpPenalty(adjacency['graph'], STAND_DATA, 1, 40, weight=5.0, threshold=9)
+    totals = STAND_DATA[np.arange(SIDE * SIDE), mgmts].sum(axis=0)
+    objective = IncrementalObjective(compile_problem(STAND_DATA, axis_map), totals)
+    assert np.isclose(best, objective.metric + check.reset(mgmts))
+
+    # and the constraint keeps clumps smaller than an unconstrained run
+    unconstrained = schedule(
+        STAND_DATA, axis_map, VALID_MGMTS, steps=3000, report_interval=1000,
+        move_mode='heatbath')[1]
+    assert check.reset(mgmts) < check.reset(unconstrained)
+
+
+def test_clump_penalty_variable(grid_graph):
+    axis_map = dict(AXIS_MAP, variables=[{'name': name} for name in ('a', 'b', 'c')])
+    graph = grid_graph(SIDE)
+    # by name or by index, numpy integers included
+    for variable in ('c', 2, np.int64(2)):
+        adjacency = {'graph': graph, 'variable': variable, 'max_clump': 40}
+        penalty = clump_penalty(STAND_DATA, axis_map, adjacency)
+        assert penalty.variable == 2 and type(penalty.variable) is int
+    adjacency = {'graph': graph, 'variable': 'd', 'max_clump': 40}
+    with pytest.raises(ValueError):
+        clump_penalty(STAND_DATA, axis_map, adjacency)
+
+
+def test_adjacency_from_geojson(tmpdir):
+    # 3 x 2 grid of 100m squares, one hectare each
+    features = []
+    for i in range(6):
+        x, y = (i % 3) * 100.0, (i // 3) * 100.0
+        ring = [[x, y], [x + 100, y], [x + 100, y + 100], [x, y + 100], [x, y]]
+        features.append({'type': 'Feature', 'properties': {'ID': 'stand%d' % i},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    path = str(tmpdir.join('stands.geojson'))
+    with open(path, 'w') as fh:
+        json.dump({'type': 'FeatureCollection', 'features': features}, fh)
+
+    axis_map = {'standids': ['stand%d' % i for i in range(6)]}
+    graph = prep_data.adjacency_from_geojson(path, axis_map, min_shared=2)
+    assert graph.neighbors(0).tolist() == [1, 3]
+    assert graph.neighbors(4).tolist() == [1, 3, 5]
+    assert np.allclose(graph.acres, 10000 / 4046.86)
+
+    # corners count as adjacent when a single shared vertex is enough
+    graph = prep_data.adjacency_from_geojson(path, axis_map)
+    assert graph.neighbors(0).tolist() == [1, 3, 4]
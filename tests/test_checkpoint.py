@@ -0,0 +1,105 @@
+"""
+Tests for checkpointing and resuming a run
+"""
+import os
+import numpy as np
+import pytest
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.checkpoint import Checkpointer, load_checkpoint
+from harvestscheduler.observers import Observer, CallbackObserver
+from harvestscheduler.trace import load_trace
+
+# stands on an 8 x 8 grid, see the grid_graph fixture
+SIDE = 8
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(SIDE * SIDE, 6, 6, 3)
+AXIS_MAP = dict(AXIS_MAP, variables=[
+    {'name': 'a', 'strategy': 'evenflow', 'weight': 1.0},
+    {'name': 'harvest', 'strategy': 'cumulative_maximize', 'weight': 1.0},
+    {'name': 'c', 'strategy': 'within_bounds', 'weight': 1.0, 'targets': (20, 40)},
+])
+
+
+class Preempted(Exception):
+    pass
+
+
+class Preempt(Observer):
+    """ Interrupts the run at the end of the report interval ending at step """
+
+    def __init__(self, step):
+        self.step = step
+
+    def on_report(self, stats):
+        if stats['step'] == self.step:
+            raise Preempted()
+
+
+def run(tmpdir, name, **kwargs):
+    args = dict(steps=6000, report_interval=500, seed=7, observers=[],
+                trace=str(tmpdir.join(name + '.npy')), logfile=str(tmpdir.join(name + '.log')))
+    args.update(kwargs)
+    return schedule(STAND_DATA, AXIS_MAP, VALID_MGMTS, **args)
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'move_mode': 'heatbath',
+     'adjacency': {'variable': 'harvest', 'max_clump': 40, 'threshold': 9}},
+    {'temp_max': 'auto', 'cooling': {'interval': 50, 'reheat_after': 300},
+     'stopping': {'patience': 10 ** 5}},
+])
+def test_resume_is_exact(tmpdir, grid_graph, options):
+    if 'adjacency' in options:
+        options = dict(options, adjacency=dict(options['adjacency'], graph=grid_graph(SIDE)))
+    best, mgmts, vars_over_time = run(tmpdir, 'whole', **options)
+
+    path = str(tmpdir.join('run.ckpt'))
+    with pytest.raises(Preempted):
+        # the last checkpoint is at 3000 steps, 3500 are run
+        run(tmpdir, 'parts', checkpoint=Checkpointer(path, every=1000),
+            observers=[Preempt(3500)], **options)
+    assert int(load_checkpoint(path)['run.step']) == 3000
+    starts = []
+    resumed = run(tmpdir, 'parts', checkpoint=path, resume=path,
+                  observers=[CallbackObserver(on_start=starts.append)], **options)
+    assert starts[0]['resumed_at'] == 3000
+
+    assert resumed[0] == best
+    assert resumed[1] == mgmts
+    assert np.array_equal(resumed[2], vars_over_time)
+    whole = load_trace(str(tmpdir.join('whole.npy')))
+    parts = load_trace(str(tmpdir.join('parts.npy')))
+    assert len(parts) == 6000 and np.array_equal(whole, parts)
+    assert tmpdir.join('whole.log').read() == tmpdir.join('parts.log').read()
+
+
+def test_checkpoint_contents(tmpdir):
+    path = str(tmpdir.join('run.ckpt'))
+    run(tmpdir, 'run', steps=2000, checkpoint=Checkpointer(path, every=500), trace=None)
+    # written at every report interval but the last, atomically
+    assert sorted(os.listdir(str(tmpdir))) == ['run.ckpt', 'run.log']
+    state = load_checkpoint(path)
+    assert int(state['run.step']) == 1500
+    assert state['mgmts'].shape == (SIDE * SIDE,)
+    # no copy of the stand data
+    assert sum(x.nbytes for x in state.values()) < STAND_DATA.nbytes
+
+
+def test_resume_checks_arguments(tmpdir):
+    path = str(tmpdir.join('run.ckpt'))
+    run(tmpdir, 'run', steps=2000, checkpoint=Checkpointer(path, seconds=0))
+    with pytest.raises(ValueError):
+        run(tmpdir, 'run', steps=3000, resume=path)
+    with pytest.raises(ValueError):
+        run(tmpdir, 'run', checkpoint=Checkpointer(path, every=750))
+
+
+def test_sampler_state():
+    from harvestscheduler._sampler import ProposalSampler
+    for skip in (0, 5, 16, 23):
+        sampler = ProposalSampler(VALID_MGMTS, 6, seed=3, block_size=8)
+        for i in range(skip):
+            sampler.draw()
+        copy = ProposalSampler(VALID_MGMTS, 6, block_size=8)
+        copy.set_state(sampler.get_state())
+        assert [copy.draw() for i in range(20)] == [sampler.draw() for i in range(20)]
@@ -0,0 +1,114 @@
+"""
+Tests for the compact stand data layouts, quantized and ragged
+"""
+import pickle
+import numpy as np
+import pytest
+from harvestscheduler import prep_data, schedule
+from harvestscheduler.compact import quantize_stand_data, ragged_stand_data
+from harvestscheduler._objective import IncrementalObjective, compile_problem
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(50, 6, 8, 3)
+
+
+@pytest.fixture
+def axis_map(variables):
+    return dict(AXIS_MAP, variables=variables)
+
+
+def test_integers_are_exact(axis_map):
+    data = quantize_stand_data(STAND_DATA)
+    assert data.values.dtype == np.int16
+    assert data.scales.tolist() == [1.0, 1.0, 1.0]
+    assert data.nbytes < STAND_DATA.nbytes / 3
+    assert (data.decode() == STAND_DATA).all()
+    # indexed like the array it replaces
+    stands = np.arange(50)
+    mgmts = [s % 6 for s in stands]
+    for key in [(3, 2), (3, [1, 4]), (stands, mgmts), (slice(None), 1, 0, 2),
+                (3, 2, slice(1, 4), slice(0, 2)), (Ellipsis, 1), (stands, mgmts, 0, stands % 3)]:
+        assert data[key].dtype == np.float64
+        assert (data[key] == STAND_DATA[key]).all()
+
+    # the same seeded run as the original array
+    result = schedule(data, axis_map, VALID_MGMTS, steps=2000, report_interval=1000, seed=1)
+    expected = schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=2000, report_interval=1000,
+                        seed=1)
+    assert result[0] == expected[0] and result[1] == expected[1]
+
+
+def test_quantized_floats(monkeypatch, axis_map):
+    from harvestscheduler import utils
+    stand_data = STAND_DATA * np.array([0.013, 1000.7, -3.3])
+    monkeypatch.setattr(utils, 'CHUNK_BYTES', stand_data[:7].nbytes)
+    for dtype in (np.int16, np.int32, np.float32):
+        data = quantize_stand_data(stand_data, dtype)
+        assert data.values.dtype == dtype
+        error = np.abs(data.decode() - stand_data).max(axis=(0, 1, 2))
+        if dtype == np.float32:
+            assert (error <= np.abs(stand_data).max() * 1e-6).all()
+        else:
+            assert (error <= data.scales / 2 + 1e-12).all()
+    data = pickle.loads(pickle.dumps(quantize_stand_data(stand_data)))
+
+    # the reported objective matches the original data within a tolerance
+    best, mgmts, vars_over_time = schedule(data, axis_map, VALID_MGMTS, steps=2000,
+                                           report_interval=1000, seed=2)
+    totals = stand_data[np.arange(50), mgmts].sum(axis=0)
+    objective = IncrementalObjective(compile_problem(stand_data, axis_map), totals)
+    assert np.isclose(best, objective.metric, rtol=1e-3)
+    assert np.allclose(vars_over_time, totals, rtol=1e-3)
+
+
+def test_ragged(axis_map):
+    valid_mgmts = [[0, 2, 5], [], [4]] + [[1, 3]] * 47
+    data = ragged_stand_data(STAND_DATA, valid_mgmts)
+    assert data.shape == STAND_DATA.shape
+    assert len(data.values) == 3 + 6 + 1 + 2 * 47 + 1
+    assert list(data.valid_mgmts) == [[0, 2, 5], list(range(6)), [4]] + [[1, 3]] * 47
+
+    # valid pairs read like the dense array, invalid ones as zeros
+    dense = STAND_DATA.copy()
+    for s, mgmts in enumerate(valid_mgmts):
+        if mgmts:
+            dense[s, [m for m in range(6) if m not in mgmts]] = 0
+    assert (data.decode() == dense).all()
+    stands = np.arange(50)
+    mgmts = [s % 6 for s in stands]
+    for key in [(3, 3), (0, [0, 2, 5]), (stands, mgmts), (stands, mgmts, slice(None), 1), 7]:
+        assert (data[key] == dense[key]).all()
+
+    # bounds over the valid mgmts only
+    totals = STAND_DATA.sum(axis=2)
+    expected = [[totals[s, m or range(6)].min(axis=0), totals[s, m or range(6)].max(axis=0)]
+                for s, m in enumerate(valid_mgmts)]
+    mins, maxes = np.sum(expected, axis=0)
+    assert np.allclose(data.bounds[0], mins) and np.allclose(data.bounds[1], maxes)
+
+    copy = pickle.loads(pickle.dumps(data))
+    assert (copy.decode() == dense).all()
+
+    best, result, vars_over_time = schedule(data, axis_map, None, steps=2000,
+                                            report_interval=1000, seed=1)
+    assert all(m in data.valid_mgmts[s] for s, m in enumerate(result))
+    assert (vars_over_time == STAND_DATA[stands, result].sum(axis=0)).all()
+
+    # the same bounds, metric and seeded run as the dense array limited to the same mgmts
+    problem = compile_problem(data, axis_map)
+    dense_problem = compile_problem(STAND_DATA, axis_map, valid_mgmts=valid_mgmts)
+    assert np.allclose(problem.theoretical_mins, dense_problem.theoretical_mins)
+    assert np.allclose(problem.theoretical_maxes, dense_problem.theoretical_maxes)
+    totals = STAND_DATA[stands, result].sum(axis=0)
+    assert np.isclose(IncrementalObjective(problem, totals).metric,
+                      IncrementalObjective(dense_problem, totals).metric)
+    # (an empty list draws its mgmts differently from a list of all of them)
+    expected = schedule(STAND_DATA, axis_map, list(data.valid_mgmts), steps=2000,
+                        report_interval=1000, seed=1)
+    assert best == expected[0] and result == expected[1]
+
+    # with every mgmt valid, the same seeded run as the dense array
+    data = ragged_stand_data(STAND_DATA, VALID_MGMTS)
+    result = schedule(data, axis_map, VALID_MGMTS, steps=2000, report_interval=1000, seed=1)
+    expected = schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=2000, report_interval=1000,
+                        seed=1)
+    assert result[0] == expected[0] and result[1] == expected[1]
@@ -0,0 +1,89 @@
+"""
+Tests for temperature calibration and adaptive cooling
+"""
+import math
+import random
+import pytest
+import numpy as np
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.cooling import (calibrate_temperature, cooling_config, AdaptiveCooling,
+                                      DEFAULTS)
+from harvestscheduler.observers import CallbackObserver
+from harvestscheduler._chain import REJECT, ACCEPT, NEW_BEST
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(60, 8, 6, 3)
+
+
+@pytest.fixture
+def axis_map(variables):
+    return dict(AXIS_MAP, variables=variables)
+
+
+def test_calibrate_temperature():
+    deltas = np.array([-3.0, -1.0, 0.5, 1.0, 2.0, 4.0])
+    for acceptance in (0.9, 0.5, 0.01):
+        temp = calibrate_temperature(deltas, acceptance)
+        assert np.exp(-deltas[deltas > 0] / temp).mean() == pytest.approx(acceptance)
+    assert calibrate_temperature([-1.0, 0.0], 0.5) is None
+
+
+def test_cooling_config():
+    assert cooling_config(None) == DEFAULTS
+    assert cooling_config({'interval': 10})['interval'] == 10
+    with pytest.raises(ValueError):
+        cooling_config({'speed': 1})
+    with pytest.raises(ValueError):
+        cooling_config({'end_acceptance': 0})
+    with pytest.raises(ValueError):
+        cooling_config('fast')
+
+
+def test_adaptive_cooling_follows_acceptance():
+    # every uphill move costs 1, so moves are accepted with probability exp(-1 / temp)
+    rng = random.Random(0)
+    cooling = AdaptiveCooling(1e-3, 100.0, cooling_config('adaptive'))
+    accepted = []
+    for step in range(20000):
+        accept = rng.random() < math.exp(-1 / cooling.temp)
+        accepted.append(accept)
+        cooling.observe(ACCEPT if accept else REJECT, False, step / 20000.0)
+        if step in (4999, 9999, 19999):
+            # within a factor of two, the controller lags a falling target
+            target = cooling.target(step / 20000.0)
+            rate = np.mean(accepted[-1000:])
+            assert target / 2 < rate < target * 2
+    assert cooling.temp < 0.3
+
+
+def test_reheat():
+    config = cooling_config({'reheat_after': 50, 'reheat_factor': 3.0, 'interval': 10 ** 6})
+    cooling = AdaptiveCooling(0.1, 10.0, config)
+    cooling.temp = 1.0
+    for step in range(49):
+        cooling.observe(REJECT, False, 0.5)
+    cooling.observe(NEW_BEST, True, 0.5)
+    assert cooling.reheats == 0
+    for step in range(50):
+        cooling.observe(REJECT, False, 0.5)
+    assert cooling.reheats == 1 and cooling.temp == 3.0
+    for step in range(100):
+        cooling.observe(REJECT, False, 0.5)
+    # never above temp_max
+    assert cooling.reheats == 3 and cooling.temp == 10.0
+
+
+def test_schedule_auto_temperatures(axis_map):
+    starts = []
+    temps = []
+    observer = CallbackObserver(on_start=starts.append, on_report=lambda s: temps.append(s['temp']))
+    results = [schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=3000, report_interval=500,
+                        temp_min='auto', temp_max='auto', seed=2, observers=[observer])
+               for i in range(2)]
+    assert results[0][0] == results[1][0] and results[0][1] == results[1][1]
+    start = starts[0]
+    assert start['calibrated'] and 0 < start['temp_min'] < start['temp_max']
+    assert temps[0] < start['temp_max'] and temps[5] == pytest.approx(start['temp_min'], rel=0.01)
+
+    best = schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=3000, report_interval=500,
+                    temp_max='auto', cooling={'reheat_after': 500}, seed=2, observers=[])[0]
+    assert best <= results[0][0] * 1.2
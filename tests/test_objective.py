@@ -0,0 +1,96 @@
+"""
+Tests for the objective function aggregates
+"""
+import numpy as np
+from harvestscheduler import prep_data
+from harvestscheduler._objective import IncrementalObjective, compile_problem
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(50, 10, 20, 5)
+
+STRATEGIES = ['within_bounds', 'cumulative_maximize', 'evenflow',
+              'evenflow_target', 'cumulative_minimize']
+WEIGHTS = [1.0, 2.0, 0.5, 1.5, 1.0]
+TARGETS = [([40.0] * 20, [55.0] * 20), None, None, 450.0, None]
+VARIABLES = [{'name': 'var%d' % i, 'strategy': strategy, 'weight': weight, 'targets': target}
+             for i, (strategy, weight, target) in enumerate(zip(STRATEGIES, WEIGHTS, TARGETS))]
+
+
+def full_objective(vars_over_time, mins, maxes):
+    """ Straightforward, from-scratch objective for comparison """
+    num_periods = vars_over_time.shape[0]
+    metrics = []
+    for s, strategy in enumerate(STRATEGIES):
+        values = vars_over_time[:, s].astype(float)
+        spread = float(maxes[s] - mins[s])
+        w = WEIGHTS[s]
+        if strategy == 'cumulative_maximize':
+            metrics.append(100 * ((maxes[s] - values.sum()) / spread) * w)
+        elif strategy == 'cumulative_minimize':
+            metrics.append(100 * ((values.sum() - mins[s]) / spread) * w)
+        elif strategy == 'evenflow':
+            metrics.append(values.var() / (spread / num_periods) * w * 100)
+        elif strategy == 'within_bounds':
+            lower, upper = [np.array(x) for x in TARGETS[s]]
+            below = lower - values
+            above = values - upper
+            out = below[below > 0].sum() + above[above > 0].sum()
+            metrics.append(out / (spread / num_periods) * 100 * w)
+        elif strategy == 'evenflow_target':
+            diffs = values - TARGETS[s]
+            diffs[diffs < 0] *= -10
+            metrics.append(100 * (diffs / (spread / num_periods / 2.0)).mean() * w)
+    return sum(metrics)
+
+
+def test_incremental_matches_full():
+    rng = np.random.RandomState(0)
+    num_stands, num_mgmts = STAND_DATA.shape[:2]
+    problem = compile_problem(STAND_DATA, {'variables': VARIABLES})
+    mins, maxes = problem.theoretical_mins, problem.theoretical_maxes
+    mgmts = rng.randint(num_mgmts, size=num_stands)
+    vars_over_time = STAND_DATA[np.arange(num_stands), mgmts].sum(axis=0)
+
+    objective = IncrementalObjective(problem, vars_over_time)
+    assert np.allclose(objective.metric, full_objective(vars_over_time, mins, maxes))
+
+    for i in range(200):
+        stand = rng.randint(num_stands)
+        new_mgmt = rng.randint(num_mgmts)
+        diff = STAND_DATA[stand, new_mgmt] - STAND_DATA[stand, mgmts[stand]]
+        metric = objective.evaluate(diff)
+        assert np.allclose(metric, full_objective(vars_over_time + diff, mins, maxes))
+        if i % 2:
+            objective.commit()
+            mgmts[stand] = new_mgmt
+            vars_over_time = vars_over_time + diff
+
+    assert np.allclose(objective.totals, vars_over_time)
+    assert np.allclose(objective.metric, full_objective(vars_over_time, mins, maxes))
+
+
+def test_compiled_order():
+    # two variables per strategy family, interleaved
+    variables = [dict(v, name=v['name'] + x) for v in VARIABLES for x in 'ab']
+    data = np.concatenate([STAND_DATA, STAND_DATA[:, ::-1]], axis=3)
+    problem = compile_problem(data, {'variables': variables})
+    assert sorted(problem.order.tolist()) == list(range(10))
+
+    num_stands = data.shape[0]
+    vars_over_time = data[np.arange(num_stands), 0].sum(axis=0)
+    objective = IncrementalObjective(problem, vars_over_time)
+    assert np.allclose(objective.totals, vars_over_time)
+    diff = data[0, 3] - data[0, 0]
+    metric = objective.evaluate(diff)
+    objective.commit()
+    assert np.allclose(objective.components.sum(), metric)
+    assert np.allclose(objective.totals, vars_over_time + diff)
+
+
+def test_evaluate_batch():
+    problem = compile_problem(STAND_DATA, {'variables': VARIABLES})
+    num_stands = STAND_DATA.shape[0]
+    objective = IncrementalObjective(problem, STAND_DATA[np.arange(num_stands), 0].sum(axis=0))
+    diffs = STAND_DATA[7] - STAND_DATA[7, 0]
+    metrics = objective.evaluate_batch(diffs)
+    assert metrics.shape == (STAND_DATA.shape[1],)
+    assert np.allclose(metrics, [objective.evaluate(diff) for diff in diffs])
@@ -0,0 +1,77 @@
+"""
+Tests for observing a run through callbacks
+"""
+import pytest
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.observers import Observer, CallbackObserver
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(40, 6, 5, 3)
+AXIS_MAP = dict(AXIS_MAP, variables=[
+    {'name': 'a', 'strategy': 'evenflow', 'weight': 1.0},
+    {'name': 'b', 'strategy': 'cumulative_maximize', 'weight': 2.0},
+    {'name': 'c', 'strategy': 'cumulative_minimize', 'weight': 1.0},
+])
+
+
+class Recorder(Observer):
+    def __init__(self):
+        self.events = []
+
+    def on_start(self, stats):
+        self.events.append(('start', stats))
+
+    def on_new_best(self, stats):
+        self.events.append(('new_best', stats))
+
+    def on_temperature_step(self, stats):
+        self.events.append(('temperature_step', stats))
+
+    def on_report(self, stats):
+        self.events.append(('report', stats))
+
+    def on_finish(self, stats):
+        self.events.append(('finish', stats))
+
+
+def test_observers(capsys):
+    recorder = Recorder()
+    reports = []
+    best, mgmts, vars_over_time = schedule(
+        STAND_DATA, AXIS_MAP, VALID_MGMTS, steps=1000, report_interval=250, seed=5,
+        observers=[recorder, CallbackObserver(on_report=reports.append)])
+    # nothing printed without the default observer
+    assert capsys.readouterr()[0] == ''
+
+    events = recorder.events
+    assert events[0][0] == 'start' and events[-1][0] == 'finish'
+    assert events[0][1]['variables'] == ['a', 'b', 'c']
+    assert [x[1]['step'] for x in events if x[0] == 'temperature_step'] == [250, 500, 750, 1000]
+    assert [x['step'] for x in reports] == [250, 500, 750, 1000]
+
+    new_bests = [x[1]['best_metric'] for x in events if x[0] == 'new_best']
+    assert new_bests == sorted(new_bests, reverse=True) and new_bests[-1] == best
+
+    report = reports[-1]
+    assert report['best_metric'] == best
+    assert report['unweighted'][1] == report['weighted'][1] / 2.0
+    assert sum(report['weighted']) == pytest.approx(best)
+    assert report['adjacency_penalty'] is None
+    assert 0 <= report['improvement_rate'] <= report['acceptance_rate'] <= 1
+    assert report['steps_per_sec'] > 0
+    assert sorted(report['timings']) == ['bookkeeping', 'evaluation', 'proposal']
+
+    finish = events[-1][1]
+    assert finish['steps'] == 1000 and finish['best_metric'] == best
+    assert 0 < sum(finish['timings'].values()) < 2 * finish['elapsed']
+
+
+def test_default_prints_report(capsys):
+    schedule(STAND_DATA, AXIS_MAP, VALID_MGMTS, steps=500, report_interval=250, seed=5)
+    out = capsys.readouterr()[0]
+    assert out.count('unweighted best:') == 2
+    assert 'Select sum time' not in out
+
+
+def test_unknown_callback():
+    with pytest.raises(TypeError):
+        CallbackObserver(on_step=None)
@@ -0,0 +1,311 @@
+"""
+Tests for loading stand data with `harvestscheduler.prep_data`
+"""
+import os
+import json
+import sqlite3
+import pytest
+import numpy as np
+from harvestscheduler import prep_data, utils
+
+STANDS = ['a', 'b', 'c']
+MGMTS = [(1, 0), (1, 5), (2, 0)]
+YEARS = [2010, 2015, 2020]
+
+
+def value(s, m, y, v):
+    return s * 1000 + m * 100 + y * 10 + v
+
+
+def make_fvs_stands(path, missing):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE fvs_stands (standid text, rx integer, "offset" integer, '
+                 'climate text, year integer, timber real, carbon real, owl real, cost real)')
+    rows = []
+    for s, standid in enumerate(STANDS):
+        for m, (rx, offset) in enumerate(MGMTS):
+            if (s, m) in missing:
+                continue
+            for y, year in enumerate(YEARS):
+                for climate in ('Ensemble-rcp60', 'Other'):
+                    rows.append([standid, rx, offset, climate, year] +
+                                [value(s, m, y, v) for v in range(4)])
+    # out of order, the loader sorts it out
+    rows.reverse()
+    conn.executemany('INSERT INTO fvs_stands VALUES (?,?,?,?,?,?,?,?,?)', rows)
+    conn.commit()
+    conn.close()
+
+
+def test_prep_db2(tmpdir):
+    path = str(tmpdir.join('fvs.db'))
+    make_fvs_stands(path, missing=[(0, 1), (2, 0), (2, 2)])
+    with tmpdir.as_cwd():
+        arr, axis_map, valid_mgmts = prep_data.prep_db2(path)
+
+    assert arr.shape == (3, 3, 3, 4)
+    assert arr.dtype == np.float32
+    assert sorted(axis_map['standids']) == STANDS
+    assert [tuple(x) for x in axis_map['mgmt']] == MGMTS
+
+    missing = set([('a', 1), ('c', 0), ('c', 2)])
+    for i, standid in enumerate(axis_map['standids']):
+        s = STANDS.index(standid)
+        assert valid_mgmts[i] == [m for m in range(3) if (standid, m) not in missing]
+        for m in range(3):
+            if (standid, m) in missing:
+                assert (arr[i, m] == 0).all()
+            else:
+                expected = [[value(s, m, y, v) for v in range(4)] for y in range(3)]
+                assert (arr[i, m] == expected).all()
+
+
+def test_scatter_rows():
+    arr = np.zeros((2, 2, 3, 1))
+    counts = np.zeros((2, 2), dtype=np.int64)
+    # two chunks, rows of one stand and mgmt continue across them
+    prep_data.scatter_rows(arr, counts, np.array([1, 0, 1]), np.array([0, 1, 0]),
+                           np.array([[1.0], [2.0], [3.0]]))
+    prep_data.scatter_rows(arr, counts, np.array([1]), np.array([0]), np.array([[4.0]]))
+    assert arr[1, 0, :, 0].tolist() == [1.0, 3.0, 4.0]
+    assert arr[0, 1, :, 0].tolist() == [2.0, 0.0, 0.0]
+    assert counts.tolist() == [[0, 1], [3, 0]]
+
+
+def make_fvsaggregate(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE stands (standid integer, acres real, slope real, '
+                 'sitecls integer, rx text)')
+    conn.execute('CREATE TABLE fvsaggregate (var text, climate text, cond integer, '
+                 'site integer, rx integer, "offset" integer, year integer, '
+                 'total_stand_carbon real, removed_merch_ft3 real, NSONEST real, '
+                 'FIREHZD real, CUT_TYPE text)')
+    conn.executemany('INSERT INTO stands VALUES (?,?,?,?,?)', [
+        (1, 10.0, 20.0, 2, ''),     # any rx
+        (2, 20.0, 30.0, 3, '2'),    # only rx 2
+        (3, 30.0, 40.0, 2, '3'),    # rx 3 has no data, so the stand is dropped
+    ])
+    rows = []
+    for cond in (1, 2, 3):
+        for rx, offset in MGMTS:
+            if (cond, rx, offset) == (1, 1, 5):
+                continue  # missing
+            for site in (2, 3):
+                for y, year in enumerate(reversed(YEARS)):
+                    cut_type = ['3', '1', ''][y]
+                    rows.append(('PN', 'Ensemble-rcp60', cond, site, rx, offset, year,
+                                 100.0 * site + y, 1000.0 * cond, 0.5, 2 + y, cut_type))
+                    rows.append(('PN', 'Other', cond, site, rx, offset, year,
+                                 1, 1, 1, 1, None))
+    conn.executemany('INSERT INTO fvsaggregate VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+    conn.commit()
+    conn.close()
+
+
+def test_prep_db(tmpdir):
+    path = str(tmpdir.join('gyb.db'))
+    make_fvsaggregate(path)
+    with tmpdir.as_cwd():
+        arr, axis_map, valid_mgmts = prep_data.prep_db(path)
+
+    assert axis_map['standids'] == [1, 2]
+    assert axis_map['acres'] == [10.0, 20.0]
+    assert [tuple(x) for x in axis_map['mgmt']] == MGMTS
+    assert valid_mgmts == [[0, 2], [2]]
+    assert arr.shape == (2, 3, 3, 6)
+    assert (arr[0, 1] == 0).all()
+
+    # stand 2 at its own site class, years in order
+    metrics = arr[1, 2]
+    timber = 2000.0 * 20.0 / 1000.0
+    assert metrics[:, 0].tolist() == [timber] * 3
+    assert metrics[:, 1].tolist() == [timber] * 3
+    assert metrics[:, 2].tolist() == [(300.0 + y) * 20.0 for y in (2, 1, 0)]
+    assert metrics[:, 3].tolist() == [10.0] * 3
+    assert metrics[:, 4].tolist() == [20.0, 0.0, 0.0]
+    assert metrics[:, 5].tolist() == [0.0, 15.0, 30.0]
+
+    # matches the per-row calculation
+    stand = {'acres': 20.0, 'slope': 30.0}
+    line = {'total_stand_carbon': '302', 'removed_merch_ft3': '2000', 'NSONEST': '0.5',
+            'FIREHZD': '4', 'CUT_TYPE': ''}
+    assert metrics[0].tolist() == prep_data.calculate_metrics(line, stand)
+
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+FEATURES = [
+    {'type': 'Feature', 'properties': {'ID': 'a', 'condid': 2},
+     'geometry': {'type': 'Polygon', 'coordinates': [square(0, 0, 100)]}},
+    # with a hole
+    {'type': 'Feature', 'properties': {'ID': 'b', 'condid': 1},
+     'geometry': {'type': 'Polygon', 'coordinates': [square(100, 0, 100), square(120, 20, 50)]}},
+    {'type': 'Feature', 'properties': {'ID': 'c', 'condid': 2},
+     'geometry': {'type': 'MultiPolygon', 'coordinates': [[square(0, 100, 100)],
+                                                          [square(500, 500, 200)]]}},
+]
+
+
+def test_iter_geojson_features(tmpdir):
+    path = str(tmpdir.join('stands.geojson'))
+    with open(path, 'w') as fh:
+        json.dump({'type': 'FeatureCollection', 'features': FEATURES}, fh, indent=2)
+    # tiny buffers split every feature across reads
+    for buffer_size in (7, 64, 1 << 20):
+        assert list(prep_data.iter_geojson_features(path, buffer_size)) == FEATURES
+
+
+def test_from_geojson_gyb(tmpdir):
+    path = str(tmpdir.join('stands.geojson'))
+    with open(path, 'w') as fh:
+        json.dump({'type': 'FeatureCollection', 'features': FEATURES}, fh)
+    db = str(tmpdir.join('gyb.db'))
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE trees_fvsaggregate (cond integer, rx integer, "offset" text, '
+                 'year integer, removed_merch_bdft real, total_stand_carbon real, FIREHZD real)')
+    rows = []
+    for cond in (1, 2):
+        for rx in (1, 2):
+            if (cond, rx) == (1, 2):
+                continue  # missing
+            for y, year in enumerate(YEARS):
+                rows.append((cond, rx, '0', year, 1000.0 * cond, 10.0 * y, 2 + y))
+    rows.append((1, 1, '0', 2025, 1.0, None, 1.0))  # blank, skipped
+    conn.executemany('INSERT INTO trees_fvsaggregate VALUES (?,?,?,?,?,?,?)', rows[::-1])
+    conn.commit()
+
+    arr, axis_map, valid_mgmts = prep_data.from_geojson_gyb(path, db, chunk_features=2)
+    acres = np.array([10000.0, 7500.0, 50000.0]) / 4046.86
+    assert axis_map['standids'] == ['a', 'b', 'c']
+    assert np.allclose(axis_map['acres'], acres)
+    assert [tuple(x) for x in axis_map['mgmt']] == [(1, '0'), (2, '0')]
+    assert valid_mgmts == [[0, 1], [0], [0, 1]]
+    assert arr.shape == (3, 2, 3, 3)
+    assert (arr[1, 1] == 0).all()
+    for i, cond in enumerate((2, 1, 2)):
+        expected = [[cond * acres[i], 10.0 * y * acres[i], (y > 1) * acres[i]] for y in range(3)]
+        assert np.allclose(arr[i, 0], expected)
+
+
+def test_prep_parallel(tmpdir):
+    path = str(tmpdir.join('fvs.db'))
+    make_fvs_stands(path, missing=[(0, 1), (2, 0)])
+    db = str(tmpdir.join('gyb.db'))
+    make_fvsaggregate(db)
+    with tmpdir.as_cwd():
+        for prep, args in ((prep_data.prep_db2, (path,)), (prep_data.prep_db, (db,))):
+            arr, axis_map, valid_mgmts = prep(*args)
+            arr2, axis_map2, valid_mgmts2 = prep(*args, processes=2)
+            assert (arr == arr2).all()
+            assert axis_map == axis_map2
+            assert valid_mgmts == valid_mgmts2
+
+
+def test_connect_readonly(tmpdir):
+    path = str(tmpdir.join('fvs.db'))
+    make_fvs_stands(path, missing=[])
+    conn = prep_data.connect_readonly(path)
+    assert conn.execute("SELECT count(*) FROM fvs_stands").fetchone()[0] == 54
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM fvs_stands")
+
+
+def test_cache_prep(tmpdir):
+    path = str(tmpdir.join('fvs.db'))
+    make_fvs_stands(path, missing=[])
+    cache_dir = str(tmpdir.join('cache'))
+    calls = []
+
+    def prep(db, climate="Ensemble-rcp60", verbose=False, scale=1):
+        calls.append(climate)
+        arr, axis_map, valid_mgmts = prep_data.prep_db2(db, climate=climate)
+        return arr * scale, axis_map, valid_mgmts
+
+    cached = prep_data.cache_prep(prep, cache_dir=cache_dir)
+    first = cached(path)
+    cached(path, "Ensemble-rcp60", verbose=True)  # same arguments
+    assert calls == ["Ensemble-rcp60"]
+    cached(path, climate="Other")
+    assert calls == ["Ensemble-rcp60", "Other"]
+    again = cached(path)
+    assert calls == ["Ensemble-rcp60", "Other"]
+    assert (again[0] == first[0]).all() and again[2] == first[2]
+
+    # a changed source file is read again
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE fvs_stands SET timber = 0")
+    conn.commit()
+    conn.close()
+    os.utime(path, (1, 1))
+    assert cached(path)[0][:, :, :, 0].sum() == 0
+    assert len(calls) == 3
+    assert len([x for x in os.listdir(cache_dir) if len(x) == 40]) == 3
+
+    # least recently used entries are evicted to fit in max_bytes
+    entry_size = max(prep_data._entry_size(os.path.join(cache_dir, x))
+                     for x in os.listdir(cache_dir))
+    small = prep_data.cache_prep(prep, cache_dir=cache_dir, max_bytes=entry_size * 2)
+    small(path)   # used, so kept
+    small(path, scale=2)
+    assert len(os.listdir(cache_dir)) == 2
+    small(path)
+    small(path, scale=2)
+    assert len(calls) == 4
+
+
+def test_compact_stands(monkeypatch):
+    arr = np.arange(8 * 2 * 3).reshape(8, 2, 3, 1)
+    expected = arr[[0, 2, 3, 4, 7]].copy()
+    # moved a stand at a time
+    monkeypatch.setattr(utils, 'CHUNK_BYTES', 1)
+    compacted = prep_data.compact_stands(arr, [0, 2, 3, 4, 7])
+    assert (compacted == expected).all()
+    assert compacted.base is arr or compacted.base is arr.base
+
+
+def test_prep_out_of_core(tmpdir, monkeypatch):
+    path = str(tmpdir.join('gyb.db'))
+    make_fvsaggregate(path)
+    with tmpdir.as_cwd():
+        arr, axis_map, valid_mgmts = prep_data.prep_db(path)
+        monkeypatch.setattr(prep_data, 'MEMMAP_BYTES', 0)
+        for processes in (None, 2):
+            arr2, axis_map2, valid_mgmts2 = prep_data.prep_db(path, processes=processes)
+            assert isinstance(arr2, np.memmap)
+            assert (arr2 == arr).all()
+            assert axis_map2 == axis_map and valid_mgmts2 == valid_mgmts
+
+
+def test_prep_ragged(tmpdir):
+    path = str(tmpdir.join('fvs.db'))
+    make_fvs_stands(path, missing=[(0, 1), (2, 0), (2, 2)])
+    geojson = str(tmpdir.join('stands.geojson'))
+    with open(geojson, 'w') as fh:
+        json.dump({'type': 'FeatureCollection', 'features': FEATURES}, fh)
+    db = str(tmpdir.join('gyb.db'))
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE trees_fvsaggregate (cond integer, rx integer, "offset" text, '
+                 'year integer, removed_merch_bdft real, total_stand_carbon real, FIREHZD real)')
+    conn.executemany('INSERT INTO trees_fvsaggregate VALUES (?,?,?,?,?,?,?)', [
+        (cond, rx, '0', year, 1000.0 * cond, 10.0 * y, 2 + y)
+        for cond in (1, 2) for rx in (1, 2) for y, year in enumerate(YEARS) if (cond, rx) != (1, 2)])
+    conn.commit()
+
+    with tmpdir.as_cwd():
+        for prep, args in ((prep_data.prep_db2, (path,)),
+                           (prep_data.from_geojson_gyb, (geojson, db))):
+            arr, axis_map, valid_mgmts = prep(*args)
+            for kwargs in ({}, {'processes': 2}):
+                data, axis_map2, valid_mgmts2 = prep(*args, ragged=True, **kwargs)
+                assert len(data.values) == sum(len(x) for x in valid_mgmts) + 1
+                assert np.allclose(data.decode(), arr)
+                assert axis_map2 == axis_map and valid_mgmts2 == valid_mgmts
+
+        # cached as the ragged arrays
+        cached = prep_data.cache_prep(prep_data.prep_db2, cache_dir=str(tmpdir.join('cache')))
+        first = cached(path, ragged=True)[0]
+        again = cached(path, ragged=True)[0]
+        assert (again.values == first.values).all()
+        assert list(again.valid_mgmts) == list(first.valid_mgmts)
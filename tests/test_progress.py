@@ -0,0 +1,99 @@
+"""
+Tests for publishing the progress of a run from a background thread
+"""
+import sys
+import json
+import time
+import threading
+import pytest
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.progress import ProgressPublisher, MemorySink, FileSink, PlotSink
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(40, 6, 5, 3)
+
+
+@pytest.fixture
+def axis_map(variables):
+    return dict(AXIS_MAP, variables=variables)
+
+
+class BrokenSink(object):
+    def write(self, batch):
+        raise RuntimeError("unavailable")
+
+    def close(self):
+        pass
+
+
+def test_progress_sinks(tmpdir, axis_map):
+    memory = MemorySink()
+    path = str(tmpdir.join('progress.jsonl'))
+    logfile = str(tmpdir.join('log.csv'))
+    # a failing sink is warned about and the others carry on
+    with pytest.warns(RuntimeWarning):
+        best = schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=1000, report_interval=300,
+                        logfile=logfile, progress=[BrokenSink(), memory, FileSink(path)])[0]
+
+    assert [len(batch) for batch in memory.batches] == [300, 300, 300, 100]
+    steps = [x for batch in memory.batches for x in batch]
+    assert [x[1] for x in steps] == list(range(1000))
+    assert steps[-1][3] == best
+    lines = [line.split(',') for line in open(logfile).read().splitlines()]
+    names = {'accept+improve': 'acceptimprove', 'new best': 'newbest'}
+    assert [x[2] for x in steps] == [names.get(x[2], x[2]) for x in lines]
+
+    written = [json.loads(line) for line in open(path)]
+    assert written == json.loads(json.dumps(memory.batches))
+    # matplotlib is left alone unless it's plotted
+    assert 'harvestscheduler.plot' not in sys.modules
+
+
+def test_slow_sink_drops_batches():
+    release = threading.Event()
+
+    class SlowSink(MemorySink):
+        def write(self, batch):
+            release.wait()
+            MemorySink.write(self, batch)
+
+    sink = SlowSink()
+    publisher = ProgressPublisher([sink], batch_size=10, queue_size=2)
+    start = time.time()
+    for step in range(100):
+        publisher.record(step, 1.0, 0, 1.0)
+    # the loop doesn't wait for the sink
+    assert time.time() - start < 1.0
+    assert publisher.dropped >= 10 - 3
+    release.set()
+    publisher.close()
+    assert len(sink.batches) == 10 - publisher.dropped
+
+
+def test_main_thread_sinks(axis_map):
+    class MainSink(MemorySink):
+        main_thread = True
+
+        def write(self, batch):
+            assert threading.current_thread().name == 'MainThread'
+            MemorySink.write(self, batch)
+
+    class BrokenMainSink(BrokenSink):
+        main_thread = True
+
+    sink = MainSink()
+    with pytest.warns(RuntimeWarning):
+        schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=1000, report_interval=300,
+                 progress=[sink, BrokenMainSink()], observers=[])
+    # written at the reports and on closing, the failing sink notwithstanding
+    assert [len(batch) for batch in sink.batches] == [300, 300, 300, 100]
+
+
+def test_plot_sink(axis_map):
+    matplotlib = pytest.importorskip('matplotlib')
+    matplotlib.use('Agg')
+    sink = PlotSink(1000)
+    schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=1000, report_interval=300,
+             progress=[sink], observers=[])
+    plot = sink._plot
+    # every step is drawn, after the initial point of each series
+    assert len(plot.x1s) + len(plot.x2s) + len(plot.x3s) == 1000 + 3
@@ -2,7 +2,8 @@
 Tests for `harvestscheduler` module.
 """
 import pytest
-from harvestscheduler import schedule, prep_data
+from harvestscheduler import schedule, parallel_tempering, prep_data
+from harvestscheduler.observers import CallbackObserver
 
 
 # Create a random 4D array
@@ -47,3 +48,73 @@ def test_schedule_random():
     # stochastic process, just make sure it's in the ballpark
     assert 5000 < best and 6000 > best
 
+
+
+def test_best_mgmts_match_best_metric(variables):
+    axis_map = dict(AXIS_MAP, variables=variables)
+    best, optimal_stand_rxs, vars_over_time = schedule(
+        STAND_DATA, axis_map, VALID_MGMTS, steps=3000, report_interval=700)
+
+    # the undo log must reconstruct exactly the best configuration
+    selected = STAND_DATA[list(range(STAND_DATA.shape[0])), optimal_stand_rxs]
+    assert (selected.sum(axis=0) == vars_over_time).all()
+
+
+def test_schedule_batched_moves(variables):
+    axis_map = dict(AXIS_MAP, variables=variables)
+    for move_mode in ('heatbath', 'metropolis'):
+        best, optimal_stand_rxs, vars_over_time = schedule(
+            STAND_DATA, axis_map, VALID_MGMTS, steps=1500, report_interval=500,
+            move_mode=move_mode)
+        selected = STAND_DATA[list(range(STAND_DATA.shape[0])), optimal_stand_rxs]
+        assert (selected.sum(axis=0) == vars_over_time).all()
+        # each step considers every mgmt of a stand, so this converges quickly
+        assert best < 100
+
+
+def test_parallel_tempering(variables):
+    axis_map = dict(AXIS_MAP, variables=variables)
+    best, optimal_stand_rxs, vars_over_time = parallel_tempering(
+        STAND_DATA, axis_map, VALID_MGMTS, steps=2000, replicas=4, processes=2,
+        swap_interval=250, report_interval=1000, temp_min=0.01, temp_max=10, seed=1)
+
+    selected = STAND_DATA[list(range(STAND_DATA.shape[0])), optimal_stand_rxs]
+    assert (selected.sum(axis=0) == vars_over_time).all()
+    assert best < 200
+
+    # each replica keeps its chain and random stream whichever process runs it
+    reports = []
+    single = parallel_tempering(
+        STAND_DATA, axis_map, VALID_MGMTS, steps=2000, replicas=4, processes=1,
+        swap_interval=250, report_interval=1000, temp_min=0.01, temp_max=10, seed=1,
+        observers=[CallbackObserver(on_replica_report=reports.append)])
+    assert single[0] == best and single[1] == optimal_stand_rxs
+
+    assert [x['step'] for x in reports] == [1000, 2000]
+    assert reports[-1]['best_metric'] == best
+    assert len(reports[-1]['metrics']) == 4 and len(reports[-1]['swap_acceptance']) == 3
+    assert all(0 <= x <= 1 for x in reports[-1]['swap_acceptance'])
+
+
+def test_seed_reproducible(variables):
+    axis_map = dict(AXIS_MAP, variables=variables)
+    runs = [schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=1000, report_interval=1000, seed=seed)
+            for seed in (7, 7, 8)]
+    assert runs[0][0] == runs[1][0] and runs[0][1] == runs[1][1]
+    assert runs[0][1] != runs[2][1]
+
+
+def test_proposal_sampler():
+    from harvestscheduler._sampler import ProposalSampler
+    valid_mgmts = [[3], [], [1, 4, 6], [2]]
+    sampler = ProposalSampler(valid_mgmts, 8, seed=0, block_size=64)
+    mgmts = [3, 5, 4, 2]
+    proposed = dict((s, set()) for s in range(4))
+    for i in range(1000):
+        stand, rand_mgmt, rand, rand2 = sampler.draw()
+        proposed[stand].add(sampler.other_mgmt(stand, mgmts[stand], rand_mgmt))
+
+    # immovable stands are never proposed and the current mgmt never is
+    assert proposed[0] == set() and proposed[3] == set()
+    assert proposed[1] == set(range(8)) - set([5])
+    assert proposed[2] == set([1, 6])
@@ -0,0 +1,53 @@
+"""
+Tests for sharing stand data between processes
+"""
+import os
+import pickle
+import multiprocessing
+import numpy as np
+from harvestscheduler import prep_data, parallel_tempering
+from harvestscheduler.shared import share_stand_data
+from harvestscheduler.utils import pack_valid_mgmts, PackedValidMgmts
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(60, 8, 10, 3)
+VALID_MGMTS = [[0, 2, 5], [], [7]] + [[1, 3]] * 57
+
+
+def _stand_sum(args):
+    shared, stand = args
+    stand_data, valid_mgmts = shared.attach()
+    return stand_data[stand].sum(), valid_mgmts[stand]
+
+
+def test_pack_valid_mgmts():
+    indptr, indices = pack_valid_mgmts(VALID_MGMTS)
+    packed = PackedValidMgmts(indptr, indices)
+    assert len(packed) == len(VALID_MGMTS)
+    assert list(packed) == VALID_MGMTS
+
+
+def test_shared_stand_data(variables):
+    with share_stand_data(STAND_DATA, VALID_MGMTS) as shared:
+        # the handle pickles small, and doesn't own the files once unpickled
+        copy = pickle.loads(pickle.dumps(shared))
+        assert len(pickle.dumps(shared)) < 1000
+        assert not copy.owner
+
+        stand_data, valid_mgmts = copy.attach()
+        assert isinstance(stand_data, np.memmap)
+        assert (stand_data == STAND_DATA).all()
+
+        pool = multiprocessing.Pool(2)
+        try:
+            results = pool.map(_stand_sum, [(shared, s) for s in range(3)])
+        finally:
+            pool.close()
+            pool.join()
+        assert results == [(STAND_DATA[s].sum(), VALID_MGMTS[s]) for s in range(3)]
+
+        axis_map = dict(AXIS_MAP, variables=variables)
+        best, mgmts, vars_over_time = parallel_tempering(
+            shared, axis_map, None, steps=200, replicas=2, processes=2, swap_interval=100)
+        assert all(m in VALID_MGMTS[s] for s, m in enumerate(mgmts) if VALID_MGMTS[s])
+
+    assert not os.path.exists(shared.directory)
@@ -0,0 +1,70 @@
+"""
+Tests for stopping a run early or on a time budget
+"""
+import pytest
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.observers import CallbackObserver
+from harvestscheduler.stopping import StoppingCriteria, stopping_config
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(40, 6, 5, 3)
+
+
+@pytest.fixture
+def axis_map(variables):
+    return dict(AXIS_MAP, variables=variables)
+
+
+def run(axis_map, **kwargs):
+    events = {'new_best': [], 'report': [], 'finish': []}
+    observer = CallbackObserver(on_new_best=events['new_best'].append,
+                                on_report=events['report'].append,
+                                on_finish=events['finish'].append)
+    result = schedule(STAND_DATA, axis_map, VALID_MGMTS, seed=4, observers=[observer], **kwargs)
+    return result, events
+
+
+def test_patience(axis_map):
+    criteria = StoppingCriteria(None, stopping_config({'patience': 3, 'tolerance': 0.5,
+                                                       'wall_time': 60}))
+    stops = [criteria.step(step, best) for step, best in enumerate([10, 9.8, 9.6, 9.55, 9.2])]
+    assert stops == [None, None, None, 'patience', None]
+
+    (best, mgmts, vars_over_time), events = run(axis_map, steps=10 ** 6,
+                                                stopping={'patience': 2000})
+    finish = events['finish'][0]
+    assert finish['stopped'] == 'patience' and finish['steps'] < 10 ** 6
+    assert finish['steps'] - events['new_best'][-1]['step'] - 1 == 2000
+    assert finish['best_metric'] == best
+
+
+def test_acceptance(axis_map):
+    result, events = run(axis_map, steps=10000, report_interval=100,
+                         stopping={'min_acceptance': 1.0, 'acceptance_intervals': 2})
+    finish = events['finish'][0]
+    assert finish['stopped'] == 'acceptance' and finish['steps'] == 200
+
+
+def test_wall_time(axis_map):
+    result, events = run(axis_map, steps=None, report_interval=500, temp_max=10.0,
+                         temp_min=0.01, stopping={'wall_time': 1.0})
+    finish = events['finish'][0]
+    assert finish['stopped'] == 'wall_time'
+    assert 0.9 < finish['elapsed'] < 3.0
+    # cooled over the budget rather than the steps
+    temps = [x['temp'] for x in events['report']]
+    assert temps == sorted(temps, reverse=True)
+    assert temps[-1] < 0.02 and temps[len(temps) // 3] > 0.1
+
+
+def test_steps_come_first(axis_map):
+    result, events = run(axis_map, steps=1000, stopping={'cpu_time': 60, 'patience': 10 ** 6})
+    assert events['finish'][0]['stopped'] == 'steps' and events['finish'][0]['steps'] == 1000
+
+
+def test_config_errors(axis_map):
+    with pytest.raises(ValueError):
+        run(axis_map, steps=None)
+    with pytest.raises(ValueError):
+        run(axis_map, stopping={'time': 10})
+    with pytest.raises(ValueError):
+        run(axis_map, stopping={'wall_time': 0})
@@ -0,0 +1,62 @@
+"""
+Tests for the single-file stand data store
+"""
+import pickle
+import pytest
+import numpy as np
+from harvestscheduler import prep_data, schedule, store, utils
+from harvestscheduler._objective import theoretical_bounds
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(40, 6, 5, 3)
+VALID_MGMTS = [[0, 2, 5], [], [4]] + [[1, 3]] * 37
+
+
+def test_round_trip(tmpdir, monkeypatch):
+    path = str(tmpdir.join('problem.hsd'))
+    # several chunks while saving
+    monkeypatch.setattr(utils, 'CHUNK_BYTES', STAND_DATA[:7].nbytes)
+    store.save_stand_data(path, STAND_DATA.astype(np.float32), AXIS_MAP, VALID_MGMTS)
+
+    data = store.StandDataFile(path)
+    assert data.shape == STAND_DATA.shape
+    assert data.axis_map == AXIS_MAP
+    stand_data, valid_mgmts = data.attach()
+    assert isinstance(stand_data, np.memmap)
+    assert stand_data.dtype == np.float32
+    assert (stand_data == STAND_DATA).all()
+    assert list(valid_mgmts) == VALID_MGMTS
+
+    mins, maxes = data.bounds
+    expected_mins, expected_maxes = theoretical_bounds(STAND_DATA, VALID_MGMTS)
+    assert np.allclose(mins, expected_mins) and np.allclose(maxes, expected_maxes)
+
+    # the handle pickles as its path
+    copy = pickle.loads(pickle.dumps(data))
+    assert len(pickle.dumps(data)) < 1000
+    assert (copy.attach()[0] == STAND_DATA).all()
+
+    stand_data, axis_map, valid_mgmts = data.load()
+    assert not isinstance(stand_data, np.memmap)
+    assert valid_mgmts == VALID_MGMTS
+
+
+def test_not_a_store(tmpdir):
+    path = tmpdir.join('other.txt')
+    path.write('nothing to see')
+    with pytest.raises(ValueError):
+        store.StandDataFile(str(path))
+
+
+def test_schedule_from_store(tmpdir, variables):
+    path = str(tmpdir.join('problem.hsd'))
+    store.save_stand_data(path, STAND_DATA, AXIS_MAP, VALID_MGMTS)
+    data = store.StandDataFile(path)
+    axis_map = data.axis_map
+    axis_map['variables'] = variables
+    best, mgmts, vars_over_time = schedule(
+        data, axis_map, None, steps=500, report_interval=250, seed=3)
+    assert all(m in VALID_MGMTS[s] for s, m in enumerate(mgmts) if VALID_MGMTS[s])
+
+    # same result as the in-memory arrays
+    assert best == schedule(STAND_DATA, axis_map, VALID_MGMTS, steps=500,
+                            report_interval=250, seed=3)[0]
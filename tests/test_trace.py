@@ -0,0 +1,53 @@
+"""
+Tests for the binary annealing trace
+"""
+import numpy as np
+from harvestscheduler import schedule, prep_data
+from harvestscheduler.trace import TraceRecorder, load_trace, ACCEPT, NEW_BEST, OUTCOMES
+
+STAND_DATA, AXIS_MAP, VALID_MGMTS = prep_data.from_random(40, 6, 5, 3)
+AXIS_MAP = dict(AXIS_MAP, variables=[
+    {'name': 'a', 'strategy': 'evenflow', 'weight': 1.0},
+    {'name': 'b', 'strategy': 'cumulative_maximize', 'weight': 2.0},
+    {'name': 'c', 'strategy': 'cumulative_minimize', 'weight': 1.0},
+])
+
+
+def run(**kwargs):
+    return schedule(STAND_DATA, AXIS_MAP, VALID_MGMTS, steps=1000, report_interval=500,
+                    seed=4, **kwargs)
+
+
+def test_trace(tmpdir):
+    path = str(tmpdir.join('trace.npy'))
+    logfile = str(tmpdir.join('log.csv'))
+    # several buffers' worth
+    best = run(trace=TraceRecorder(path, buffer_size=300), logfile=logfile)[0]
+
+    trace = load_trace(path)
+    assert trace['step'].tolist() == list(range(1000))
+    assert trace['best'][-1] == best
+    assert (np.diff(trace['best']) <= 0).all()
+    # the components add up to the proposed metric of every step, rejected or not
+    assert (trace['outcome'] < ACCEPT).any()
+    assert np.allclose(trace['components'].sum(axis=1), trace['metric'])
+
+    # and agree with the text log
+    lines = [line.split(',') for line in open(logfile).read().splitlines()]
+    assert [OUTCOMES[x] for x in trace['outcome']] == [x[2] for x in lines]
+    assert np.allclose(trace['metric'], [float(x[1]) for x in lines])
+    assert np.allclose(trace['temp'], [float(x[3]) for x in lines])
+
+
+def test_trace_decimated(tmpdir):
+    full = str(tmpdir.join('full.npy'))
+    run(trace=full)
+    full = load_trace(full, mmap_mode='r')
+
+    path = str(tmpdir.join('every.npy'))
+    run(trace=TraceRecorder(path, every=7, buffer_size=64))
+    assert (load_trace(path) == full[::7]).all()
+
+    path = str(tmpdir.join('best.npy'))
+    run(trace=TraceRecorder(path, min_outcome=NEW_BEST))
+    assert (load_trace(path) == full[full['outcome'] == NEW_BEST]).all()
@@ -0,0 +1,96 @@
+"""
+Tests for the starting configuration: random, given, greedy and polished
+"""
+import numpy as np
+import pytest
+from harvestscheduler import schedule, prep_data
+from harvestscheduler._scheduler import initial_mgmts
+from harvestscheduler._objective import IncrementalObjective, compile_problem
+from harvestscheduler.adjacency import ClumpPenalty
+from harvestscheduler.observers import CallbackObserver
+from harvestscheduler.warmstart import greedy_mgmts, polish_mgmts, impact_order
+
+SIDE = 8
+STAND_DATA, AXIS_MAP, _ = prep_data.from_random(SIDE * SIDE, 8, 6, 3)
+AXIS_MAP = dict(AXIS_MAP, variables=[
+    {'name': 'a', 'strategy': 'within_bounds', 'weight': 1.0, 'targets': (300, 350)},
+    {'name': 'b', 'strategy': 'cumulative_maximize', 'weight': 1.0},
+    {'name': 'c', 'strategy': 'evenflow', 'weight': 1.0},
+])
+# every third stand is limited to mgmts 2, 5 and 7
+VALID_MGMTS = [[2, 5, 7] if s % 3 == 0 else [] for s in range(SIDE * SIDE)]
+PROBLEM = compile_problem(STAND_DATA, AXIS_MAP, valid_mgmts=VALID_MGMTS)
+
+
+def metric(mgmts):
+    totals = STAND_DATA[np.arange(len(mgmts)), mgmts].sum(axis=0)
+    return IncrementalObjective(PROBLEM, totals).metric
+
+
+def test_initial_mgmts():
+    rng = np.random.RandomState(0)
+    mgmts = initial_mgmts(8, VALID_MGMTS, rng=rng)
+    limited = [mgmts[s] for s in range(0, SIDE * SIDE, 3)]
+    assert set(limited) == set([2, 5, 7])
+
+    # valid starting mgmts are kept, others replaced by the first valid one
+    starting = [5 if s % 3 == 0 else 1 for s in range(SIDE * SIDE)]
+    starting[3] = 4
+    mgmts = initial_mgmts(8, VALID_MGMTS, starting, rng)
+    assert mgmts[0] == 5 and mgmts[1] == 1 and mgmts[3] == 2
+
+
+def test_greedy():
+    order, mean_totals = impact_order(STAND_DATA, VALID_MGMTS, PROBLEM)
+    assert sorted(order) == list(range(SIDE * SIDE))
+    expected = sum(STAND_DATA[s, VALID_MGMTS[s] or slice(None)].mean(axis=0)
+                   for s in range(SIDE * SIDE))
+    assert np.allclose(mean_totals, expected)
+
+    mgmts = greedy_mgmts(STAND_DATA, VALID_MGMTS, PROBLEM)
+    assert all(mgmts[s] in (2, 5, 7) for s in range(0, SIDE * SIDE, 3))
+    rng = np.random.RandomState(1)
+    random_metrics = [metric(initial_mgmts(8, VALID_MGMTS, rng=rng)) for i in range(20)]
+    assert metric(mgmts) < min(random_metrics)
+
+
+def test_polish():
+    mgmts = initial_mgmts(8, VALID_MGMTS, rng=np.random.RandomState(2))
+    start = metric(mgmts)
+    totals = STAND_DATA[np.arange(SIDE * SIDE), mgmts].sum(axis=0)
+    objective = IncrementalObjective(PROBLEM, totals)
+    moved = polish_mgmts(STAND_DATA, VALID_MGMTS, objective, mgmts, passes=10)
+    assert moved > 0
+    assert objective.metric < start and objective.metric == pytest.approx(metric(mgmts))
+    assert all(mgmts[s] in (2, 5, 7) for s in range(0, SIDE * SIDE, 3))
+    # a local optimum, no single stand can improve it
+    assert polish_mgmts(STAND_DATA, VALID_MGMTS, objective, mgmts) == 0
+
+
+def test_polish_adjacency(grid_graph):
+    graph = grid_graph(SIDE)
+    penalty = ClumpPenalty(graph, STAND_DATA, 1, 30, weight=5.0, threshold=9)
+    mgmts = greedy_mgmts(STAND_DATA, VALID_MGMTS, PROBLEM)
+    totals = STAND_DATA[np.arange(SIDE * SIDE), mgmts].sum(axis=0)
+    objective = IncrementalObjective(PROBLEM, totals)
+    start = objective.metric + penalty.reset(mgmts)
+    polish_mgmts(STAND_DATA, VALID_MGMTS, objective, mgmts, penalty, passes=3)
+    assert objective.metric + penalty.penalty < start
+    check = ClumpPenalty(graph, STAND_DATA, 1, 30, weight=5.0, threshold=9)
+    assert penalty.penalty == pytest.approx(check.reset(mgmts))
+
+
+def test_schedule_warm_start():
+    starts = []
+    observer = CallbackObserver(on_start=lambda stats: starts.append(stats['start_metric']))
+    results = [schedule(STAND_DATA, AXIS_MAP, VALID_MGMTS, steps=2000, seed=3,
+                        temp_max=0.5, observers=[observer], **options)
+               for options in ({}, {'warm_start': 'greedy'}, {'warm_start': 'greedy', 'polish': 2})]
+    assert starts[0] > starts[1] > starts[2]
+    assert results[2][0] <= starts[2]
+    assert results[2][0] < results[0][0]
+
+    with pytest.raises(ValueError):
+        schedule(STAND_DATA, AXIS_MAP, VALID_MGMTS, warm_start='best')
+    with pytest.raises(ValueError):
+        schedule(STAND_DATA, AXIS_MAP, VALID_MGMTS, warm_start='greedy', starting_mgmts=[0] * 64)